@@ -0,0 +1,902 @@
+# functions/bench.py
+#
+# Benchmark & pemeriksaan paritas lokal (tanpa deploy). Paritas evaluator pohon & encoder
+# fitur dijalankan otomatis oleh pytest (tests/); perintah di sini untuk timing.
+# Jalankan dari folder functions:
+#   python bench.py tree-eval [--model freshlens_lgbm.txt]
+#   python bench.py startup [--repeat 3]
+#   python bench.py features [--items 20000]
+#   python bench.py repredict-sensitivity --model freshlens_lgbm.txt
+#   python bench.py shelflife-grid --model freshlens_lgbm.txt [--grid freshlens_grid.npy | --temp-steps 0.5,1 --humid-steps 2,5]
+#   python bench.py pipeline [--sizes 1000,10000,100000] [--backend memory|emulator] [--save-baseline]
+#   python bench.py async-fanout [--items 10000] [--rpc-latency-ms 5]
+#   python bench.py shadow --model freshlens_lgbm.txt [--shadow-model kandidat.txt] [--sample-rate 0.1 --cpu-budget 0.25]
+#   python bench.py score-export --model freshlens_lgbm.txt [--items 20000] [--workers N]
+
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+import random
+import logging
+import tempfile
+import subprocess
+import urllib.request
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+import main
+
+
+def _timeit(fn: Callable[[], object], repeat: int) -> Dict[str, float]:
+    """Jalankan fn beberapa kali; kembalikan median & p95 (ms)."""
+    samples: List[float] = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - t0) * 1000.0)
+    return {"median_ms": float(np.median(samples)), "p95_ms": float(np.percentile(samples, 95))}
+
+
+def _feature_grid(limit: int, seed: int = 0) -> np.ndarray:
+    """
+    Grid fitur (n, 17): semua kombinasi item x kondisi x penyimpanan x Hari_Ke,
+    dengan suhu/RH dari grid kasar + titik acak (termasuk nilai tepat di ambang).
+    """
+    item_cols = [c for c in main.TRAINING_COLUMNS if c.startswith("Nama_Item_")]
+    cond_cols = [c for c in main.TRAINING_COLUMNS if c.startswith("Kondisi_Awal_")]
+    col = {c: i for i, c in enumerate(main.TRAINING_COLUMNS)}
+    rng = np.random.default_rng(seed)
+
+    rows = []
+    for item, cond, kulkas, day, temp, rh in itertools.product(
+        [None] + item_cols, [None] + cond_cols, (0, 1),
+        (0, 1, 2, 3, 5, 8, 13, 21, 34, 60, 120, 365),
+        (0.0, 4.0, 10.0, 18.5, 25.0, 31.0, 40.0),
+        (30.0, 55.0, 70.0, 85.0, 100.0),
+    ):
+        row = np.zeros(len(main.TRAINING_COLUMNS), dtype=np.float32)
+        row[col["Hari_Ke"]] = day
+        row[col["Suhu (°C)"]] = temp + rng.uniform(-0.5, 0.5)
+        row[col["Kelembapan (%)"]] = rh + rng.uniform(-1.0, 1.0)
+        row[col["temp_x_humid"]] = row[col["Suhu (°C)"]] * row[col["Kelembapan (%)"]]
+        if item:
+            row[col[item]] = 1
+        if cond:
+            row[col[cond]] = 1
+        row[col["Kondisi_Penyimpanan_Kulkas"]] = kulkas
+        rows.append(row)
+    X = np.stack(rows)
+    if len(X) > limit:
+        X = X[rng.choice(len(X), size=limit, replace=False)]
+    return X
+
+
+def _tiled(X: np.ndarray, n: int) -> np.ndarray:
+    return np.resize(X, (n, X.shape[1]))
+
+
+def _synthetic_booster(X: np.ndarray):
+    """Booster kecil hasil lgb.train pada label sisa umur sintetis (timing tanpa file model)."""
+    import lightgbm as lgb
+
+    rng = np.random.default_rng(7)
+    y = 30.0 - 0.4 * X[:, main._IDX_DAY] - 0.5 * X[:, main._IDX_TEMP] + rng.normal(0, 1.5, len(X))
+    return lgb.train({"objective": "regression", "num_leaves": 31, "verbose": -1, "seed": 7},
+                     lgb.Dataset(X, label=np.clip(y, 0, None)), num_boost_round=200)
+
+
+def cmd_tree_eval(args: argparse.Namespace) -> int:
+    """Timing evaluator NumPy vs Booster.predict; paritas dicek di tests/test_tree_eval.py."""
+    import lightgbm as lgb
+
+    X = _feature_grid(args.grid_size)
+    if args.model is None:
+        booster = _synthetic_booster(X)
+        model_str = booster.model_to_string()
+    else:
+        with open(args.model, "r", encoding="utf-8") as f:
+            model_str = f.read()
+        booster = lgb.Booster(model_str=model_str)
+    compiled = main._CompiledEnsemble.from_model_str(model_str)
+    print(f"trees={compiled.num_trees()} nodes={len(compiled.feature)} max_depth={compiled.max_depth}")
+
+    for n in (1, 100, 100_000):
+        data = _tiled(X, n)
+        repeat = 5 if n >= 100_000 else 50
+        lgb_t = _timeit(lambda: booster.predict(data), repeat)
+        np_t = _timeit(lambda: compiled.predict(data), repeat)
+        print(
+            f"[bench] rows={n:>6} lightgbm median={lgb_t['median_ms']:.3f}ms p95={lgb_t['p95_ms']:.3f}ms | "
+            f"numpy median={np_t['median_ms']:.3f}ms p95={np_t['p95_ms']:.3f}ms"
+        )
+    return 0
+
+
+# ===============================
+# Features: timing _FeatureEncoder vs _feature_row
+# ===============================
+def _random_item_docs(n: int, now: datetime, seed: int = 0) -> List[Dict]:
+    """Dokumen item sintetis, termasuk variasi kapitalisasi/spasi, alias, field kosong & batas setengah hari."""
+    rnd = random.Random(seed)
+    names = list(main._ITEM_ALIASES) + ["Apel ", " PISANG", "durian", "", None]
+    conds = list(main._COND_ALIASES) + ["Setengah Matang", " MENTAH ", "busuk", "", None]
+    storages = ["kulkas", "Kulkas ", "suhu ruang", "freezer", "", None]
+    docs = []
+    for i in range(n):
+        doc: Dict = {
+            "itemName": rnd.choice(names),
+            "initialCondition": rnd.choice(conds),
+            "storageMode": rnd.choice(storages),
+        }
+        kind = i % 5
+        if kind == 0:
+            doc["entryDate"] = now - timedelta(days=rnd.randint(0, 400), seconds=rnd.randint(0, 86399))
+        elif kind == 1:
+            doc["entryDate"] = now - timedelta(days=rnd.randint(0, 30) + 0.5)  # tepat x.5 hari
+        elif kind == 2:
+            doc["entryDate"] = (now - timedelta(hours=rnd.randint(0, 500))).replace(tzinfo=None)
+        elif kind == 3:
+            doc["entryDate"] = None
+        elif i % 97 == 4:
+            doc["itemName"] = 42  # tipe salah -> error per item
+        docs.append(doc)
+    return docs
+
+
+def cmd_features(args: argparse.Namespace) -> int:
+    """Timing encoder batch vs _feature_row; paritas dicek di tests/test_features.py."""
+    now = datetime.now(timezone.utc)
+    docs = _random_item_docs(args.items, now)
+    rnd = random.Random(1)
+    temps = [rnd.uniform(0, 40) for _ in docs]
+    humids = [rnd.uniform(20, 100) for _ in docs]
+
+    def reference() -> None:
+        for doc, t, h in zip(docs, temps, humids):
+            try:
+                main._feature_row(doc, {"avg_temp": t, "avg_humid": h}, now)
+            except Exception:
+                pass
+
+    buf = np.empty((len(docs), len(main.TRAINING_COLUMNS)), dtype=np.float32)
+    ref_t = _timeit(reference, 3)
+    enc_t = _timeit(lambda: main._FEATURE_ENCODER.encode(docs, temps, humids, now, out=buf), 3)
+    print(
+        f"[bench] items={len(docs)} reference median={ref_t['median_ms']:.1f}ms | "
+        f"encoder median={enc_t['median_ms']:.1f}ms ({ref_t['median_ms'] / max(enc_t['median_ms'], 1e-9):.1f}x)"
+    )
+    return 0
+
+
+# ===============================
+# Repredict: efek ambang debounce sensor ke prediksi
+# ===============================
+def cmd_repredict_sensitivity(args: argparse.Namespace) -> int:
+    """Perkiraan efek menahan re-prediksi saat drift rata-rata 24 jam < ambang.
+
+    Untuk setiap pergeseran (±ambang suhu, ±ambang RH, keduanya) hitung berapa item yang
+    hari prediksinya akan berubah -- yaitu error maksimum yang diterima karena skip.
+    """
+    with open(args.model, "r", encoding="utf-8") as f:
+        booster = main._parse_model(f.read())
+    now = datetime.now(timezone.utc)
+    docs = _random_item_docs(args.items, now)
+    rnd = random.Random(2)
+    temps = np.array([rnd.uniform(0, 40) for _ in docs])
+    humids = np.array([rnd.uniform(20, 100) for _ in docs])
+
+    X, errors = main._FEATURE_ENCODER.encode(docs, temps.tolist(), humids.tolist(), now)
+    ok_rows = np.array([e is None for e in errors])
+
+    def days(t: np.ndarray, h: np.ndarray) -> np.ndarray:
+        X_shift, _ = main._FEATURE_ENCODER.encode(docs, t.tolist(), h.tolist(), now)
+        return np.rint(np.clip(booster.predict(X_shift[ok_rows]), 0, 365)).astype(int)
+
+    base = days(temps, humids)
+    dt, dh = args.temp_threshold, args.humid_threshold
+    print(f"items={int(ok_rows.sum())} temp_threshold={dt} humid_threshold={dh}")
+    for name, t, h in (
+        (f"temp {dt:+}", temps + dt, humids), (f"temp {-dt:+}", temps - dt, humids),
+        (f"humid {dh:+}", temps, humids + dh), (f"humid {-dh:+}", temps, humids - dh),
+        ("both +", temps + dt, humids + dh), ("both -", temps - dt, humids - dh),
+    ):
+        delta = np.abs(days(t, h) - base)
+        print(
+            f"[effect] {name:>10}: changed={np.mean(delta > 0) * 100:5.1f}% "
+            f"mean|Δdays|={delta.mean():.3f} max|Δdays|={int(delta.max())}"
+        )
+    return 0
+
+
+# ===============================
+# Shelf-life grid: error lookup grid vs booster eksak
+# ===============================
+class _LazyGridValues:
+    """Pengganti array grid: hanya node yang diminta lookup dievaluasi booster (hasil sama dengan grid penuh)."""
+
+    def __init__(self, booster, meta: Dict):
+        self.booster = booster
+        self.meta = meta
+        self.day_rep = np.asarray(meta["day_rep"])
+
+    def __getitem__(self, key) -> np.ndarray:
+        combo, d, ti, hi = key
+        X = main._grid_feature_rows(self.meta, combo, self.day_rep[d], ti, hi)
+        return self.booster.predict(X).astype(np.float32)
+
+
+def _float_list(value: str) -> List[float]:
+    return [float(v) for v in value.split(",") if v]
+
+
+def _grid_report(label: str, grid, booster, X: np.ndarray, exact: np.ndarray, interpolate: bool) -> float:
+    """Cetak coverage & selisih grid vs booster; kembalikan fraksi baris tercakup yang hari integer-nya berbeda."""
+    y, hit = grid.lookup(X, interpolate)
+    exact_days = np.rint(np.clip(exact[hit], 0, 365))
+    got_days = np.rint(np.clip(y[hit], 0, 365))
+    delta = np.abs(got_days - exact_days)
+    raw = np.abs(y[hit] - exact[hit])
+    mismatch = float(np.mean(delta > 0)) if hit.any() else 0.0
+    meta = grid.meta
+    cells = main._GRID_COMBOS * len(meta["day_rep"]) * meta["temp"]["count"] * meta["humid"]["count"]
+    print(
+        f"[grid] {label} temp_step={meta['temp']['step']:g} humid_step={meta['humid']['step']:g} "
+        f"mode={'linear' if interpolate else 'nearest':<7} size={cells * 4 / 1e6:7.1f}MB "
+        f"coverage={np.mean(hit) * 100:5.1f}% days_mismatch={mismatch * 100:6.3f}% "
+        f"max|Δdays|={int(delta.max()) if delta.size else 0} max|Δraw|={float(raw.max()) if raw.size else 0.0:.3f}"
+    )
+    return mismatch
+
+
+def cmd_shelflife_grid(args: argparse.Namespace) -> int:
+    with open(args.model, "r", encoding="utf-8") as f:
+        model_str = f.read()
+    booster = main._parse_model(model_str)
+
+    if args.grid:
+        grid = main._load_shelflife_grid(args.grid)
+        if grid.meta["model_sha256"] != main._model_sha256(model_str):
+            print(f"[grid] WARNING {args.grid} dibangun dari model lain")
+        t_axis, h_axis = grid.meta["temp"], grid.meta["humid"]
+        temp_range = (t_axis["start"], t_axis["start"] + t_axis["step"] * (t_axis["count"] - 1))
+        humid_range = (h_axis["start"], h_axis["start"] + h_axis["step"] * (h_axis["count"] - 1))
+    else:
+        temp_range, humid_range = args.temp_range, args.humid_range
+
+    # Sampel realistis lewat encoder: Hari_Ke 0..400, alias item/kondisi, suhu/RH kontinu dalam rentang
+    now = datetime.now(timezone.utc)
+    docs = _random_item_docs(args.samples, now)
+    rnd = random.Random(3)
+    temps = [rnd.uniform(*temp_range) for _ in docs]
+    humids = [rnd.uniform(*humid_range) for _ in docs]
+    X, errors = main._FEATURE_ENCODER.encode(docs, temps, humids, now)
+    X = X[[e is None for e in errors]]
+    exact = booster.predict(X)
+    print(f"samples={len(X)} day_classes={main._grid_day_classes(model_str)[-1] + 1}")
+
+    if args.grid:
+        worst = 0.0
+        for interpolate in (False, True):
+            m = _grid_report("file", grid, booster, X, exact, interpolate)
+            if interpolate == main.SHELFLIFE_GRID_INTERPOLATE:
+                worst = m
+        grid_t = _timeit(lambda: grid.lookup(X, main.SHELFLIFE_GRID_INTERPOLATE), 5)
+        booster_t = _timeit(lambda: booster.predict(X), 5)
+        print(
+            f"[bench] rows={len(X)} booster median={booster_t['median_ms']:.1f}ms | "
+            f"grid median={grid_t['median_ms']:.1f}ms ({booster_t['median_ms'] / max(grid_t['median_ms'], 1e-9):.1f}x)"
+        )
+        return 1 if worst > args.max_mismatch else 0
+
+    for t_step, h_step in itertools.product(_float_list(args.temp_steps), _float_list(args.humid_steps)):
+        meta = main._shelflife_grid_meta(model_str, temp_range, t_step, humid_range, h_step)
+        grid = main._ShelfLifeGrid(_LazyGridValues(booster, meta), meta)
+        for interpolate in (False, True):
+            _grid_report("sweep", grid, booster, X, exact, interpolate)
+    return 0
+
+
+# ===============================
+# Startup: waktu import & RSS per entry point
+# ===============================
+# Modul berat yang tidak boleh ikut ter-load oleh `import main`
+HEAVY_MODULES = ("numpy", "pandas", "lightgbm", "google.cloud.vision")
+
+# Dependensi berat yang disentuh handler pada pemanggilan pertama
+ENTRY_POINT_DEPS: Dict[str, List[str]] = {
+    "ingestSensorData": [],
+    "registerDevice": [],
+    "unregisterDevice": [],
+    "log_sensor_data_to_history": [],
+    "compact_sensor_history": [],
+    "check_expiring_items": [],
+    "predict_initial_shelflife": ["numpy"],
+    "on_sensor_data_update_and_repredict": ["numpy"],
+    "update_all_shelflives": ["numpy"],
+    "daily_shelflife_recalculation": ["numpy"],
+    "flush_deferred_repredictions": ["numpy"],
+    "annotate_image": ["google.cloud.vision"],
+}
+
+# Budget cold start per entry point (ms total sampai siap, RSS MB)
+STARTUP_BUDGET_LIGHT = {"total_ms": 1500.0, "rss_mb": 120.0}
+STARTUP_BUDGET_HEAVY = {"total_ms": 2500.0, "rss_mb": 200.0}
+
+
+# Dijalankan di interpreter bersih (bench.py sendiri sudah meng-import numpy & main)
+_STARTUP_PROBE = """
+import sys, json, time, resource
+t0 = time.perf_counter()
+import main
+t1 = time.perf_counter()
+heavy = [h for h in {heavy!r} if h in sys.modules]
+for mod in {deps!r}:
+    __import__(mod)
+t2 = time.perf_counter()
+
+def peak_rss_mb():
+    # VmHWM milik image proses ini; ru_maxrss di Linux ikut membawa puncak parent (pytest) lewat fork
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+print(json.dumps({{
+    "import_main_ms": (t1 - t0) * 1000.0,
+    "first_use_ms": (t2 - t1) * 1000.0,
+    "total_ms": (t2 - t0) * 1000.0,
+    "rss_mb": peak_rss_mb(),
+    "heavy_after_import": heavy,
+}}))
+"""
+
+
+def _startup_check(deps: List[str], repeat: int, budget_scale: float) -> Tuple[Dict, List[str]]:
+    """Probe cold start satu entry point di proses baru (terbaik dari `repeat`); kembalikan (hasil, pelanggaran)."""
+    code = _STARTUP_PROBE.format(heavy=HEAVY_MODULES, deps=deps)
+    runs = []
+    for _ in range(repeat):
+        out = subprocess.run(
+            [sys.executable, "-c", code],
+            capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+        )
+        runs.append(json.loads(out.stdout.strip().splitlines()[-1]))
+    best = min(runs, key=lambda r: r["total_ms"])
+    budget = STARTUP_BUDGET_HEAVY if deps else STARTUP_BUDGET_LIGHT
+    problems = []
+    if best["total_ms"] > budget["total_ms"] * budget_scale:
+        problems.append(f"total {best['total_ms']:.0f}ms > {budget['total_ms'] * budget_scale:.0f}ms")
+    if best["rss_mb"] > budget["rss_mb"] * budget_scale:
+        problems.append(f"rss {best['rss_mb']:.0f}MB > {budget['rss_mb'] * budget_scale:.0f}MB")
+    if best["heavy_after_import"]:
+        problems.append(f"heavy modules loaded: {best['heavy_after_import']}")
+    return best, problems
+
+
+def cmd_startup(args: argparse.Namespace) -> int:
+    """Budget juga ditegakkan oleh tests/test_startup.py (STARTUP_BUDGET_SCALE untuk mesin lambat)."""
+    failures = 0
+    for entry_point, deps in ENTRY_POINT_DEPS.items():
+        best, problems = _startup_check(deps, args.repeat, args.budget_scale)
+        failures += bool(problems)
+        print(
+            f"[startup] {entry_point:<36} import={best['import_main_ms']:7.0f}ms first_use={best['first_use_ms']:6.0f}ms "
+            f"rss={best['rss_mb']:6.1f}MB {'FAIL ' + '; '.join(problems) if problems else 'ok'}"
+        )
+    return 1 if failures else 0
+
+
+# ===============================
+# Pipeline: beban end-to-end body fungsi vs Firestore in-memory / emulator
+# ===============================
+PIPELINE_SCENARIOS = ("predict_initial", "repredict_on_sensor", "update_all", "daily_recalc", "expiring")
+PIPELINE_BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baselines.json")
+_UID_CHARS = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+
+
+class _StubBooster:
+    """Pengganti booster tanpa file model: linear murah & deterministik atas fitur numerik."""
+
+    def predict(self, X: np.ndarray) -> np.ndarray:
+        return 14.0 - 0.8 * X[:, 0] - 0.25 * X[:, main._IDX_TEMP] + 0.03 * X[:, main._IDX_HUMID]
+
+
+class _Event:
+    def __init__(self, params: Dict[str, str], data):
+        self.params = params
+        self.data = data
+
+
+class _Change:
+    def __init__(self, before: Dict, after: Dict):
+        self.before = type("Snap", (), {"to_dict": lambda _: before})()
+        self.after = type("Snap", (), {"to_dict": lambda _: after})()
+
+
+class _SendResponse:
+    success = True
+    exception = None
+
+
+def _install_backend(backend: str):
+    """Arahkan firestore.client() milik main ke backend bench; kembalikan (client, counter|None)."""
+    if backend == "memory":
+        import bench_firestore
+
+        client = bench_firestore.Client()
+        async_client = bench_firestore.AsyncClient(client)
+        main.firestore.client = lambda *a, **k: client
+        main.firestore.transactional = bench_firestore.transactional
+        main._async_db = lambda: async_client
+        return client, client.counter
+    if not os.getenv("FIRESTORE_EMULATOR_HOST"):
+        raise SystemExit("backend emulator butuh FIRESTORE_EMULATOR_HOST (firebase emulators:start --only firestore)")
+    project = main.PROJECT_ID or os.getenv("GCLOUD_PROJECT") or "demo-freshlens"
+    url = f"http://{os.environ['FIRESTORE_EMULATOR_HOST']}/emulator/v1/projects/{project}/databases/(default)/documents"
+    urllib.request.urlopen(urllib.request.Request(url, method="DELETE"))
+    return main.firestore.client(), None
+
+
+def _generate_dataset(db, n_items: int, items_per_user: int, history_hours: int, seed: int = 0) -> List[str]:
+    """users x items x history sensor per jam (bacaan tiap 10 menit) + dokumen agregat."""
+    rnd = random.Random(seed)
+    sensor_rnd = random.Random(seed + 1)  # jumlah bacaan jam berjalan tergantung jam -> RNG terpisah
+    now = datetime.now(timezone.utc)
+    names = list(main._ITEM_ALIASES)
+    conds = ["Matang", "Mentah", "Segar", "Setengah Matang"]
+    uids: List[str] = []
+    batch, ops = db.batch(), 0
+
+    def queue(ref, data) -> None:
+        nonlocal batch, ops
+        batch.set(ref, data)
+        ops += 1
+        if ops >= 400:
+            batch.commit()
+            batch, ops = db.batch(), 0
+
+    n_users = max(1, -(-n_items // items_per_user))
+    for u in range(n_users):
+        uid = "".join(rnd.choice(_UID_CHARS) for _ in range(28))
+        uids.append(uid)
+        user_ref = db.collection("users").document(uid)
+        queue(user_ref, {"name": f"bench-{u}", "fcmToken": f"bench-token-{u}" if rnd.random() < 0.9 else None})
+        base_t, base_h = rnd.uniform(18, 32), rnd.uniform(55, 95)
+        queue(user_ref.collection("sensor_data").document("latest"), {"temperature": base_t, "humidity": base_h})
+        for h in range(history_hours, -1, -1):
+            hour = (now - timedelta(hours=h)).replace(minute=0, second=0, microsecond=0)
+            ts = [hour + timedelta(minutes=10 * k) for k in range(6)]
+            ts = [t for t in ts if t <= now]
+            queue(main._sensor_hour_buckets_ref(db, uid).document(main._hour_bucket_key(hour)), {
+                "hourStart": hour,
+                "ts": [round(t.timestamp(), 3) for t in ts],
+                "temperature": [round(base_t + sensor_rnd.gauss(0, 0.7), 2) for _ in ts],
+                "humidity": [round(base_h + sensor_rnd.gauss(0, 2.0), 2) for _ in ts],
+                "source": "bench",
+            })
+        for _ in range(min(items_per_user, n_items - u * items_per_user)):
+            image_id = f"{uid}_{rnd.randrange(10**12, 10**13)}"
+            queue(user_ref.collection("items").document(), {
+                # Field klien seperti FirestoreService.addItem (tidak dibaca jalur skor)
+                "quantity": rnd.randint(1, 12),
+                "ownerId": uid,
+                "imageUrl": f"https://firebasestorage.googleapis.com/v0/b/bench.appspot.com/o/item_images%2F{image_id}.jpg"
+                            f"?alt=media&token={rnd.getrandbits(128):032x}",
+                "itemName": rnd.choice(names).capitalize(),
+                "initialCondition": rnd.choice(conds),
+                "storageMode": rnd.choice(["kulkas", "suhu ruang"]),
+                "entryDate": now - timedelta(days=rnd.uniform(0, 14)),
+                "predictedShelfLife": rnd.randint(0, 10),
+                "predictionUpdatedAt": now - timedelta(hours=5),
+                "nextRecomputeAt": now - timedelta(hours=rnd.uniform(0, 2)),
+            })
+    if ops:
+        batch.commit()
+    for uid in uids:
+        main._rebuild_sensor_aggregate(uid)
+    return uids
+
+
+def _timed_chunks(samples: List[float]):
+    """Bungkus main._repredict_snapshots agar durasi tiap chunk skor tercatat."""
+    original = main._repredict_snapshots
+
+    def wrapper(*args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            return original(*args, **kwargs)
+        finally:
+            samples.append((time.perf_counter() - t0) * 1000.0)
+
+    return original, wrapper
+
+
+def _prepare_scenario(name: str, db, uids: List[str]) -> Tuple[List, str]:
+    """Siapkan payload event (di luar pengukuran); kembalikan (payload, unit latensi)."""
+    if name == "predict_initial":
+        # Payload event dikirim gratis oleh trigger -> snapshot dibaca sebelum counter di-reset
+        return [
+            _Event({"uid": uid, "itemId": snap.id}, snap)
+            for uid in uids for snap in db.collection("users").document(uid).collection("items").stream()
+        ], "item"
+    if name == "repredict_on_sensor":
+        return [
+            _Event({"uid": uid}, _Change({"temperature": 20.0, "humidity": 70.0}, {"temperature": 30.0, "humidity": 60.0}))
+            for uid in uids
+        ], "user"
+    return [], "chunk" if name in ("update_all", "daily_recalc") else "batch"
+
+
+def _execute(name: str, payload: List) -> List[float]:
+    """Jalankan body fungsi skenario; kembalikan latensi (ms) per unit."""
+    samples: List[float] = []
+    if name in ("predict_initial", "repredict_on_sensor"):
+        fn = (main.predict_initial_shelflife if name == "predict_initial" else main.on_sensor_data_update_and_repredict).__wrapped__
+        for event in payload:
+            t0 = time.perf_counter()
+            fn(event)
+            samples.append((time.perf_counter() - t0) * 1000.0)
+    elif name in ("update_all", "daily_recalc"):
+        original, wrapper = _timed_chunks(samples)
+        main._repredict_snapshots = wrapper
+        try:
+            (main.update_all_shelflives if name == "update_all" else main.daily_shelflife_recalculation).__wrapped__(None)
+        finally:
+            main._repredict_snapshots = original
+    elif name == "expiring":
+        def send_each(messages):
+            t0 = time.perf_counter()
+            resp = type("BatchResponse", (), {"responses": [_SendResponse() for _ in messages]})()
+            samples.append((time.perf_counter() - t0) * 1000.0)
+            return resp
+        original = main.messaging.send_each
+        main.messaging.send_each = send_each
+        try:
+            main.check_expiring_items.__wrapped__(None)
+        finally:
+            main.messaging.send_each = original
+    return samples
+
+
+def _percentiles(samples: List[float]) -> Dict[str, Optional[float]]:
+    if not samples:
+        return {"p50_ms": None, "p95_ms": None, "p99_ms": None}
+    p50, p95, p99 = np.percentile(samples, [50, 95, 99])
+    return {"p50_ms": round(float(p50), 3), "p95_ms": round(float(p95), 3), "p99_ms": round(float(p99), 3)}
+
+
+def _compare_baseline(key: str, result: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    """Regresi: throughput turun > tolerance, jumlah op Firestore naik, atau byte terbaca naik > 5%."""
+    problems = []
+    base = baseline.get(key)
+    if not base:
+        return problems
+    if base.get("items_per_s") and result["items_per_s"] < base["items_per_s"] * (1 - tolerance):
+        problems.append(f"items/s {result['items_per_s']:.0f} < baseline {base['items_per_s']:.0f}")
+    for op in ("reads", "writes"):
+        if base.get(op) is not None and result.get(op) is not None and result[op] > base[op]:
+            problems.append(f"{op} {result[op]} > baseline {base[op]}")
+    # Byte terbaca tergantung isi jam berjalan (jumlah bacaan sensor) -> toleransi kecil
+    if base.get("read_bytes") and result.get("read_bytes") is not None and result["read_bytes"] > base["read_bytes"] * 1.05:
+        problems.append(f"read_bytes {result['read_bytes']} > baseline {base['read_bytes']}")
+    return problems
+
+
+def cmd_pipeline(args: argparse.Namespace) -> int:
+    logging.getLogger().setLevel(logging.WARNING)
+    if args.model:
+        with open(args.model, "r", encoding="utf-8") as f:
+            booster = main._parse_model(f.read())
+    else:
+        booster = _StubBooster()
+    main._load_booster_if_needed = lambda: booster
+    # Skenario sensor mengukur recompute penuh: tanpa gate ambang & jendela coalescing
+    main.REPREDICT_TEMP_THRESHOLD = main.REPREDICT_HUMID_THRESHOLD = 0.0
+    main.REPREDICT_COALESCE_MIN = 0.0
+    # Memo statistik sensor tidak kedaluwarsa di tengah skenario: jumlah read tidak tergantung wall time
+    main.SENSOR_STATS_TTL_SEC = 3600.0
+    main.FIRESTORE_ASYNC_PIPELINE = args.async_pipeline
+    if args.rpc_latency_ms and args.backend != "memory":
+        raise SystemExit("--rpc-latency-ms hanya untuk backend memory")
+    variant = args.backend + ("+async" if args.async_pipeline else "") + (f"+rtt{args.rpc_latency_ms:g}ms" if args.rpc_latency_ms else "")
+
+    baseline: Dict = {}
+    if os.path.exists(PIPELINE_BASELINES):
+        with open(PIPELINE_BASELINES, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+
+    regressions = 0
+    results: Dict[str, Dict] = {}
+    for size in [int(x) for x in args.sizes.split(",")]:
+        for name in args.scenarios.split(","):
+            db, counter = _install_backend(args.backend)
+            uids = _generate_dataset(db, size, args.items_per_user, args.history_hours)
+            # Mulai dari instance "hangat" tanpa memo statistik sensor dari skenario sebelumnya
+            with main._sensor_stats_lock:
+                main._sensor_stats_cache.clear()
+            payload, unit = _prepare_scenario(name, db, uids)
+            if counter is not None:
+                counter.reset()
+                db.latency_sec = args.rpc_latency_ms / 1000.0
+            t0 = time.perf_counter()
+            samples = _execute(name, payload)
+            wall = time.perf_counter() - t0
+
+            result = {"items": size, "unit": unit, "wall_s": round(wall, 3),
+                      "items_per_s": round(size / wall, 1), **_percentiles(samples)}
+            if counter is not None:
+                result.update(counter.snapshot())
+            key = f"{variant}:{name}:{size}"
+            results[key] = result
+            problems = _compare_baseline(key, result, baseline, args.tolerance)
+            regressions += bool(problems)
+            ops = (f"reads={result.get('reads')} writes={result.get('writes')} queries={result.get('queries')} "
+                   f"read_kb={round(result['read_bytes'] / 1024) if result.get('read_bytes') is not None else None}")
+            print(
+                f"[pipeline{'' if variant == args.backend else ' ' + variant}] {name:<20} items={size:>7} wall={wall:8.2f}s items/s={result['items_per_s']:>9.1f} "
+                f"{unit} p50={result['p50_ms']} p95={result['p95_ms']} p99={result['p99_ms']}ms {ops} "
+                f"{'REGRESSION ' + '; '.join(problems) if problems else 'ok'}"
+            )
+
+    if args.save_baseline:
+        baseline.update(results)
+        with open(PIPELINE_BASELINES, "w", encoding="utf-8") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"baseline disimpan: {PIPELINE_BASELINES}")
+    return 1 if regressions else 0
+
+
+ASYNC_FANOUT_SCENARIOS = ("repredict_on_sensor", "update_all", "daily_recalc")
+
+
+def _prediction_digest(db, uids: List[str]) -> Dict[str, List]:
+    """Hasil prediksi per user (tanpa id item, yang berbeda antar dataset) untuk paritas antar mode."""
+    return {
+        uid: sorted(
+            (d.get("predictedShelfLife"), d.get("predictionFingerprint") or "", str(d.get("predictionStatus")))
+            for d in (s.to_dict() for s in db.collection("users").document(uid).collection("items").stream())
+        )
+        for uid in uids
+    }
+
+
+def cmd_async_fanout(args: argparse.Namespace) -> int:
+    """Jalur sinkron vs fan-out async (FIRESTORE_ASYNC_PIPELINE) dengan round trip RPC tersimulasi."""
+    logging.getLogger().setLevel(logging.WARNING)
+    booster = _StubBooster()
+    main._load_booster_if_needed = lambda: booster
+    main.REPREDICT_TEMP_THRESHOLD = main.REPREDICT_HUMID_THRESHOLD = 0.0
+    main.REPREDICT_COALESCE_MIN = 0.0
+    main.SENSOR_STATS_TTL_SEC = 3600.0
+    main.ASYNC_FANOUT_CONCURRENCY = args.concurrency
+
+    failed = 0
+    for name in args.scenarios.split(","):
+        runs: Dict[bool, Tuple[float, Dict, Dict]] = {}
+        for use_async in (False, True):
+            main.FIRESTORE_ASYNC_PIPELINE = use_async
+            db, counter = _install_backend("memory")
+            uids = _generate_dataset(db, args.items, args.items_per_user, args.history_hours)
+            with main._sensor_stats_lock:
+                main._sensor_stats_cache.clear()
+            payload, _ = _prepare_scenario(name, db, uids)
+            counter.reset()
+            db.latency_sec = args.rpc_latency_ms / 1000.0
+            t0 = time.perf_counter()
+            _execute(name, payload)
+            wall = time.perf_counter() - t0
+            ops = counter.snapshot()
+            db.latency_sec = 0.0
+            runs[use_async] = (wall, ops, _prediction_digest(db, uids))
+
+        (sync_wall, sync_ops, sync_digest), (async_wall, async_ops, async_digest) = runs[False], runs[True]
+        mismatched = sum(sync_digest[u] != async_digest[u] for u in sync_digest)
+        failed += bool(mismatched)
+        print(
+            f"[async-fanout] {name:<20} items={args.items} rtt={args.rpc_latency_ms:g}ms "
+            f"sync={sync_wall:7.2f}s ({args.items / sync_wall:8.1f} items/s) "
+            f"async={async_wall:7.2f}s ({args.items / async_wall:8.1f} items/s) speedup={sync_wall / async_wall:5.2f}x "
+            f"reads={sync_ops['reads']}/{async_ops['reads']} writes={sync_ops['writes']}/{async_ops['writes']} "
+            f"{'MISMATCH users=' + str(mismatched) if mismatched else 'parity ok'}"
+        )
+    return 1 if failed else 0
+
+
+def cmd_shadow(args: argparse.Namespace) -> int:
+    """Overhead skor shadow pada jalur primary (_score_items) + kepatuhan budget & isi side log."""
+    with open(args.model, "r", encoding="utf-8") as f:
+        model_str = f.read()
+    primary = main._parse_model(model_str)
+    shadow_path = args.shadow_model or args.model
+    with open(shadow_path, "r", encoding="utf-8") as f:
+        shadow_str = f.read()
+    now = datetime.now(timezone.utc)
+    docs = _random_item_docs(args.items, now)
+    rnd = random.Random(3)
+    entries = [(f"u{i % 500}", doc) for i, doc in enumerate(docs)]
+    stats_by_uid = {f"u{i}": {"avg_temp": rnd.uniform(0, 40), "avg_humid": rnd.uniform(20, 100),
+                              "std_temp": 0.5, "std_humid": 2.0} for i in range(500)}
+    chunks = [entries[i:i + main.SCORING_CHUNK_SIZE] for i in range(0, len(entries), main.SCORING_CHUNK_SIZE)]
+
+    def run() -> Tuple[float, List[List]]:
+        t0 = time.perf_counter()
+        out = [main._score_items(primary, chunk, now, stats_by_uid) for chunk in chunks]
+        return time.perf_counter() - t0, out
+
+    main._booster_cache, main._booster_sha256 = primary, main._model_sha256(model_str)
+    main.MODEL_SHADOW_BLOB_PATHS = []
+    run()  # warm-up (kompilasi evaluator, cache)
+    base_wall, base_out = min((run() for _ in range(args.repeat)), key=lambda r: r[0])
+
+    logs: List[Dict] = []
+    original_info = main.logger.info
+    main.logger.info = lambda msg, **kw: logs.append(kw) if kw.get("metric") == "freshlens_shadow" else original_info(msg, **kw)
+    main.MODEL_SHADOW_BLOB_PATHS = [shadow_path]
+    main.MODEL_SHADOW_SAMPLE_RATE = args.sample_rate
+    main.MODEL_SHADOW_CPU_BUDGET = args.cpu_budget
+    main._shadow_models = [main._ShadowModel(shadow_path, main._parse_model(shadow_str), 1, main._model_sha256(shadow_str))]
+    main._shadow_checked_at = time.monotonic() + 10 ** 9  # tanpa refresh dari Storage
+    main._shadow_budget = main._ShadowBudget()
+    try:
+        walls, outs = zip(*(run() for _ in range(args.repeat)))
+    finally:
+        main.logger.info = original_info
+    shadow_wall = min(walls)
+
+    budget = main._shadow_budget
+    ratio = budget.shadow_ms / budget.primary_ms if budget.primary_ms else 0.0
+    def comparable(out: List[List]) -> List:
+        return [(fields, str(err) if err else None, fp) for chunk in out for fields, err, fp in chunk]
+
+    identical = all(comparable(o) == comparable(base_out) for o in outs)
+    print(f"[shadow] items={args.items} chunks={len(chunks)} sample_rate={args.sample_rate} cpu_budget={args.cpu_budget}")
+    print(f"[shadow] primary only   wall={base_wall:.3f}s items/s={args.items / base_wall:9.1f}")
+    print(f"[shadow] with shadow    wall={shadow_wall:.3f}s items/s={args.items / shadow_wall:9.1f} "
+          f"overhead={(shadow_wall / base_wall - 1) * 100:+.1f}%")
+    print(f"[shadow] predict ms primary={budget.primary_ms:.1f} shadow={budget.shadow_ms:.1f} ratio={ratio:.3f} "
+          f"side-log entries={len(logs)} primary results unchanged={identical}")
+    if logs:
+        items = sum(e["items"] for e in logs)
+        changed = sum(e["changed"] for e in logs)
+        mean_abs = sum(e["meanAbsDeltaDays"] * e["items"] for e in logs) / items
+        print(f"[shadow] vs primary: changed={changed}/{items} mean|Δdays|={mean_abs:.3f} "
+              f"max|Δdays|={max(e['maxAbsDeltaDays'] for e in logs)}")
+    same_model = args.shadow_model is None
+    drift = same_model and any(e["changed"] for e in logs)
+    return 1 if (ratio > args.cpu_budget or not identical or drift) else 0
+
+
+def cmd_score_export(args: argparse.Namespace) -> int:
+    """Ekspor dataset fake -> manage.py score-export (pool proses) -> paritas vs _score_items online."""
+    import csv
+    import manage
+
+    logging.getLogger().setLevel(logging.WARNING)
+    db, _ = _install_backend("memory")
+    uids = _generate_dataset(db, args.items, args.items_per_user, args.history_hours)
+    with open(args.model, "r", encoding="utf-8") as f:
+        booster = main._parse_model(f.read())
+
+    with tempfile.TemporaryDirectory() as tmp:
+        items_path, sensors_path = os.path.join(tmp, "items.jsonl"), os.path.join(tmp, "sensors.jsonl")
+        manage.cmd_export_scoring_data(argparse.Namespace(uid=[], items_out=items_path, sensors_out=sensors_path, hours=25))
+        as_of = datetime.now(timezone.utc)
+        out = os.path.join(tmp, "scores.csv")
+        rc = manage.cmd_score_export(argparse.Namespace(
+            items=items_path, sensors=sensors_path, model=args.model, out=out, format="csv",
+            as_of=as_of.isoformat(), grid=args.grid, workers=args.workers, chunk_size=args.chunk_size, write_back=False, status="ok",
+        ))
+        with open(out, "r", encoding="utf-8") as f:
+            offline = {(r["uid"], r["itemId"]): r for r in csv.DictReader(f)}
+
+    # Jalur online (agregat sensor di Firestore fake) pada sampel user, waktu skor yang sama
+    rnd = random.Random(0)
+    checked = day_mismatch = fp_mismatch = 0
+    for uid in rnd.sample(uids, min(len(uids), args.parity_users)):
+        snaps = list(db.collection("users").document(uid).collection("items").stream())
+        results = main._score_items(booster, [(uid, s.to_dict()) for s in snaps], as_of)
+        for snap, (fields, err, fingerprint) in zip(snaps, results):
+            row = offline[(uid, snap.id)]
+            checked += 1
+            days = ",".join(map(str, fields["shelfLifeTrajectory"]["days"]))
+            day_mismatch += row["trajectoryDays"] != days or int(row["predictedShelfLife"]) != fields["predictedShelfLife"]
+            fp_mismatch += row["fingerprint"] != fingerprint
+    print(f"[score-export] parity items={checked} trajectory_mismatch={day_mismatch} fingerprint_mismatch={fp_mismatch}")
+    return 1 if rc or (not args.grid and (day_mismatch or fp_mismatch)) else 0
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Benchmark lokal FreshLens")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("tree-eval", help="Benchmark evaluator NumPy vs Booster.predict")
+    p.add_argument("--model", default=None,
+                   help="Path file model LightGBM (teks); tanpa ini dipakai booster sintetis lgb.train")
+    p.add_argument("--grid-size", type=int, default=50_000)
+    p.set_defaults(func=cmd_tree_eval)
+
+    p = sub.add_parser("features", help="Benchmark encoder fitur batch vs _feature_row")
+    p.add_argument("--items", type=int, default=20_000)
+    p.set_defaults(func=cmd_features)
+
+    p = sub.add_parser("repredict-sensitivity", help="Efek ambang debounce sensor terhadap hari prediksi")
+    p.add_argument("--model", default="freshlens_lgbm.txt", help="Path file model LightGBM (teks)")
+    p.add_argument("--items", type=int, default=20_000)
+    p.add_argument("--temp-threshold", type=float, default=main.REPREDICT_TEMP_THRESHOLD)
+    p.add_argument("--humid-threshold", type=float, default=main.REPREDICT_HUMID_THRESHOLD)
+    p.set_defaults(func=cmd_repredict_sensitivity)
+
+    p = sub.add_parser("shelflife-grid", help="Error grid umur simpan vs booster eksak per ukuran bucket")
+    p.add_argument("--model", default="freshlens_lgbm.txt", help="Path file model LightGBM (teks)")
+    p.add_argument("--grid", default=None, help="Laporkan grid .npy yang sudah dibangun (+ benchmark lookup)")
+    p.add_argument("--samples", type=int, default=50_000)
+    p.add_argument("--temp-range", type=lambda v: tuple(_float_list(v)), default=(0.0, 40.0))
+    p.add_argument("--humid-range", type=lambda v: tuple(_float_list(v)), default=(30.0, 100.0))
+    p.add_argument("--temp-steps", default="0.25,0.5,1", help="Ukuran bucket suhu yang dibandingkan (tanpa --grid)")
+    p.add_argument("--humid-steps", default="1,2,5", help="Ukuran bucket RH yang dibandingkan (tanpa --grid)")
+    p.add_argument("--max-mismatch", type=float, default=0.0, help="Fraksi hari berbeda yang diterima (mode --grid)")
+    p.set_defaults(func=cmd_shelflife_grid)
+
+    p = sub.add_parser("pipeline", help="Latensi, items/s & op Firestore per skenario (fake in-memory / emulator)")
+    p.add_argument("--backend", choices=("memory", "emulator"), default="memory")
+    p.add_argument("--sizes", default="1000,10000", help="Jumlah item total, dipisah koma (mis. 1000,10000,100000)")
+    p.add_argument("--scenarios", default=",".join(PIPELINE_SCENARIOS))
+    p.add_argument("--items-per-user", type=int, default=20)
+    p.add_argument("--history-hours", type=int, default=24)
+    p.add_argument("--model", default=None, help="Pakai model LightGBM asli alih-alih stub booster")
+    p.add_argument("--tolerance", type=float, default=0.3, help="Penurunan items/s yang masih diterima vs baseline")
+    p.add_argument("--save-baseline", action="store_true", help=f"Simpan hasil ke {os.path.basename(PIPELINE_BASELINES)}")
+    p.add_argument("--async-pipeline", action="store_true", help="Jalankan dengan FIRESTORE_ASYNC_PIPELINE=1")
+    p.add_argument("--rpc-latency-ms", type=float, default=0.0, help="Round trip tersimulasi per RPC baca (backend memory)")
+    p.set_defaults(func=cmd_pipeline)
+
+    p = sub.add_parser("score-export", help="Throughput & paritas skor offline (manage.py score-export) vs online")
+    p.add_argument("--model", default="freshlens_lgbm.txt", help="Path file model LightGBM (teks)")
+    p.add_argument("--items", type=int, default=20_000)
+    p.add_argument("--items-per-user", type=int, default=20)
+    p.add_argument("--history-hours", type=int, default=24)
+    p.add_argument("--workers", type=int, default=0, help="Jumlah proses (default semua core)")
+    p.add_argument("--chunk-size", type=int, default=5000)
+    p.add_argument("--parity-users", type=int, default=50)
+    p.add_argument("--grid", default=None, help="Skor offline lewat grid (paritas vs booster eksak jadi perkiraan)")
+    p.set_defaults(func=cmd_score_export)
+
+    p = sub.add_parser("shadow", help="Overhead & budget skor model shadow pada jalur primary")
+    p.add_argument("--model", default="freshlens_lgbm.txt", help="Model primary (teks LightGBM)")
+    p.add_argument("--shadow-model", default=None, help="Model kandidat (default: model primary -> selisih harus 0)")
+    p.add_argument("--items", type=int, default=20_000)
+    p.add_argument("--repeat", type=int, default=3)
+    p.add_argument("--sample-rate", type=float, default=main.MODEL_SHADOW_SAMPLE_RATE)
+    p.add_argument("--cpu-budget", type=float, default=main.MODEL_SHADOW_CPU_BUDGET)
+    p.set_defaults(func=cmd_shadow)
+
+    p = sub.add_parser("async-fanout", help="Jalur sinkron vs fan-out async dengan round trip RPC tersimulasi")
+    p.add_argument("--items", type=int, default=10_000)
+    p.add_argument("--items-per-user", type=int, default=20)
+    p.add_argument("--history-hours", type=int, default=24)
+    p.add_argument("--scenarios", default=",".join(ASYNC_FANOUT_SCENARIOS))
+    p.add_argument("--rpc-latency-ms", type=float, default=5.0, help="Round trip tersimulasi per RPC baca")
+    p.add_argument("--concurrency", type=int, default=main.ASYNC_FANOUT_CONCURRENCY)
+    p.set_defaults(func=cmd_async_fanout)
+
+    p = sub.add_parser("startup", help="Waktu import & RSS per entry point, gagal jika melewati budget")
+    p.add_argument("--repeat", type=int, default=3, help="Ambil run tercepat dari N subprocess")
+    p.add_argument("--budget-scale", type=float, default=1.0, help="Pengali budget (mesin lambat/CI)")
+    p.set_defaults(func=cmd_startup)
+
+    return parser
+
+
+if __name__ == "__main__":
+    args = build_parser().parse_args()
+    sys.exit(args.func(args))
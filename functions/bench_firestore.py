@@ -0,0 +1,604 @@
+# functions/bench_firestore.py
+#
+# Firestore in-memory untuk bench.py (bukan untuk produksi, tidak di-import main).
+# Cukup untuk menjalankan body fungsi di main.py: dokumen/koleksi, set(merge)/update
+# dengan transform (Increment/Minimum/Maximum/DELETE_FIELD/SERVER_TIMESTAMP), query
+# where/order_by/limit/start_after/select, collection_group, batch, transaksi,
+# BulkWriter dan get_all. Setiap operasi dihitung seperti billing Firestore
+# (read per dokumen yang dikembalikan, minimal 1 per query; write per operasi).
+# AsyncClient membungkus Client yang sama untuk jalur firestore_async; latency_sec
+# mensimulasikan round trip tiap RPC baca (time.sleep sinkron / asyncio.sleep async).
+
+import asyncio
+import copy
+import functools
+import itertools
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from google.cloud.firestore_v1 import transforms
+from google.cloud.firestore_v1.field_path import parse_field_path
+
+_auto_ids = itertools.count()
+
+_OPS = {
+    "<": lambda a, b: a < b,
+    "<=": lambda a, b: a <= b,
+    "==": lambda a, b: a == b,
+    "!=": lambda a, b: a != b,
+    ">": lambda a, b: a > b,
+    ">=": lambda a, b: a >= b,
+    "in": lambda a, b: a in b,
+    "not-in": lambda a, b: a not in b,
+    "array_contains": lambda a, b: isinstance(a, list) and b in a,
+    "array-contains": lambda a, b: isinstance(a, list) and b in a,
+}
+_INEQUALITY_OPS = {"<", "<=", ">", ">=", "!=", "not-in"}
+_NAME = "__name__"
+
+
+class OpCounter:
+    """Hitungan read/write/query + perkiraan byte dokumen yang dibaca (thread-safe)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.reads = 0
+            self.writes = 0
+            self.queries = 0
+            self.read_bytes = 0
+
+    def add(self, reads: int = 0, writes: int = 0, queries: int = 0, read_bytes: int = 0) -> None:
+        with self._lock:
+            self.reads += reads
+            self.writes += writes
+            self.queries += queries
+            self.read_bytes += read_bytes
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return {"reads": self.reads, "writes": self.writes, "queries": self.queries,
+                    "read_bytes": self.read_bytes}
+
+
+def _value_size(value) -> int:
+    """Ukuran nilai menurut aturan storage size Firestore (string = UTF-8 + 1, angka/timestamp = 8, ...)."""
+    if isinstance(value, dict):
+        return sum(len(k.encode("utf-8")) + 1 + _value_size(v) for k, v in value.items())
+    if isinstance(value, list):
+        return sum(_value_size(v) for v in value)
+    if isinstance(value, str):
+        return len(value.encode("utf-8")) + 1
+    if value is None or isinstance(value, bool):
+        return 1
+    return 8
+
+
+@functools.lru_cache(maxsize=4096)
+def _field_parts(field_path: str) -> Tuple[str, ...]:
+    """Segmen field path; segmen ber-backtick (mis. buckets.`2026101816`) di-unquote."""
+    return tuple(parse_field_path(field_path) if "`" in field_path else field_path.split("."))
+
+
+def _get_field(data: Dict, field_path: str) -> Tuple[object, bool]:
+    cur: object = data
+    for part in _field_parts(field_path):
+        if not isinstance(cur, dict) or part not in cur:
+            return None, False
+        cur = cur[part]
+    return cur, True
+
+
+def _apply_value(target: Dict, key: str, value: object) -> None:
+    if value is transforms.DELETE_FIELD:
+        target.pop(key, None)
+    elif value is transforms.SERVER_TIMESTAMP:
+        target[key] = datetime.now(timezone.utc)
+    elif isinstance(value, transforms.Increment):
+        target[key] = target.get(key, 0) + value.value
+    elif isinstance(value, transforms.Minimum):
+        target[key] = min(target[key], value.value) if key in target else value.value
+    elif isinstance(value, transforms.Maximum):
+        target[key] = max(target[key], value.value) if key in target else value.value
+    elif isinstance(value, transforms.ArrayUnion):
+        current = list(target.get(key) or [])
+        current += [v for v in value.values if v not in current]
+        target[key] = current
+    elif isinstance(value, transforms.ArrayRemove):
+        target[key] = [v for v in target.get(key) or [] if v not in value.values]
+    else:
+        target[key] = copy.deepcopy(value)
+
+
+def _merge_into(target: Dict, data: Dict) -> None:
+    for key, value in data.items():
+        if isinstance(value, dict) and value:
+            child = target.get(key)
+            if not isinstance(child, dict):
+                child = target[key] = {}
+            _merge_into(child, value)
+        else:
+            _apply_value(target, key, value)
+
+
+def _apply_update(target: Dict, data: Dict) -> None:
+    """update(): key bertitik = field path bersarang, nilai dict menimpa utuh."""
+    for key, value in data.items():
+        parts = _field_parts(key)
+        cur = target
+        for part in parts[:-1]:
+            child = cur.get(part)
+            if not isinstance(child, dict):
+                child = cur[part] = {}
+            cur = child
+        if isinstance(value, dict):
+            fresh: Dict = {}
+            _merge_into(fresh, value)
+            cur[parts[-1]] = fresh
+        else:
+            _apply_value(cur, parts[-1], value)
+
+
+def _snapshot_data(data: Optional[Dict], field_paths: Optional[Iterable[str]]) -> Optional[Dict]:
+    """Salinan data untuk snapshot; proyeksi (select / field_paths) diterapkan sebelum deepcopy."""
+    if data is None:
+        return None
+    if field_paths is not None:
+        projected: Dict = {}
+        for path in field_paths:
+            value, found = _get_field(data, path)
+            if found:
+                *parents, leaf = _field_parts(path)
+                cur = projected
+                for part in parents:
+                    cur = cur.setdefault(part, {})
+                cur[leaf] = value
+        data = projected
+    return copy.deepcopy(data)
+
+
+class DocumentSnapshot:
+    def __init__(self, reference: "DocumentReference", data: Optional[Dict]):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self) -> Optional[Dict]:
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field_path: str):
+        return _get_field(self._data or {}, field_path)[0]
+
+
+class DocumentReference:
+    def __init__(self, client: "Client", path: str):
+        self._client = client
+        self.path = path
+        self.id = path.rsplit("/", 1)[-1]
+
+    @property
+    def parent(self) -> "CollectionReference":
+        return CollectionReference(self._client, self.path.rsplit("/", 1)[0])
+
+    def collection(self, name: str) -> "CollectionReference":
+        return CollectionReference(self._client, f"{self.path}/{name}")
+
+    def get(self, field_paths: Optional[Iterable[str]] = None, transaction=None) -> DocumentSnapshot:
+        self._client._round_trip()
+        return self._get(field_paths)
+
+    def _get(self, field_paths: Optional[Iterable[str]] = None) -> DocumentSnapshot:
+        data = self._client._read(self.path, field_paths)
+        self._client.counter.add(reads=1, read_bytes=_value_size(data or {}))
+        return DocumentSnapshot(self, data)
+
+    def set(self, data: Dict, merge: bool = False) -> None:
+        self._client._write(self.path, lambda cur: _set(cur, data, merge))
+
+    def update(self, data: Dict) -> None:
+        self._client._write(self.path, lambda cur: _update(self.path, cur, data))
+
+    def create(self, data: Dict) -> None:
+        self._client._write(self.path, lambda cur: _create(self.path, cur, data))
+
+    def delete(self) -> None:
+        self._client._write(self.path, lambda cur: None)
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, DocumentReference) and other.path == self.path
+
+    def __hash__(self) -> int:
+        return hash(self.path)
+
+
+def _set(current: Optional[Dict], data: Dict, merge: bool) -> Dict:
+    doc = copy.deepcopy(current) if (merge and current is not None) else {}
+    _merge_into(doc, data)
+    return doc
+
+
+def _update(path: str, current: Optional[Dict], data: Dict) -> Dict:
+    if current is None:
+        raise KeyError(f"404 No document to update: {path}")
+    doc = copy.deepcopy(current)
+    _apply_update(doc, data)
+    return doc
+
+
+def _create(path: str, current: Optional[Dict], data: Dict) -> Dict:
+    if current is not None:
+        raise KeyError(f"409 Document already exists: {path}")
+    return _set(None, data, False)
+
+
+class Query:
+    DESCENDING = "DESCENDING"
+    ASCENDING = "ASCENDING"
+
+    def __init__(self, client: "Client", collections, filters=(), orders=(), limit=None,
+                 start_after=None, projection=None):
+        self._client = client
+        self._collections = collections  # callable -> list path koleksi
+        self._filters: Tuple = tuple(filters)
+        self._orders: Tuple = tuple(orders)
+        self._limit = limit
+        self._start_after = start_after
+        self._projection = projection
+
+    def _copy(self, **kw) -> "Query":
+        args = dict(filters=self._filters, orders=self._orders, limit=self._limit,
+                    start_after=self._start_after, projection=self._projection)
+        args.update(kw)
+        return Query(self._client, self._collections, **args)
+
+    def where(self, field_path: str, op_string: str, value) -> "Query":
+        return self._copy(filters=self._filters + ((field_path, op_string, value),))
+
+    def order_by(self, field_path: str, direction: str = "ASCENDING") -> "Query":
+        return self._copy(orders=self._orders + ((field_path, direction),))
+
+    def limit(self, count: int) -> "Query":
+        return self._copy(limit=count)
+
+    def start_after(self, snapshot: DocumentSnapshot) -> "Query":
+        return self._copy(start_after=snapshot)
+
+    def select(self, field_paths: Iterable[str]) -> "Query":
+        return self._copy(projection=list(field_paths))
+
+    def _normalized_orders(self) -> List[Tuple[str, str]]:
+        orders = list(self._orders)
+        ordered = {f for f, _ in orders}
+        for field, op, _ in self._filters:
+            if op in _INEQUALITY_OPS and field not in ordered and field != _NAME:
+                orders.insert(0, (field, "ASCENDING"))
+                ordered.add(field)
+        if _NAME not in ordered:
+            orders.append((_NAME, orders[-1][1] if orders else "ASCENDING"))
+        return orders
+
+    @staticmethod
+    def _value(path: str, data: Dict, field: str):
+        if field == _NAME:
+            return path
+        return _get_field(data, field)
+
+    def _matches(self, path: str, data: Dict) -> bool:
+        for field, op, value in self._filters:
+            if field == _NAME:
+                actual = path
+                value = value.path if isinstance(value, DocumentReference) else value
+            else:
+                actual, found = _get_field(data, field)
+                if not found:
+                    return False
+            try:
+                if not _OPS[op](actual, value):
+                    return False
+            except TypeError:
+                return False
+        return True
+
+    def stream(self, transaction=None):
+        self._client._round_trip()
+        yield from self._stream()
+
+    def _stream(self):
+        orders = self._normalized_orders()
+        with self._client._lock:
+            rows = []
+            for coll in self._collections():
+                for doc_id, data in self._client._store.get(coll, {}).items():
+                    path = f"{coll}/{doc_id}"
+                    if not self._matches(path, data):
+                        continue
+                    if any(f != _NAME and not _get_field(data, f)[1] for f, _ in orders):
+                        continue
+                    rows.append((path, data))
+
+        def key(row) -> List:
+            return [row[0] if f == _NAME else _get_field(row[1], f)[0] for f, _ in orders]
+
+        for i in range(len(orders) - 1, -1, -1):
+            rows.sort(key=lambda r: key(r)[i], reverse=orders[i][1] == "DESCENDING")
+        if self._start_after is not None:
+            cursor_path = self._start_after.reference.path
+            cursor_data = self._start_after._data or {}
+            cursor = key((cursor_path, cursor_data))
+            descending = orders[0][1] == "DESCENDING"
+            rows = [r for r in rows if (key(r) < cursor if descending else key(r) > cursor)]
+        if self._limit is not None:
+            rows = rows[: self._limit]
+
+        self._client.counter.add(reads=max(1, len(rows)), queries=1)
+        for path, data in rows:
+            data = _snapshot_data(data, self._projection)
+            self._client.counter.add(read_bytes=_value_size(data))
+            yield DocumentSnapshot(DocumentReference(self._client, path), data)
+
+    def get(self, transaction=None) -> List[DocumentSnapshot]:
+        return list(self.stream())
+
+
+class CollectionReference(Query):
+    def __init__(self, client: "Client", path: str):
+        super().__init__(client, lambda: [path])
+        self.path = path
+        self.id = path.rsplit("/", 1)[-1]
+
+    @property
+    def parent(self) -> Optional[DocumentReference]:
+        if "/" not in self.path:
+            return None
+        return DocumentReference(self._client, self.path.rsplit("/", 1)[0])
+
+    def document(self, document_id: Optional[str] = None) -> DocumentReference:
+        return DocumentReference(self._client, f"{self.path}/{document_id or f'auto{next(_auto_ids):012d}'}")
+
+    def add(self, data: Dict):
+        ref = self.document()
+        ref.set(data)
+        return datetime.now(timezone.utc), ref
+
+    def list_documents(self) -> List[DocumentReference]:
+        with self._client._lock:
+            ids = list(self._client._store.get(self.path, {}))
+        return [self.document(i) for i in ids]
+
+
+class WriteBatch:
+    def __init__(self, client: "Client"):
+        self._client = client
+        self._ops: List = []
+
+    def set(self, reference: DocumentReference, data: Dict, merge: bool = False) -> None:
+        self._ops.append((reference.path, lambda cur: _set(cur, data, merge)))
+
+    def update(self, reference: DocumentReference, data: Dict) -> None:
+        path = reference.path
+        self._ops.append((path, lambda cur: _update(path, cur, data)))
+
+    def create(self, reference: DocumentReference, data: Dict) -> None:
+        path = reference.path
+        self._ops.append((path, lambda cur: _create(path, cur, data)))
+
+    def delete(self, reference: DocumentReference) -> None:
+        self._ops.append((reference.path, lambda cur: None))
+
+    def commit(self) -> List:
+        ops, self._ops = self._ops, []
+        with self._client._lock:
+            for path, fn in ops:
+                self._client._write(path, fn)
+        return [None] * len(ops)
+
+    def __len__(self) -> int:
+        return len(self._ops)
+
+
+class Transaction(WriteBatch):
+    """Transaksi sederhana: read langsung, write ditahan sampai commit (tanpa konflik/retry)."""
+
+    def get(self, ref_or_query):
+        if isinstance(ref_or_query, DocumentReference):
+            return ref_or_query.get()
+        return ref_or_query.stream()
+
+
+def transactional(fn):
+    """Pengganti firebase_admin.firestore.transactional untuk Transaction di atas."""
+    def wrapper(transaction: Transaction, *args, **kwargs):
+        result = fn(transaction, *args, **kwargs)
+        transaction.commit()
+        return result
+    return wrapper
+
+
+class BulkWriter:
+    """BulkWriter sinkron: op langsung diterapkan, callback hasil/error dipanggil seperti aslinya."""
+
+    class _Failure:
+        def __init__(self, reference, error: Exception, attempts: int):
+            self.operation = type("Operation", (), {"reference": reference})()
+            self.code = 5 if isinstance(error, KeyError) else 13
+            self.message = str(error)
+            self.attempts = attempts
+
+    def __init__(self, client: "Client", options=None):
+        self._client = client
+        self._on_result = None
+        self._on_error = None
+
+    def on_write_result(self, callback) -> None:
+        self._on_result = callback
+
+    def on_write_error(self, callback) -> None:
+        self._on_error = callback
+
+    def _run(self, reference: DocumentReference, fn) -> None:
+        attempts = 0
+        while True:
+            try:
+                self._client._write(reference.path, fn)
+            except Exception as e:
+                attempts += 1
+                if self._on_error and self._on_error(self._Failure(reference, e, attempts), self):
+                    continue
+                return
+            if self._on_result:
+                self._on_result(reference, None, self)
+            return
+
+    def set(self, reference: DocumentReference, data: Dict, merge: bool = False) -> None:
+        self._run(reference, lambda cur: _set(cur, data, merge))
+
+    def update(self, reference: DocumentReference, data: Dict) -> None:
+        self._run(reference, lambda cur: _update(reference.path, cur, data))
+
+    def create(self, reference: DocumentReference, data: Dict) -> None:
+        self._run(reference, lambda cur: _create(reference.path, cur, data))
+
+    def delete(self, reference: DocumentReference) -> None:
+        self._run(reference, lambda cur: None)
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class Client:
+    def __init__(self):
+        self._lock = threading.RLock()
+        # path koleksi -> {doc_id: data}; group id -> set path koleksi
+        self._store: Dict[str, Dict[str, Dict]] = {}
+        self._groups: Dict[str, Set[str]] = {}
+        self.counter = OpCounter()
+        self.latency_sec = 0.0
+
+    def _round_trip(self) -> None:
+        if self.latency_sec > 0:
+            time.sleep(self.latency_sec)
+
+    def _read(self, path: str, field_paths: Optional[Iterable[str]] = None) -> Optional[Dict]:
+        coll, doc_id = path.rsplit("/", 1)
+        with self._lock:
+            return _snapshot_data(self._store.get(coll, {}).get(doc_id), field_paths)
+
+    def _write(self, path: str, fn) -> None:
+        coll, doc_id = path.rsplit("/", 1)
+        with self._lock:
+            docs = self._store.get(coll)
+            new = fn(docs.get(doc_id) if docs is not None else None)
+            if new is None:
+                if docs is not None:
+                    docs.pop(doc_id, None)
+            else:
+                if docs is None:
+                    docs = self._store[coll] = {}
+                    self._groups.setdefault(coll.rsplit("/", 1)[-1], set()).add(coll)
+                docs[doc_id] = new
+        self.counter.add(writes=1)
+
+    def collection(self, name: str) -> CollectionReference:
+        return CollectionReference(self, name)
+
+    def document(self, path: str) -> DocumentReference:
+        return DocumentReference(self, path)
+
+    def collection_group(self, collection_id: str) -> Query:
+        return Query(self, lambda: sorted(self._groups.get(collection_id, ())))
+
+    def get_all(self, references: Iterable[DocumentReference], field_paths: Optional[Iterable[str]] = None, transaction=None):
+        self._round_trip()  # BatchGetDocuments: satu RPC untuk semua referensi
+        for ref in references:
+            yield ref._get(field_paths)
+
+    def batch(self) -> WriteBatch:
+        return WriteBatch(self)
+
+    def transaction(self, **kwargs) -> Transaction:
+        return Transaction(self)
+
+    def bulk_writer(self, options=None) -> BulkWriter:
+        return BulkWriter(self, options)
+
+    def document_count(self) -> int:
+        with self._lock:
+            return sum(len(d) for d in self._store.values())
+
+
+class AsyncDocumentReference:
+    def __init__(self, client: "AsyncClient", ref: DocumentReference):
+        self._client = client
+        self._ref = ref
+        self.path = ref.path
+        self.id = ref.id
+
+    def collection(self, name: str) -> "AsyncQuery":
+        return AsyncQuery(self._client, self._ref.collection(name))
+
+    async def get(self, field_paths: Optional[Iterable[str]] = None, transaction=None) -> DocumentSnapshot:
+        await self._client._round_trip()
+        return self._ref._get(field_paths)
+
+
+class AsyncQuery:
+    """Query/CollectionReference async: builder diteruskan ke Query sinkron, stream() = 1 round trip."""
+
+    def __init__(self, client: "AsyncClient", query: Query):
+        self._client = client
+        self._query = query
+
+    def _wrap(self, method: str, *args, **kwargs) -> "AsyncQuery":
+        return AsyncQuery(self._client, getattr(self._query, method)(*args, **kwargs))
+
+    def where(self, *args, **kwargs) -> "AsyncQuery":
+        return self._wrap("where", *args, **kwargs)
+
+    def order_by(self, *args, **kwargs) -> "AsyncQuery":
+        return self._wrap("order_by", *args, **kwargs)
+
+    def limit(self, count: int) -> "AsyncQuery":
+        return self._wrap("limit", count)
+
+    def start_after(self, snapshot: DocumentSnapshot) -> "AsyncQuery":
+        return self._wrap("start_after", snapshot)
+
+    def select(self, field_paths: Iterable[str]) -> "AsyncQuery":
+        return self._wrap("select", field_paths)
+
+    def document(self, document_id: Optional[str] = None) -> AsyncDocumentReference:
+        return AsyncDocumentReference(self._client, self._query.document(document_id))
+
+    async def stream(self, transaction=None):
+        await self._client._round_trip()
+        for snap in self._query._stream():
+            yield snap
+
+
+class AsyncClient:
+    """Pengganti firestore_async.client() di atas data & counter Client yang sama."""
+
+    def __init__(self, client: Client):
+        self._sync = client
+
+    async def _round_trip(self) -> None:
+        if self._sync.latency_sec > 0:
+            await asyncio.sleep(self._sync.latency_sec)
+
+    def collection(self, name: str) -> AsyncQuery:
+        return AsyncQuery(self, self._sync.collection(name))
+
+    def collection_group(self, collection_id: str) -> AsyncQuery:
+        return AsyncQuery(self, self._sync.collection_group(collection_id))
+
+    def document(self, path: str) -> AsyncDocumentReference:
+        return AsyncDocumentReference(self, self._sync.document(path))
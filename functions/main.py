@@ -1,30 +1,60 @@
 # functions/main.py
+from __future__ import annotations
 
 # ===============================
 # Imports
 # ===============================
 import os
+import asyncio
 import json
+import math
+import struct
 import base64
 import time
 import tempfile
 import logging
+import threading
+import hashlib
+import importlib
+import functools
+import contextvars
+import random
+import itertools
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta, timezone
-from typing import Optional, Dict, List
-
-# Import berat: tetap di top-level sesuai permintaan
-import numpy as np
-import pandas as pd
-import lightgbm as lgb
+from typing import Optional, Dict, List, Tuple, Union
 
 from firebase_functions import scheduler_fn
-from firebase_functions import firestore_fn, https_fn, options
+from firebase_functions import firestore_fn, https_fn, options, logger
 from firebase_admin import initialize_app, storage, firestore, messaging
+from google.cloud.firestore_v1.bulk_writer import BulkWriterOptions, BulkRetry
+from google.cloud.firestore_v1.field_path import FieldPath
+
+# Import berat (numpy, lightgbm, vision) ditunda sampai benar-benar dipakai,
+# supaya endpoint ringan (ingestSensorData, registerDevice, ...) cold start cepat.
+class _LazyModule:
+    """Proxy modul: import terjadi pada akses atribut pertama, lalu nama global diganti modul asli."""
+
+    def __init__(self, name: str, alias: str):
+        self._name = name
+        self._alias = alias
+
+    def __getattr__(self, attr: str):
+        module = importlib.import_module(self._name)
+        globals()[self._alias] = module
+        return getattr(module, attr)
 
-try:
-    from google.cloud import vision
-except ImportError:
-    vision = None
+np = _LazyModule("numpy", "np")
+lgb = _LazyModule("lightgbm", "lgb")
+
+def _vision_module():
+    """google-cloud-vision (lazy); None jika tidak terpasang."""
+    try:
+        from google.cloud import vision
+    except ImportError:
+        return None
+    return vision
 
 # ===============================
 # Konfigurasi Global
@@ -41,13 +71,26 @@ DEFAULT_BUCKET = (
 
 
 # ---- NAMA FILE MODEL DI STORAGE (root bucket)
-MODEL_BLOB_PATH = "freshlens_lgbm.txt"
+MODEL_BLOB_PATH = os.getenv("MODEL_BLOB_PATH", "freshlens_lgbm.txt")
 
 options.set_global_options(region="asia-southeast2")
 initialize_app(options={"storageBucket": DEFAULT_BUCKET})
 
-# Cache booster di memori proses
-_booster_cache: Optional[lgb.Booster] = None
+# Cache booster di memori proses (di-key generation blob di Storage)
+_booster_cache: Optional["Model"] = None
+_booster_generation: Optional[int] = None
+_booster_sha256: Optional[str] = None   # sha256 teks model ter-cache (kunci grid umur simpan)
+_booster_checked_at: float = 0.0
+_booster_lock = threading.Lock()
+
+# Interval cek metadata blob (deteksi model baru tanpa redeploy)
+MODEL_GENERATION_CHECK_SEC = float(os.getenv("MODEL_GENERATION_CHECK_SEC", "300"))
+# Salinan lokal model per generation (/tmp bertahan selama instance hangat)
+MODEL_LOCAL_CACHE_DIR = os.getenv("MODEL_LOCAL_CACHE_DIR", tempfile.gettempdir())
+# "1" = muat booster di thread background saat import (warm-up)
+MODEL_WARMUP = os.getenv("MODEL_WARMUP", "0") == "1"
+# "numpy" = evaluator pohon terkompilasi (fallback ke LightGBM bila model tidak didukung)
+MODEL_EVALUATOR = os.getenv("MODEL_EVALUATOR", "numpy")
 
 # --- TRAINING_COLUMNS (17 fitur final) ---
 TRAINING_COLUMNS: List[str] = [
@@ -60,81 +103,704 @@ TRAINING_COLUMNS: List[str] = [
     "Kondisi_Penyimpanan_Kulkas"
 ]
 
+# ===============================
+# Helper: Metrik per-invocation (log JSON terstruktur)
+# ===============================
+# Invocation yang tersampel mengeluarkan satu entri log terstruktur "[Metrics]" berisi durasi
+# per stage (model_load, sensor_stats, firestore_read, feature_build, predict, write), hitungan
+# read/write Firestore, cache hit booster & cold/warm start. Default 0 = mati (tanpa biaya).
+METRICS_SAMPLE_RATE = float(os.getenv("METRICS_SAMPLE_RATE", "0"))
+
+_PROCESS_STARTED = time.monotonic()
+_cold_start = True
+_current_metrics: "contextvars.ContextVar[Optional[_InvocationMetrics]]" = contextvars.ContextVar(
+    "freshlens_metrics", default=None
+)
+
+class _InvocationMetrics:
+    """Akumulator stage & counter satu invocation (thread-safe untuk sweep paralel)."""
+
+    def __init__(self, function: str, cold: bool):
+        self.function = function
+        self.cold = cold
+        self.started = time.perf_counter()
+        self.stages: Dict[str, List[float]] = {}  # nama -> [count, total_ms, max_ms]
+        self.counters: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def add_stage(self, name: str, elapsed_ms: float) -> None:
+        with self._lock:
+            stage = self.stages.setdefault(name, [0, 0.0, 0.0])
+            stage[0] += 1
+            stage[1] += elapsed_ms
+            stage[2] = max(stage[2], elapsed_ms)
+
+    def count(self, name: str, n: int) -> None:
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def emit(self, error: Optional[BaseException]) -> None:
+        logger.info(
+            f"[Metrics] {self.function}",
+            metric="freshlens_invocation",
+            function=self.function,
+            coldStart=self.cold,
+            processAgeSec=round(time.monotonic() - _PROCESS_STARTED, 1),
+            totalMs=round((time.perf_counter() - self.started) * 1000.0, 2),
+            stages={k: {"count": c, "totalMs": round(t, 2), "maxMs": round(m, 2)} for k, (c, t, m) in self.stages.items()},
+            counters=dict(self.counters),
+            error=type(error).__name__ if error else None,
+            sampleRate=METRICS_SAMPLE_RATE,
+        )
+
+class _Stage:
+    __slots__ = ("_metrics", "_name", "_t0")
+
+    def __init__(self, metrics: _InvocationMetrics, name: str):
+        self._metrics = metrics
+        self._name = name
+
+    def __enter__(self) -> None:
+        self._t0 = time.perf_counter()
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self._metrics.add_stage(self._name, (time.perf_counter() - self._t0) * 1000.0)
+
+class _NoStage:
+    __slots__ = ()
+
+    def __enter__(self) -> None:
+        pass
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        pass
+
+_NO_STAGE = _NoStage()
+
+def _stage(name: str):
+    """Context manager pengukur durasi stage; no-op bila invocation tidak tersampel."""
+    metrics = _current_metrics.get()
+    return _NO_STAGE if metrics is None else _Stage(metrics, name)
+
+def _metric_count(name: str, n: int = 1) -> None:
+    metrics = _current_metrics.get()
+    if metrics is not None:
+        metrics.count(name, n)
+
+def _instrumented(func):
+    """Bungkus entry point: tandai cold start, sampling, dan emit metrik di akhir invocation."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        global _cold_start
+        cold, _cold_start = _cold_start, False
+        if METRICS_SAMPLE_RATE <= 0 or random.random() >= METRICS_SAMPLE_RATE:
+            return func(*args, **kwargs)
+
+        metrics = _InvocationMetrics(func.__name__, cold)
+        token = _current_metrics.set(metrics)
+        error: Optional[BaseException] = None
+        try:
+            return func(*args, **kwargs)
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            _current_metrics.reset(token)
+            metrics.emit(error)
+    return wrapper
+
 # ===============================
 # Helper: Loader Model (LightGBM)
 # ===============================
-def _load_booster_if_needed() -> lgb.Booster:
-    """Lazy-load LightGBM booster dari Firebase Storage dan cache di memori."""
-    global _booster_cache
-    if _booster_cache is not None:
+def _load_booster_if_needed() -> "Model":
+    """
+    Lazy-load LightGBM booster dari Firebase Storage dan cache di memori.
+    Cache di-key generation blob; metadata dicek paling sering tiap
+    MODEL_GENERATION_CHECK_SEC sehingga model baru terpakai tanpa redeploy.
+    """
+    with _stage("model_load"):
+        return _resolve_booster()
+
+def _resolve_booster() -> "Model":
+    global _booster_cache, _booster_generation, _booster_checked_at, _booster_sha256
+    if _booster_cache is not None and time.monotonic() - _booster_checked_at < MODEL_GENERATION_CHECK_SEC:
+        _metric_count("booster_cache_hit")
         return _booster_cache
 
-    logging.info(f"[ModelLoader] Bucket: {DEFAULT_BUCKET}, Blob: {MODEL_BLOB_PATH}")
-    bucket = storage.bucket(DEFAULT_BUCKET)
-    blob = bucket.blob(MODEL_BLOB_PATH)
-    if not blob.exists():
-        raise FileNotFoundError(f"Model NOT FOUND at gs://{DEFAULT_BUCKET}/{MODEL_BLOB_PATH}")
+    with _booster_lock:
+        # Thread lain (mis. warm-up) mungkin sudah memuat selagi kita menunggu lock
+        if _booster_cache is not None and time.monotonic() - _booster_checked_at < MODEL_GENERATION_CHECK_SEC:
+            _metric_count("booster_cache_hit")
+            return _booster_cache
 
-    last_err: Optional[Exception] = None
-    for attempt in range(1, 4):
+        _metric_count("booster_generation_check")
         try:
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".txt") as tmp:
-                tmp_path = tmp.name
-            blob.download_to_filename(tmp_path)
+            blob = storage.bucket(DEFAULT_BUCKET).get_blob(MODEL_BLOB_PATH)
+        except Exception as e:
+            if _booster_cache is None:
+                raise
+            logging.warning(f"[ModelLoader] Metadata check failed, keep generation {_booster_generation}: {e}")
+            _booster_checked_at = time.monotonic()
+            return _booster_cache
 
-            booster = lgb.Booster(model_file=tmp_path)
+        if blob is None:
+            if _booster_cache is None:
+                raise FileNotFoundError(f"Model NOT FOUND at gs://{DEFAULT_BUCKET}/{MODEL_BLOB_PATH}")
+            logging.warning(f"[ModelLoader] Blob hilang, tetap pakai generation {_booster_generation}")
+        elif blob.generation != _booster_generation:
+            _metric_count("booster_cache_miss")
+            _booster_cache, _booster_sha256 = _load_booster_generation(blob)
+            _booster_generation = blob.generation
+        _booster_checked_at = time.monotonic()
+        return _booster_cache
+
+def _load_booster_generation(blob, blob_path: str = MODEL_BLOB_PATH) -> Tuple["Model", str]:
+    """Parse model dari salinan lokal /tmp jika ada; jika tidak, unduh langsung ke memori (model_str).
+    Kembalikan (booster, sha256 teks model)."""
+    logging.info(f"[ModelLoader] Bucket: {DEFAULT_BUCKET}, Blob: {blob_path}, Generation: {blob.generation}")
+    # Nama salinan per blob (primary tetap freshlens_lgbm.<generation>.txt)
+    stem = os.path.splitext(blob_path)[0].replace("/", "__")
+    local_path = os.path.join(MODEL_LOCAL_CACHE_DIR, f"{stem}.{blob.generation}.txt")
+
+    if os.path.exists(local_path):
+        try:
+            with open(local_path, "r", encoding="utf-8") as f:
+                model_str = f.read()
+            booster = _parse_model(model_str)
+            logging.info(f"[ModelLoader] LightGBM Booster loaded from local copy {local_path}")
+            return booster, _model_sha256(model_str)
+        except Exception as e:
+            logging.warning(f"[ModelLoader] Local copy unusable, re-download: {e}")
+            os.remove(local_path)
 
-            os.remove(tmp_path)
-            _booster_cache = booster
+    last_err: Optional[Exception] = None
+    for attempt in range(1, 4):
+        try:
+            model_str = blob.download_as_bytes(if_generation_match=blob.generation).decode("utf-8")
+            booster = _parse_model(model_str)
             logging.info("[ModelLoader] LightGBM Booster loaded successfully")
-            return _booster_cache
+            _save_local_model_copy(local_path, model_str)
+            return booster, _model_sha256(model_str)
         except Exception as e:
             last_err = e
             logging.warning(f"[ModelLoader] Failed (try {attempt}): {e}")
             time.sleep(1.0)
     raise RuntimeError(f"Failed to load model after retries: {last_err}")
 
+def _save_local_model_copy(local_path: str, model_str: str) -> None:
+    """Tulis salinan lokal secara atomik dan buang salinan generation lama."""
+    try:
+        with tempfile.NamedTemporaryFile("w", delete=False, dir=MODEL_LOCAL_CACHE_DIR,
+                                         suffix=".tmp", encoding="utf-8") as tmp:
+            tmp.write(model_str)
+        os.replace(tmp.name, local_path)
+        keep = os.path.basename(local_path)
+        prefix = keep.rsplit(".", 2)[0] + "."
+        for name in os.listdir(MODEL_LOCAL_CACHE_DIR):
+            if (name.startswith(prefix) and name.endswith(".txt") and name != keep
+                    and name[len(prefix):-len(".txt")].isdigit()):
+                os.remove(os.path.join(MODEL_LOCAL_CACHE_DIR, name))
+    except OSError as e:
+        logging.warning(f"[ModelLoader] Gagal simpan salinan lokal: {e}")
+
+def _model_sha256(model_str: str) -> str:
+    return hashlib.sha256(model_str.encode("utf-8")).hexdigest()
+
+def _parse_model(model_str: str) -> "Model":
+    """Bangun evaluator dari teks model sesuai MODEL_EVALUATOR."""
+    if MODEL_EVALUATOR == "numpy":
+        try:
+            return _CompiledEnsemble.from_model_str(model_str)
+        except _UnsupportedModelError as e:
+            logging.warning(f"[ModelLoader] Compiled evaluator not supported ({e}); pakai LightGBM")
+    return lgb.Booster(model_str=model_str)
+
+def _warm_up_booster() -> None:
+    try:
+        _load_booster_if_needed()
+    except Exception as e:
+        logging.warning(f"[ModelLoader] Warm-up failed: {e}")
+
+if MODEL_WARMUP:
+    threading.Thread(target=_warm_up_booster, name="model-warmup", daemon=True).start()
+
+# ===============================
+# Helper: Registry model shadow
+# ===============================
+# Kandidat model (MODEL_SHADOW_BLOB_PATHS, dipisah koma) diskor pada matriks trajektori
+# yang sama dengan primary di _score_items: tanpa read Firestore tambahan, dan hasilnya
+# hanya ke log "[Shadow]" (selisih hari & latensi per model), tidak pernah ke dokumen item.
+# Shadow dimuat & dicek generation-nya di thread latar; sampai siap, shadow dilewati.
+# Hanya MODEL_SHADOW_SAMPLE_RATE panggilan skor yang ikut shadow, dan total waktu predict
+# shadow per proses dibatasi MODEL_SHADOW_CPU_BUDGET x total waktu predict primary.
+MODEL_SHADOW_BLOB_PATHS = [p for p in os.getenv("MODEL_SHADOW_BLOB_PATHS", "").split(",") if p]
+MODEL_SHADOW_SAMPLE_RATE = float(os.getenv("MODEL_SHADOW_SAMPLE_RATE", "0.1"))
+MODEL_SHADOW_CPU_BUDGET = float(os.getenv("MODEL_SHADOW_CPU_BUDGET", "0.1"))
+_SHADOW_DELTA_CLIP = 5  # histogram selisih hari: -5..+5 (di luar itu digabung ke ujung)
+
+class _ShadowModel:
+    __slots__ = ("blob_path", "booster", "generation", "sha256", "ms_per_row")
+
+    def __init__(self, blob_path: str, booster: "Model", generation: int, sha256: str):
+        self.blob_path = blob_path
+        self.booster = booster
+        self.generation = generation
+        self.sha256 = sha256
+        self.ms_per_row = 0.0  # estimasi biaya untuk cek budget sebelum predict
+
+class _ShadowBudget:
+    """Akumulator waktu predict primary vs shadow (per proses, thread-safe)."""
+
+    def __init__(self):
+        self.primary_ms = 0.0
+        self.shadow_ms = 0.0
+        self._lock = threading.Lock()
+
+    def add_primary(self, ms: float) -> None:
+        with self._lock:
+            self.primary_ms += ms
+
+    def allows(self, estimate_ms: float) -> bool:
+        with self._lock:
+            return self.shadow_ms + estimate_ms <= MODEL_SHADOW_CPU_BUDGET * self.primary_ms
+
+    def add_shadow(self, ms: float) -> None:
+        with self._lock:
+            self.shadow_ms += ms
+
+_shadow_models: List[_ShadowModel] = []
+_shadow_checked_at: Optional[float] = None
+_shadow_refreshing = False
+_shadow_lock = threading.Lock()
+_shadow_budget = _ShadowBudget()
+
+def _shadow_boosters() -> List[_ShadowModel]:
+    """Shadow yang sudah dimuat; refresh (tiap MODEL_GENERATION_CHECK_SEC) jalan di thread latar."""
+    global _shadow_refreshing
+    if not MODEL_SHADOW_BLOB_PATHS:
+        return []
+    with _shadow_lock:
+        due = _shadow_checked_at is None or time.monotonic() - _shadow_checked_at >= MODEL_GENERATION_CHECK_SEC
+        if due and not _shadow_refreshing:
+            _shadow_refreshing = True
+            threading.Thread(target=_refresh_shadow_models, name="shadow-loader", daemon=True).start()
+        return _shadow_models
+
+def _refresh_shadow_models() -> None:
+    """Muat ulang shadow yang generation blob-nya berubah; shadow yang gagal dicek tetap dipakai."""
+    global _shadow_models, _shadow_checked_at, _shadow_refreshing
+    current = {m.blob_path: m for m in _shadow_models}
+    loaded: List[_ShadowModel] = []
+    try:
+        bucket = storage.bucket(DEFAULT_BUCKET)
+        for path in MODEL_SHADOW_BLOB_PATHS:
+            model = current.get(path)
+            try:
+                blob = bucket.get_blob(path)
+                if blob is None:
+                    logging.warning(f"[ShadowModel] Blob {path} tidak ditemukan")
+                elif model is None or blob.generation != model.generation:
+                    booster, sha = _load_booster_generation(blob, path)
+                    model = _ShadowModel(path, booster, blob.generation, sha)
+            except Exception as e:
+                logging.warning(f"[ShadowModel] Gagal memuat {path}: {e}")
+            if model is not None:
+                loaded.append(model)
+    except Exception as e:
+        logging.warning(f"[ShadowModel] Refresh gagal: {e}")
+        loaded = list(current.values())
+    finally:
+        with _shadow_lock:
+            _shadow_models = loaded
+            _shadow_checked_at = time.monotonic()
+            _shadow_refreshing = False
+
+def _trajectory_days(y: np.ndarray, n_items: int, width: int) -> np.ndarray:
+    """Prediksi baris trajektori -> hari sisa per item per hari (running minimum, 0..365)."""
+    # Pada kondisi tetap sisa umur tidak bertambah seiring umur item -> running minimum
+    return np.minimum.accumulate(np.rint(np.clip(y, 0, 365)).astype(int).reshape(n_items, width), axis=1)
+
+def _score_shadows(X_traj: np.ndarray, primary_days: np.ndarray, primary_ms: float) -> None:
+    """Skor shadow pada X_traj primary (tersampel, dalam budget) dan log ringkas selisihnya."""
+    _shadow_budget.add_primary(primary_ms)
+    shadows = _shadow_boosters()
+    if not shadows or random.random() >= MODEL_SHADOW_SAMPLE_RATE:
+        return
+    n_items, width = primary_days.shape
+    for shadow in shadows:
+        if not _shadow_budget.allows(shadow.ms_per_row * len(X_traj)):
+            _metric_count("shadow_skipped_budget")
+            continue
+        t0 = time.perf_counter()
+        try:
+            y = shadow.booster.predict(X_traj)
+        except Exception as e:
+            logging.warning(f"[ShadowModel] {shadow.blob_path} predict gagal: {e}")
+            continue
+        elapsed_ms = (time.perf_counter() - t0) * 1000.0
+        _shadow_budget.add_shadow(elapsed_ms)
+        shadow.ms_per_row = elapsed_ms / len(X_traj)
+        _metric_count("shadow_items", n_items)
+
+        diff = _trajectory_days(y, n_items, width) - primary_days
+        delta = diff[:, 0]  # selisih predictedShelfLife (hari ini)
+        hist = np.bincount(np.clip(delta, -_SHADOW_DELTA_CLIP, _SHADOW_DELTA_CLIP) + _SHADOW_DELTA_CLIP,
+                           minlength=2 * _SHADOW_DELTA_CLIP + 1)
+        logger.info(
+            f"[Shadow] {shadow.blob_path}",
+            metric="freshlens_shadow",
+            model=shadow.blob_path,
+            generation=shadow.generation,
+            modelSha256=shadow.sha256[:12],
+            primarySha256=(_booster_sha256 or "")[:12],
+            items=n_items,
+            changed=int(np.count_nonzero(delta)),
+            meanDeltaDays=round(float(delta.mean()), 3),
+            meanAbsDeltaDays=round(float(np.abs(delta).mean()), 3),
+            maxAbsDeltaDays=int(np.abs(delta).max()),
+            meanAbsTrajectoryDelta=round(float(np.abs(diff).mean()), 3),
+            deltaHistogram={str(d - _SHADOW_DELTA_CLIP): int(c) for d, c in enumerate(hist) if c},
+            primaryMs=round(primary_ms, 2),
+            shadowMs=round(elapsed_ms, 2),
+            sampleRate=MODEL_SHADOW_SAMPLE_RATE,
+        )
+
+# ===============================
+# Helper: Compiled Tree Ensemble (NumPy)
+# ===============================
+# LightGBM: missing_type ada di bit 2-3 decision_type, default_left di bit 1
+_MISSING_NONE, _MISSING_ZERO, _MISSING_NAN = 0, 1, 2
+_K_ZERO_THRESHOLD = 1.0000000180025095e-35  # float(np.float32(1e-35)), kZeroThreshold LightGBM
+_EXP_OBJECTIVES = ("poisson", "gamma", "tweedie")
+_IDENTITY_OBJECTIVES = ("regression", "regression_l1", "huber", "fair", "quantile", "mape")
+
+class _UnsupportedModelError(ValueError):
+    """Model valid tapi di luar dukungan _CompiledEnsemble; pemanggil kembali ke lgb.Booster."""
+
+class _CompiledEnsemble:
+    """
+    Ensemble pohon LightGBM (teks model) yang diratakan ke array:
+    feature, threshold, left, right, value per node (semua pohon disambung;
+    leaf menunjuk ke dirinya sendiri).
+
+    Evaluasi utama memakai bitvector per pohon (ala QuickScorer): tiap node
+    yang kondisinya salah (x > threshold) mematikan leaf subtree kirinya;
+    leaf keluar = bit hidup terendah. Per fitur, AND mask node disusun
+    kumulatif menurut threshold, jadi skor satu batch = searchsorted +
+    gather + AND, tanpa loop per node. Pohon > 64 leaf atau split dengan
+    missing_type Zero/NaN memakai traversal level-by-level.
+    Penjumlahan antar pohon berurutan (double), sama dengan LightGBM.
+    """
+
+    def __init__(self, feature, threshold, left, right, value, default_left, missing_type,
+                 roots, max_depth: int, num_feature: int, objective: str, average_output: bool):
+        self.feature = feature
+        self.threshold = threshold
+        self.left = left
+        self.right = right
+        self.value = value
+        self.default_left = default_left
+        self.missing_type = missing_type
+        self.roots = roots
+        self.max_depth = max_depth
+        self.num_feature = num_feature
+        self.objective = objective
+        self.average_output = average_output
+        self._needs_missing = bool(np.any(missing_type != _MISSING_NONE))
+        self._tables = None
+        if not self._needs_missing:
+            self._build_bitvector_tables()
+
+    def num_trees(self) -> int:
+        return len(self.roots)
+
+    @classmethod
+    def from_model_str(cls, model_str: str) -> "_CompiledEnsemble":
+        header: Dict[str, str] = {}
+        trees: List[Dict[str, str]] = []
+        current: Optional[Dict[str, str]] = None
+        average_output = False
+        for line in model_str.splitlines():
+            line = line.strip()
+            if line == "end of trees":
+                break
+            if line.startswith("Tree="):
+                current = {}
+                trees.append(current)
+            elif line == "average_output":
+                average_output = True
+            elif "=" in line:
+                key, _, val = line.partition("=")
+                (current if current is not None else header)[key] = val
+
+        if int(header.get("num_class", "1")) != 1:
+            raise _UnsupportedModelError("multiclass")
+        objective_tokens = header.get("objective", "regression").split()
+        objective = objective_tokens[0]
+        if "sqrt" in objective_tokens[1:]:
+            raise _UnsupportedModelError("reg_sqrt")
+        if objective not in _IDENTITY_OBJECTIVES and objective not in _EXP_OBJECTIVES:
+            raise _UnsupportedModelError(f"objective {objective}")
+        if not trees:
+            raise _UnsupportedModelError("model tanpa pohon")
+
+        feats, thrs, lefts, rights, vals, dlefts, mtypes, roots = [], [], [], [], [], [], [], []
+        max_depth = 0
+        base = 0
+        for t in trees:
+            if int(t.get("num_cat", "0")) > 0:
+                raise _UnsupportedModelError("categorical split")
+            if t.get("is_linear", "0") != "0":
+                raise _UnsupportedModelError("linear tree")
+            n_leaves = int(t["num_leaves"])
+            leaf_value = np.array(t["leaf_value"].split(), dtype=np.float64)
+            n_internal = n_leaves - 1
+            roots.append(base)
+            if n_internal == 0:
+                feats.append(np.zeros(1, np.int32))
+                thrs.append(np.zeros(1))
+                lefts.append(np.array([base], np.int32))
+                rights.append(np.array([base], np.int32))
+                vals.append(leaf_value[:1])
+                dlefts.append(np.zeros(1, bool))
+                mtypes.append(np.zeros(1, np.int8))
+                base += 1
+                continue
+
+            def _remap(children: np.ndarray) -> np.ndarray:
+                # child >= 0: node internal; child < 0: leaf ~child
+                return np.where(children >= 0, base + children, base + n_internal + ~children).astype(np.int32)
+
+            decision = np.array(t["decision_type"].split(), dtype=np.int32)
+            split_feature = np.array(t["split_feature"].split(), dtype=np.int32)
+            left = np.array(t["left_child"].split(), dtype=np.int64)
+            right = np.array(t["right_child"].split(), dtype=np.int64)
+            leaf_ids = np.arange(base + n_internal, base + n_internal + n_leaves, dtype=np.int32)
+
+            feats.append(np.concatenate([split_feature, np.zeros(n_leaves, np.int32)]))
+            thrs.append(np.concatenate([np.array(t["threshold"].split(), dtype=np.float64), np.zeros(n_leaves)]))
+            lefts.append(np.concatenate([_remap(left), leaf_ids]))
+            rights.append(np.concatenate([_remap(right), leaf_ids]))
+            vals.append(np.concatenate([np.zeros(n_internal), leaf_value]))
+            dlefts.append(np.concatenate([(decision & 2) != 0, np.zeros(n_leaves, bool)]))
+            mtypes.append(np.concatenate([((decision >> 2) & 3).astype(np.int8), np.zeros(n_leaves, np.int8)]))
+            max_depth = max(max_depth, cls._tree_depth(left, right))
+            base += n_internal + n_leaves
+
+        return cls(
+            feature=np.concatenate(feats), threshold=np.concatenate(thrs),
+            left=np.concatenate(lefts), right=np.concatenate(rights),
+            value=np.concatenate(vals), default_left=np.concatenate(dlefts),
+            missing_type=np.concatenate(mtypes), roots=np.array(roots, dtype=np.int32),
+            max_depth=max_depth, num_feature=int(header.get("max_feature_idx", "-1")) + 1,
+            objective=objective, average_output=average_output,
+        )
+
+    @staticmethod
+    def _tree_depth(left: np.ndarray, right: np.ndarray) -> int:
+        depth, frontier = 0, [0]
+        while frontier:
+            depth += 1
+            frontier = [int(c) for n in frontier for c in (left[n], right[n]) if c >= 0]
+        return depth
+
+    def _build_bitvector_tables(self) -> None:
+        """Siapkan tabel mask kumulatif per fitur; lewati bila ada pohon > 64 leaf."""
+        n_trees = len(self.roots)
+        ends = list(self.roots[1:]) + [len(self.feature)]
+        leaf_values = np.zeros((n_trees, 64), dtype=np.float64)
+        node_tree: List[int] = []
+        node_mask: List[int] = []
+        node_index: List[int] = []
+        left, right = self.left.tolist(), self.right.tolist()
+
+        for t, (root, end) in enumerate(zip(self.roots, ends)):
+            if end - root > 127:
+                return
+            # Urutan leaf kiri->kanan; mask node = leaf yang tersisa bila kondisi salah
+            order: List[int] = []
+            subtree: Dict[int, Tuple[int, int]] = {}
+            stack = [(int(root), False)]
+            while stack:
+                node, expanded = stack.pop()
+                if left[node] == node:
+                    order.append(node)
+                elif expanded:
+                    lo = subtree[left[node]][0]
+                    subtree[node] = (lo, len(order))
+                    continue
+                else:
+                    stack.append((node, True))
+                    stack.append((right[node], False))
+                    stack.append((left[node], False))
+                    continue
+                subtree[node] = (len(order) - 1, len(order))
+            leaf_values[t, :len(order)] = self.value[order]
+            for node in range(int(root), int(end)):
+                if left[node] == node:
+                    continue
+                lo, hi = subtree[left[node]]
+                left_bits = ((1 << (hi - lo)) - 1) << lo
+                node_tree.append(t)
+                node_mask.append(~left_bits & 0xFFFFFFFFFFFFFFFF)
+                node_index.append(node)
+
+        node_tree_arr = np.array(node_tree, dtype=np.intp)
+        node_mask_arr = np.array(node_mask, dtype=np.uint64)
+        node_index_arr = np.array(node_index, dtype=np.intp)
+        node_feature = self.feature[node_index_arr]
+        node_threshold = self.threshold[node_index_arr]
+
+        features, thresholds, blocks = [], [], []
+        for f in np.unique(node_feature):
+            sel = np.flatnonzero(node_feature == f)
+            sel = sel[np.argsort(node_threshold[sel], kind="stable")]
+            block = np.full((len(sel) + 1, n_trees), np.uint64(0xFFFFFFFFFFFFFFFF), dtype=np.uint64)
+            block[np.arange(1, len(sel) + 1), node_tree_arr[sel]] = node_mask_arr[sel]
+            np.bitwise_and.accumulate(block, axis=0, out=block)
+            features.append(int(f))
+            thresholds.append(node_threshold[sel])
+            blocks.append(block)
+
+        offsets = np.cumsum([0] + [len(b) for b in blocks[:-1]]).astype(np.intp)
+        self._tables = (features, thresholds, offsets, np.concatenate(blocks), leaf_values)
+
+    def predict(self, X: np.ndarray, chunk_size: int = 2048) -> np.ndarray:
+        """Skor batch (n, num_feature); hasil setara Booster.predict."""
+        X = np.asarray(X, dtype=np.float64)
+        if X.ndim != 2 or X.shape[1] != self.num_feature:
+            raise ValueError(f"Expected (n, {self.num_feature}) features, got {X.shape}")
+        if self._tables is not None and np.isnan(X).any():
+            X = np.where(np.isnan(X), 0.0, X)  # missing_type None: NaN diperlakukan 0
+        raw = self._predict_bitvector if self._tables is not None else self._predict_levels
+        out = np.empty(X.shape[0], dtype=np.float64)
+        for start in range(0, X.shape[0], chunk_size):
+            out[start:start + chunk_size] = raw(X[start:start + chunk_size])
+        if self.average_output:
+            out /= len(self.roots)
+        if self.objective in _EXP_OBJECTIVES:
+            out = np.exp(out)
+        return out
+
+    def _predict_bitvector(self, X: np.ndarray) -> np.ndarray:
+        features, thresholds, offsets, table, leaf_values = self._tables
+        bins = np.empty((X.shape[0], len(features)), dtype=np.intp)
+        for j, (f, thr) in enumerate(zip(features, thresholds)):
+            bins[:, j] = np.searchsorted(thr, X[:, f], side="left")
+        bins += offsets
+        mask = np.bitwise_and.reduce(table[bins], axis=1)
+        lowest = mask & (~mask + np.uint64(1))
+        leaf = np.log2(lowest.astype(np.float64)).astype(np.intp)
+        # cumsum = akumulasi berurutan per pohon (bukan pairwise)
+        return np.cumsum(leaf_values[np.arange(len(self.roots)), leaf], axis=1)[:, -1]
+
+    def _predict_levels(self, X: np.ndarray) -> np.ndarray:
+        n = X.shape[0]
+        rows = np.arange(n)[:, None]
+        node = np.broadcast_to(self.roots, (n, len(self.roots))).copy()
+        for _ in range(self.max_depth):
+            x = X[rows, self.feature[node]]
+            mtype = self.missing_type[node]
+            nan = np.isnan(x)
+            x = np.where(nan & (mtype != _MISSING_NAN), 0.0, x)
+            use_default = ((mtype == _MISSING_ZERO) & (np.abs(x) <= _K_ZERO_THRESHOLD)) | ((mtype == _MISSING_NAN) & nan)
+            go_left = np.where(use_default, self.default_left[node], x <= self.threshold[node])
+            node = np.where(go_left, self.left[node], self.right[node])
+        return np.cumsum(self.value[node], axis=1)[:, -1]
+
+# Evaluator yang dipakai jalur skor: LightGBM Booster atau ensemble terkompilasi
+Model = Union["lgb.Booster", "_CompiledEnsemble"]
+
 # ===============================
 # Helper: Sensor & Feature Builder
 # ===============================
+# Memo statistik sensor per proses: key (uid, hours) -> (expires_at, stats)
+SENSOR_STATS_TTL_SEC = float(os.getenv("SENSOR_STATS_TTL_SEC", "60"))
+_sensor_stats_cache: Dict[Tuple[str, int], Tuple[float, Dict[str, float]]] = {}
+_sensor_stats_lock = threading.Lock()
+
 def _get_sensor_statistics(uid: str, hours: int = 24) -> Dict[str, float]:
+    """Statistik sensor dengan memo TTL singkat, agar N item satu user = 1x scan history."""
+    cached = _sensor_stats_memo_get((uid, hours))
+    if cached is not None:
+        return cached
+    with _stage("sensor_stats"):
+        stats = _fetch_sensor_statistics(uid, hours)
+    _sensor_stats_memo_put((uid, hours), stats)
+    return dict(stats)
+
+def _sensor_stats_memo_get(key: Tuple[str, int]) -> Optional[Dict[str, float]]:
+    with _sensor_stats_lock:
+        cached = _sensor_stats_cache.get(key)
+        if cached is not None and cached[0] > time.monotonic():
+            _metric_count("sensor_stats_memo_hit")
+            return dict(cached[1])
+    _metric_count("sensor_stats_memo_miss")
+    return None
+
+def _sensor_stats_memo_put(key: Tuple[str, int], stats: Dict[str, float]) -> None:
+    now = time.monotonic()
+    with _sensor_stats_lock:
+        # Sweep entri kedaluwarsa agar scheduler lintas user tidak menumpuk memori
+        if len(_sensor_stats_cache) >= 10000:
+            for k in [k for k, v in _sensor_stats_cache.items() if v[0] <= now]:
+                del _sensor_stats_cache[k]
+        _sensor_stats_cache[key] = (now + SENSOR_STATS_TTL_SEC, stats)
+
+def _invalidate_sensor_statistics(uid: str) -> None:
+    """Buang memo statistik sensor milik uid (semua window)."""
+    with _sensor_stats_lock:
+        for key in [k for k in _sensor_stats_cache if k[0] == uid]:
+            _sensor_stats_cache.pop(key, None)
+
+def _sensor_history_root_ref(db, uid: str):
+    return db.collection("users").document(uid).collection("sensor_data").document("history")
+
+def _sensor_history_ref(db, uid: str):
+    """Koleksi lama: satu dokumen per bacaan (hanya dibaca oleh _migrate_sensor_history)."""
+    return _sensor_history_root_ref(db, uid).collection("entries")
+
+def _fetch_sensor_statistics(uid: str, hours: int = 24) -> Dict[str, float]:
     """Ambil ringkasan suhu/RH dari 24 jam terakhir; fallback ke 'latest' atau default."""
     db = firestore.client()
     now = datetime.now(timezone.utc)
     start_time = now - timedelta(hours=hours)
 
-    history_ref = (
-        db.collection("users")
-        .document(uid)
-        .collection("sensor_data")
-        .document("history")
-        .collection("entries")
-    )
-    query = history_ref.where("createdAt", ">=", start_time).stream()
-
-    temps, humids = [], []
-    for doc in query:
-        data = doc.to_dict() or {}
-        if data.get("temperature") is not None:
-            temps.append(data["temperature"])
-        if data.get("humidity") is not None:
-            humids.append(data["humidity"])
+    # Jalur cepat: 1 read dokumen agregat per jam (lihat _update_sensor_aggregate),
+    # hanya bucket jam di window yang diunduh
+    agg = _sensor_aggregate_ref(db, uid).get(field_paths=_aggregate_window_field_paths(start_time, now))
+    _metric_count("firestore_reads")
+    spread: Optional[Tuple[float, float]] = None
+    if agg.exists:
+        agg_data = agg.to_dict() or {}
+        temps, humids = _aggregate_window_means(agg_data, start_time)
+        spread = _aggregate_window_spread(agg_data, start_time)
+    else:
+        temps, humids = _scan_history_values(db, uid, start_time)
 
     # Fallback: pakai 'latest' jika history kosong
+    latest_data = None
     if not temps or not humids:
         latest_doc = (
             db.collection("users")
             .document(uid)
             .collection("sensor_data")
             .document("latest")
-            .get()
+            .get(field_paths=["temperature", "humidity"])
         )
+        _metric_count("firestore_reads")
         if latest_doc.exists:
             latest_data = latest_doc.to_dict() or {}
-            if not temps and latest_data.get("temperature") is not None:
-                temps.append(latest_data["temperature"])
-            if not humids and latest_data.get("humidity") is not None:
-                humids.append(latest_data["humidity"])
+    return _sensor_statistics_from(temps, humids, spread, latest_data)
+
+def _sensor_statistics_from(temps: List[float], humids: List[float], spread: Optional[Tuple[float, float]],
+                            latest_data: Optional[Dict]) -> Dict[str, float]:
+    """Ringkasan statistik dari nilai window (+ fallback 'latest' lalu default); tanpa I/O."""
+    if latest_data:
+        if not temps and latest_data.get("temperature") is not None:
+            temps.append(latest_data["temperature"])
+        if not humids and latest_data.get("humidity") is not None:
+            humids.append(latest_data["humidity"])
 
     # Fallback final: default wajar
     if not temps:
@@ -145,8 +811,366 @@ def _get_sensor_statistics(uid: str, hours: int = 24) -> Dict[str, float]:
     return {
         "avg_temp": float(np.mean(temps)),
         "avg_humid": float(np.mean(humids)),
+        # Volatilitas (jadwal recompute): std rata-rata per jam; jalur scan: std bacaan mentah
+        "std_temp": spread[0] if spread else float(np.std(temps)),
+        "std_humid": spread[1] if spread else float(np.std(humids)),
     }
 
+def _scan_history_values(db, uid: str, start_time: datetime) -> Tuple[List[float], List[float]]:
+    """Bacaan mentah sejak start_time dari bucket history per jam (<= 1 read per jam window)."""
+    return _reading_values(_iter_history_readings(db, uid, start_time))
+
+def _reading_values(readings) -> Tuple[List[float], List[float]]:
+    temps, humids = [], []
+    for _, t, h in readings:
+        if t is not None:
+            temps.append(t)
+        if h is not None:
+            humids.append(h)
+    return temps, humids
+
+# ===============================
+# Helper: History sensor per jam (packed)
+# ===============================
+# users/{uid}/sensor_data/history/hours/{YYYYMMDDHH} menyimpan array paralel
+#   ts (epoch detik), temperature, humidity
+# sehingga window 24 jam cukup <= 25 read dokumen. Bucket yang lebih tua dari
+# SENSOR_HISTORY_RAW_RETENTION_HOURS digulung oleh compact_sensor_history menjadi
+# ringkasan harian users/{uid}/sensor_data/history/days/{YYYYMMDD}.
+SENSOR_HISTORY_RAW_RETENTION_HOURS = int(os.getenv("SENSOR_HISTORY_RAW_RETENTION_HOURS", "72"))
+SENSOR_HISTORY_DAILY_RETENTION_DAYS = int(os.getenv("SENSOR_HISTORY_DAILY_RETENTION_DAYS", "365"))
+_BATCH_MAX_OPS = 450
+
+def _sensor_hour_buckets_ref(db, uid: str):
+    return _sensor_history_root_ref(db, uid).collection("hours")
+
+def _sensor_day_summaries_ref(db, uid: str):
+    return _sensor_history_root_ref(db, uid).collection("days")
+
+def _hour_start(ts: datetime) -> datetime:
+    return ts.astimezone(timezone.utc).replace(minute=0, second=0, microsecond=0)
+
+def _append_sensor_reading(db, uid: str, temperature: float, humidity: float, ts: datetime) -> None:
+    """Tambah satu bacaan ke bucket jamnya (transaksi read-modify-write, urutan array tetap sejajar)."""
+    ref = _sensor_hour_buckets_ref(db, uid).document(_hour_bucket_key(ts))
+
+    @firestore.transactional
+    def append(transaction):
+        snap = ref.get(transaction=transaction)
+        data = (snap.to_dict() or {}) if snap.exists else {}
+        transaction.set(ref, {
+            "hourStart": _hour_start(ts),
+            "ts": list(data.get("ts") or []) + [round(ts.timestamp(), 3)],
+            "temperature": list(data.get("temperature") or []) + [temperature],
+            "humidity": list(data.get("humidity") or []) + [humidity],
+            "source": "iot-latest",
+            "updatedAt": firestore.SERVER_TIMESTAMP,
+        })
+
+    append(db.transaction())
+    _metric_count("firestore_reads")
+    _metric_count("firestore_writes")
+
+def _iter_history_readings(db, uid: str, start_time: datetime):
+    """Yield (epoch_detik, suhu, RH) dari bucket jam sejak start_time, urut per bucket."""
+    start_epoch = start_time.timestamp()
+    for doc in _history_buckets_query(db, uid, start_time).stream():
+        _metric_count("firestore_reads")
+        yield from _bucket_readings(doc.to_dict() or {}, start_epoch)
+
+def _history_buckets_query(db, uid: str, start_time: datetime):
+    return (
+        _sensor_hour_buckets_ref(db, uid)
+        .where("hourStart", ">=", _hour_start(start_time))
+        .select(["ts", "temperature", "humidity"])
+    )
+
+def _bucket_readings(data: Dict, start_epoch: float):
+    for ts, t, h in zip(data.get("ts") or [], data.get("temperature") or [], data.get("humidity") or []):
+        if ts >= start_epoch:
+            yield ts, t, h
+
+def _summarize_values(values: List[float], prefix: str) -> Dict[str, float]:
+    if not values:
+        return {f"{prefix}Count": 0}
+    return {
+        f"{prefix}Sum": float(sum(values)),
+        f"{prefix}Count": len(values),
+        f"{prefix}Min": float(min(values)),
+        f"{prefix}Max": float(max(values)),
+    }
+
+def _compact_sensor_history(db, uid: str, now: datetime) -> Dict[str, int]:
+    """
+    Gulung bucket jam di luar retensi ke ringkasan harian (satu batch atomik per hari:
+    increment ringkasan + hapus bucket), lalu hapus ringkasan harian yang kedaluwarsa.
+    """
+    cutoff = _hour_start(now - timedelta(hours=SENSOR_HISTORY_RAW_RETENTION_HOURS))
+    by_day: Dict[str, List[firestore.DocumentSnapshot]] = {}
+    for doc in _sensor_hour_buckets_ref(db, uid).where("hourStart", "<", cutoff).stream():
+        by_day.setdefault(doc.id[:8], []).append(doc)
+
+    compacted_hours = 0
+    for day_key, docs in by_day.items():
+        batch = db.batch()
+        temps_day: List[float] = []
+        humids_day: List[float] = []
+        hours: Dict[str, Dict[str, float]] = {}
+        for doc in docs:
+            data = doc.to_dict() or {}
+            temps = [float(t) for t in data.get("temperature") or [] if t is not None]
+            humids = [float(h) for h in data.get("humidity") or [] if h is not None]
+            hour_summary: Dict[str, float] = {"count": len(data.get("ts") or [])}
+            if temps:
+                hour_summary.update(tMean=sum(temps) / len(temps), tMin=min(temps), tMax=max(temps))
+            if humids:
+                hour_summary.update(hMean=sum(humids) / len(humids), hMin=min(humids), hMax=max(humids))
+            hours[doc.id[8:]] = hour_summary
+            temps_day += temps
+            humids_day += humids
+            batch.delete(doc.reference)
+
+        fields: Dict[str, object] = {
+            "dayStart": datetime.strptime(day_key, "%Y%m%d").replace(tzinfo=timezone.utc),
+            "hours": hours,
+            "updatedAt": firestore.SERVER_TIMESTAMP,
+        }
+        # Increment/Minimum/Maximum: bucket terlambat untuk hari yang sama tetap bisa ditambahkan
+        for key, value in {**_summarize_values(temps_day, "t"), **_summarize_values(humids_day, "h")}.items():
+            if key.endswith("Min"):
+                fields[key] = firestore.Minimum(value)
+            elif key.endswith("Max"):
+                fields[key] = firestore.Maximum(value)
+            else:
+                fields[key] = firestore.Increment(value)
+        batch.set(_sensor_day_summaries_ref(db, uid).document(day_key), fields, merge=True)
+        batch.commit()
+        compacted_hours += len(docs)
+
+    expired = 0
+    day_cutoff = now - timedelta(days=SENSOR_HISTORY_DAILY_RETENTION_DAYS)
+    batch = db.batch()
+    for doc in _sensor_day_summaries_ref(db, uid).where("dayStart", "<", day_cutoff).stream():
+        batch.delete(doc.reference)
+        expired += 1
+        if expired % _BATCH_MAX_OPS == 0:
+            batch.commit()
+            batch = db.batch()
+    if expired % _BATCH_MAX_OPS:
+        batch.commit()
+
+    return {"hours": compacted_hours, "days": len(by_day), "expiredDays": expired}
+
+def _migrate_sensor_history(uid: str, delete_entries: bool = False) -> int:
+    """
+    Konversi koleksi lama history/entries ke bucket jam. Idempoten: bacaan digabung
+    dengan isi bucket yang sudah ada (dedupe per timestamp) di dalam transaksi.
+    Kembalikan jumlah entri lama yang diproses.
+    """
+    db = firestore.client()
+    grouped: Dict[str, Dict[float, Tuple[Optional[float], Optional[float]]]] = {}
+    legacy_refs = []
+    for doc in _sensor_history_ref(db, uid).stream():
+        legacy_refs.append(doc.reference)
+        data = doc.to_dict() or {}
+        created = data.get("createdAt")
+        if not isinstance(created, datetime):
+            continue
+        t = data.get("temperature")
+        h = data.get("humidity")
+        grouped.setdefault(_hour_bucket_key(created), {})[round(created.timestamp(), 3)] = (
+            float(t) if t is not None else None,
+            float(h) if h is not None else None,
+        )
+
+    for key, readings in grouped.items():
+        ref = _sensor_hour_buckets_ref(db, uid).document(key)
+
+        @firestore.transactional
+        def merge(transaction):
+            snap = ref.get(transaction=transaction)
+            data = (snap.to_dict() or {}) if snap.exists else {}
+            merged = dict(zip(data.get("ts") or [], zip(data.get("temperature") or [], data.get("humidity") or [])))
+            merged.update(readings)
+            order = sorted(merged)
+            transaction.set(ref, {
+                "hourStart": datetime.strptime(key, "%Y%m%d%H").replace(tzinfo=timezone.utc),
+                "ts": order,
+                "temperature": [merged[ts][0] for ts in order],
+                "humidity": [merged[ts][1] for ts in order],
+                "source": data.get("source", "migrated"),
+                "updatedAt": firestore.SERVER_TIMESTAMP,
+            })
+
+        merge(db.transaction())
+
+    if delete_entries:
+        for start in range(0, len(legacy_refs), _BATCH_MAX_OPS):
+            batch = db.batch()
+            for ref in legacy_refs[start:start + _BATCH_MAX_OPS]:
+                batch.delete(ref)
+            batch.commit()
+
+    _invalidate_sensor_statistics(uid)
+    return len(legacy_refs)
+
+# ===============================
+# Helper: Agregat sensor per jam (rolling)
+# ===============================
+# Dokumen users/{uid}/sensor_data/aggregate menyimpan map
+#   buckets.{YYYYMMDDHH} = {tSum, tCount, tMin, tMax, hSum, hCount, hMin, hMax}
+# yang di-update atomik (Increment/Minimum/Maximum) oleh log_sensor_data_to_history.
+# Tiap write membaca kunci bucket yang ada dan menghapus semua yang lebih tua dari retensi
+# (umur absolut), jadi jeda write berapa pun lamanya tidak meninggalkan bucket basi.
+SENSOR_AGGREGATE_RETENTION_HOURS = 48
+
+def _sensor_aggregate_ref(db, uid: str):
+    return db.collection("users").document(uid).collection("sensor_data").document("aggregate")
+
+def _hour_bucket_key(ts: datetime) -> str:
+    return ts.astimezone(timezone.utc).strftime("%Y%m%d%H")
+
+def _aggregate_window_field_paths(start_time: datetime, end_time: datetime) -> List[str]:
+    """Field path buckets.`YYYYMMDDHH` untuk tiap jam dari jam(start_time) s/d jam(end_time)."""
+    hour, last = _hour_start(start_time), _hour_start(end_time)
+    paths = []
+    while hour <= last:
+        paths.append(FieldPath("buckets", _hour_bucket_key(hour)).to_api_repr())
+        hour += timedelta(hours=1)
+    return paths
+
+def _aggregate_window_means(agg_data: Dict, start_time: datetime) -> Tuple[List[float], List[float]]:
+    """
+    Rata-rata suhu/RH dari bucket jam >= jam(start_time).
+    Dikembalikan sebagai list 0/1 elemen agar fallback 'latest' tetap sama.
+    Catatan: window diratakan ke awal jam (bisa lebih lebar s/d 59 menit).
+    """
+    first_key = _hour_bucket_key(start_time)
+    t_sum = t_cnt = h_sum = h_cnt = 0.0
+    for key, b in (agg_data.get("buckets") or {}).items():
+        if key < first_key or not isinstance(b, dict):
+            continue
+        t_sum += float(b.get("tSum", 0.0))
+        t_cnt += float(b.get("tCount", 0))
+        h_sum += float(b.get("hSum", 0.0))
+        h_cnt += float(b.get("hCount", 0))
+    temps = [t_sum / t_cnt] if t_cnt else []
+    humids = [h_sum / h_cnt] if h_cnt else []
+    return temps, humids
+
+def _aggregate_window_spread(agg_data: Dict, start_time: datetime) -> Tuple[float, float]:
+    """Std (populasi) rata-rata suhu/RH per jam di window; 0 bila < 2 jam berisi."""
+    first_key = _hour_bucket_key(start_time)
+    t_means, h_means = [], []
+    for key, b in (agg_data.get("buckets") or {}).items():
+        if key < first_key or not isinstance(b, dict):
+            continue
+        if b.get("tCount"):
+            t_means.append(float(b.get("tSum", 0.0)) / float(b["tCount"]))
+        if b.get("hCount"):
+            h_means.append(float(b.get("hSum", 0.0)) / float(b["hCount"]))
+    return (
+        float(np.std(t_means)) if len(t_means) > 1 else 0.0,
+        float(np.std(h_means)) if len(h_means) > 1 else 0.0,
+    )
+
+def _update_sensor_aggregate(db, uid: str, temperature: float, humidity: float, ts: datetime) -> None:
+    """Tambah satu bacaan ke bucket jamnya secara atomik dan buang semua bucket di luar retensi."""
+    ref = _sensor_aggregate_ref(db, uid)
+    snap = ref.get(field_paths=["buckets"])
+    _metric_count("firestore_reads")
+    buckets = _aggregate_expired_buckets((snap.to_dict() or {}) if snap.exists else {}, ts)
+    buckets[_hour_bucket_key(ts)] = _aggregate_bucket_fields([temperature], [humidity])
+    ref.set({"buckets": buckets, "updatedAt": firestore.SERVER_TIMESTAMP}, merge=True)
+    _metric_count("firestore_writes")
+
+def _aggregate_bucket_fields(temps: List[float], humids: List[float]) -> Dict[str, object]:
+    """Transform atomik yang menambahkan bacaan (>= 1, satu jam) ke bucket agregat."""
+    return {
+        "tSum": firestore.Increment(sum(temps)),
+        "tCount": firestore.Increment(len(temps)),
+        "tMin": firestore.Minimum(min(temps)),
+        "tMax": firestore.Maximum(max(temps)),
+        "hSum": firestore.Increment(sum(humids)),
+        "hCount": firestore.Increment(len(humids)),
+        "hMin": firestore.Minimum(min(humids)),
+        "hMax": firestore.Maximum(max(humids)),
+    }
+
+def _aggregate_first_key(now: datetime) -> str:
+    """Kunci bucket tertua yang masih dalam retensi agregat."""
+    return _hour_bucket_key(now - timedelta(hours=SENSOR_AGGREGATE_RETENTION_HOURS))
+
+def _aggregate_expired_buckets(agg_data: Dict, now: datetime) -> Dict[str, object]:
+    """DELETE_FIELD untuk tiap bucket di agg_data yang lebih tua dari retensi, dalam write yang sama."""
+    first_key = _aggregate_first_key(now)
+    return {key: firestore.DELETE_FIELD for key in (agg_data.get("buckets") or {}) if key < first_key}
+
+def _rebuild_sensor_aggregate(uid: str) -> int:
+    """
+    Backfill/rebuild dokumen agregat dari bucket history per jam (retensi penuh).
+    Menimpa dokumen agregat; kembalikan jumlah bacaan yang diproses.
+    """
+    db = firestore.client()
+    start_time = datetime.now(timezone.utc) - timedelta(hours=SENSOR_AGGREGATE_RETENTION_HOURS)
+
+    buckets: Dict[str, Dict[str, float]] = {}
+    count = _add_to_aggregate_buckets(buckets, _iter_history_readings(db, uid, start_time))
+    # Dokumen ditimpa (bucket basi lama hilang); batas retensi sama dengan jalur write
+    first_key = _aggregate_first_key(datetime.now(timezone.utc))
+    buckets = {key: b for key, b in buckets.items() if key >= first_key}
+    _sensor_aggregate_ref(db, uid).set({"buckets": buckets, "updatedAt": firestore.SERVER_TIMESTAMP})
+    _invalidate_sensor_statistics(uid)
+    return count
+
+def _add_to_aggregate_buckets(buckets: Dict[str, Dict[str, float]], readings) -> int:
+    """Akumulasi bacaan (epoch_detik, suhu, RH) ke map bucket jam format agregat; kembalikan jumlahnya."""
+    count = 0
+    for ts, temperature, humidity in readings:
+        created = datetime.fromtimestamp(ts, timezone.utc)
+        b = buckets.setdefault(_hour_bucket_key(created), {"tSum": 0.0, "tCount": 0, "hSum": 0.0, "hCount": 0})
+        if temperature is not None:
+            t = float(temperature)
+            b["tSum"] += t
+            b["tCount"] += 1
+            b["tMin"] = min(b.get("tMin", t), t)
+            b["tMax"] = max(b.get("tMax", t), t)
+        if humidity is not None:
+            h = float(humidity)
+            b["hSum"] += h
+            b["hCount"] += 1
+            b["hMin"] = min(b.get("hMin", h), h)
+            b["hMax"] = max(b.get("hMax", h), h)
+        count += 1
+    return count
+
+def _check_sensor_aggregate(uid: str, hours: int = 24, tolerance: float = 1e-6) -> Dict[str, object]:
+    """
+    Bandingkan rata-rata dari agregat dengan np.mean atas history mentah
+    pada window yang sama (diratakan ke awal jam).
+    """
+    db = firestore.client()
+    start_time = datetime.now(timezone.utc) - timedelta(hours=hours)
+    bucket_start = start_time.replace(minute=0, second=0, microsecond=0)
+
+    agg = _sensor_aggregate_ref(db, uid).get()
+    agg_temps, agg_humids = _aggregate_window_means(agg.to_dict() or {}, start_time)
+    raw_temps, raw_humids = _scan_history_values(db, uid, bucket_start)
+
+    report: Dict[str, object] = {"uid": uid, "aggregateExists": agg.exists, "rawEntries": len(raw_temps)}
+    ok = True
+    for name, agg_vals, raw_vals in (("temp", agg_temps, raw_temps), ("humid", agg_humids, raw_humids)):
+        agg_mean = agg_vals[0] if agg_vals else None
+        raw_mean = float(np.mean(raw_vals)) if raw_vals else None
+        report[f"aggregate_avg_{name}"] = agg_mean
+        report[f"raw_avg_{name}"] = raw_mean
+        if agg_mean is None or raw_mean is None:
+            ok = ok and agg_mean is None and raw_mean is None
+        else:
+            ok = ok and abs(agg_mean - raw_mean) <= tolerance * max(1.0, abs(raw_mean))
+    report["consistent"] = ok
+    return report
+
 # Alias untuk one-hot
 _ITEM_ALIASES = {
     "alpukat": "Nama_Item_Alpukat",
@@ -169,21 +1193,21 @@ _COND_ALIASES = {
 def _one_hot(keys: List[str], selected_key: Optional[str]) -> Dict[str, int]:
     return {k: (1 if k == selected_key else 0) for k in keys}
 
-def _build_features_for_item(uid: str, item_doc_data: Dict) -> pd.DataFrame:
+def _feature_row(item_doc_data: Dict, sensor_stats: Dict[str, float], now: datetime) -> Dict[str, float]:
     """
-    Bangun 17 kolom fitur final:
+    Bangun 17 kolom fitur final untuk satu item (tanpa I/O):
       Numerik: Hari_Ke, Suhu (°C), Kelembapan (%), temp_x_humid
       One-hot: 8 Nama_Item, 4 Kondisi_Awal, 1 Kondisi_Penyimpanan_Kulkas
+    Implementasi referensi; jalur skor memakai _FeatureEncoder (lihat bench.py features).
     """
     # Durasi hari sejak entryDate
     entry_ts = item_doc_data.get("entryDate")
     durasi_hari = 0.0
     if entry_ts:
         dt_entry = entry_ts if isinstance(entry_ts, datetime) else entry_ts.to_datetime()
-        durasi_hari = (datetime.now(timezone.utc) - dt_entry.replace(tzinfo=timezone.utc)).total_seconds() / 86400.0
+        durasi_hari = (now - dt_entry.replace(tzinfo=timezone.utc)).total_seconds() / 86400.0
 
     # Sensor (pakai AVG saja)
-    sensor_stats = _get_sensor_statistics(uid)
     suhu = float(sensor_stats.get("avg_temp", 25.0))
     rh = float(sensor_stats.get("avg_humid", 80.0))
 
@@ -221,26 +1245,1162 @@ def _build_features_for_item(uid: str, item_doc_data: Dict) -> pd.DataFrame:
     # Penyimpanan: 1 biner saja -> Kulkas
     storage_mode = (item_doc_data.get("storageMode") or "suhu ruang").strip().lower()
     base_features["Kondisi_Penyimpanan_Kulkas"] = 1 if storage_mode == "kulkas" else 0
+    return base_features
 
-    # Reindex agar urutan & kolom persis
-    return pd.DataFrame([base_features]).reindex(columns=TRAINING_COLUMNS, fill_value=0)
+# ===============================
+# Helper: Feature Encoder (batch, layout tetap)
+# ===============================
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_ONE_MICROSECOND = timedelta(microseconds=1)
 
-def _predict_days(booster: lgb.Booster, df: pd.DataFrame) -> int:
-    """Infer sisa umur (hari) dan clamp 0..365, lalu bulatkan ke int."""
-    X = df[TRAINING_COLUMNS].to_numpy(dtype=np.float32)
-    y = booster.predict(X)
-    return int(round(float(np.clip(y[0], 0, 365))))
+class _FeatureEncoder:
+    """
+    Encoder batch item -> matriks float32 (n, 17) dengan posisi kolom
+    TRAINING_COLUMNS / _ITEM_ALIASES / _COND_ALIASES yang dihitung sekali.
+    Identik dengan _feature_row (referensi), termasuk pembulatan Hari_Ke.
+    """
+
+    def __init__(self, columns: List[str]):
+        idx = {c: i for i, c in enumerate(columns)}
+        self.width = len(columns)
+        self.i_day = idx["Hari_Ke"]
+        self.i_temp = idx["Suhu (°C)"]
+        self.i_humid = idx["Kelembapan (%)"]
+        self.i_txh = idx["temp_x_humid"]
+        self.i_kulkas = idx["Kondisi_Penyimpanan_Kulkas"]
+        self.item_pos = {alias: idx[col] for alias, col in _ITEM_ALIASES.items()}
+        self.cond_pos = {alias: idx[col] for alias, col in _COND_ALIASES.items()}
+
+    def encode(self, items: List[Dict], temps, humids, now: datetime,
+               out: Optional[np.ndarray] = None) -> Tuple[np.ndarray, List[Optional[Exception]]]:
+        """
+        Tulis n item langsung ke matriks (n, 17). temps/humids: rata-rata sensor per baris.
+        Baris yang gagal di-encode dibiarkan nol dan error-nya dikembalikan per baris.
+        """
+        n = len(items)
+        X = out[:n] if out is not None else np.empty((n, self.width), dtype=np.float32)
+        X.fill(0)
+        errors: List[Optional[Exception]] = [None] * n
+        entry_us = np.zeros(n, dtype=np.int64)
+        has_entry = np.zeros(n, dtype=bool)
+        hot_rows: List[int] = []
+        hot_cols: List[int] = []
+
+        for r, data in enumerate(items):
+            try:
+                entry_ts = data.get("entryDate")
+                if entry_ts:
+                    dt_entry = entry_ts if isinstance(entry_ts, datetime) else entry_ts.to_datetime()
+                    entry_us[r] = (dt_entry.replace(tzinfo=timezone.utc) - _EPOCH) // _ONE_MICROSECOND
+                    has_entry[r] = True
+                raw_item = (data.get("itemName") or "").strip().lower()
+                raw_cond = (data.get("initialCondition") or "").strip().lower()
+                storage_mode = (data.get("storageMode") or "suhu ruang").strip().lower()
+            except Exception as e:
+                errors[r] = e
+                has_entry[r] = False
+                continue
+            pos = self.item_pos.get(raw_item)
+            if pos is not None:
+                hot_rows.append(r)
+                hot_cols.append(pos)
+            pos = self.cond_pos.get(raw_cond)
+            if pos is not None:
+                hot_rows.append(r)
+                hot_cols.append(pos)
+            if storage_mode == "kulkas":
+                hot_rows.append(r)
+                hot_cols.append(self.i_kulkas)
+
+        if hot_rows:
+            X[hot_rows, hot_cols] = 1
+
+        # Hari_Ke: (now - entry) dalam hari, dibulatkan half-even seperti round()
+        now_us = (now - _EPOCH) // _ONE_MICROSECOND
+        days = (now_us - entry_us) / 1e6 / 86400.0
+        X[:, self.i_day] = np.where(has_entry, np.rint(days), 0.0)
+
+        suhu = np.asarray(temps, dtype=np.float64)
+        rh = np.asarray(humids, dtype=np.float64)
+        X[:, self.i_temp] = suhu
+        X[:, self.i_humid] = rh
+        X[:, self.i_txh] = suhu * rh
+
+        for r, err in enumerate(errors):
+            if err is not None:
+                X[r] = 0
+        return X, errors
+
+_FEATURE_ENCODER = _FeatureEncoder(TRAINING_COLUMNS)
+
+# ===============================
+# Helper: Trajektori umur simpan & jadwal recompute
+# ===============================
+# Satu predict batch menilai Hari_Ke = sekarang..sekarang+TRAJECTORY_HORIZON_DAYS di bawah
+# rata-rata sensor saat ini. Item menyimpan trajektori ringkas + predictedExpiryAt, sehingga
+# klien & check_expiring_items menurunkan sisa hari dari waktu tanpa write harian.
+# Recompute hanya saat sensor berubah (trigger), model berubah (sweep harian), atau
+# nextRecomputeAt jatuh tempo (due-queue update_all_shelflives).
+TRAJECTORY_HORIZON_DAYS = int(os.getenv("TRAJECTORY_HORIZON_DAYS", "30"))
+RECOMPUTE_MIN_HOURS = float(os.getenv("RECOMPUTE_MIN_HOURS", "3"))
+RECOMPUTE_MAX_HOURS = float(os.getenv("RECOMPUTE_MAX_HOURS", "72"))
+# Interval recompute <= fraksi sisa umur: item yang hampir kedaluwarsa dicek lebih sering
+RECOMPUTE_REMAINING_FRACTION = float(os.getenv("RECOMPUTE_REMAINING_FRACTION", "0.25"))
+
+def _entry_datetime(item_data: Dict) -> Optional[datetime]:
+    """entryDate sebagai datetime UTC (sama dengan _FeatureEncoder); None jika kosong."""
+    entry_ts = item_data.get("entryDate")
+    if not entry_ts:
+        return None
+    dt_entry = entry_ts if isinstance(entry_ts, datetime) else entry_ts.to_datetime()
+    return dt_entry.replace(tzinfo=timezone.utc)
+
+def _error_retry_at(now: datetime, errors: int) -> datetime:
+    """Jadwal coba ulang item yang gagal diskor: RECOMPUTE_MIN_HOURS x 2^gagal, maks RECOMPUTE_MAX_HOURS."""
+    return now + timedelta(hours=min(RECOMPUTE_MIN_HOURS * 2 ** min(errors, 16), RECOMPUTE_MAX_HOURS))
+
+def _next_recompute_at(now: datetime, remaining_days: int, stats: Dict[str, float],
+                       end_at: Optional[datetime]) -> datetime:
+    """Jadwal recompute berikutnya: lebih rapat bila sensor volatil atau sisa umur pendek."""
+    hours = RECOMPUTE_MAX_HOURS
+    if remaining_days > 0:
+        volatility = max(
+            stats.get("std_temp", 0.0) / max(REPREDICT_TEMP_THRESHOLD, 1e-9),
+            stats.get("std_humid", 0.0) / max(REPREDICT_HUMID_THRESHOLD, 1e-9),
+        )
+        hours = min(hours, remaining_days * 24.0 * RECOMPUTE_REMAINING_FRACTION,
+                    RECOMPUTE_MAX_HOURS / (1.0 + volatility))
+    next_at = now + timedelta(hours=max(RECOMPUTE_MIN_HOURS, hours))
+    if end_at is not None:
+        # Sebelum trajektori tersimpan habis
+        next_at = min(next_at, max(end_at, now + timedelta(hours=RECOMPUTE_MIN_HOURS)))
+    return next_at
+
+def _trajectory_fields(days: np.ndarray, day0: int, entry_at: Optional[datetime], now: datetime,
+                       stats: Dict[str, float]) -> Tuple[Dict, bytes]:
+    """
+    Field Firestore dari trajektori sisa umur (monoton turun) mulai Hari_Ke=day0, plus kunci
+    ringkas untuk fingerprint. Setelah akhir trajektori sisa umur diekstrapolasi turun 1 hari/hari.
+
+    Kunci hanya memuat nilai absolut (hari kedaluwarsa & jendela notifikasi dalam Hari_Ke, dan
+    apakah trajektori mencapai 0): tidak bergeser saat item bertambah umur, termasuk trajektori
+    yang belum mencapai 0 dalam horizon.
+    """
+    if entry_at is None:
+        # Tanpa entryDate Hari_Ke selalu 0: sisa umur tidak bergeser dengan waktu
+        days = days[:1]
+        start_at = expiry_at = end_at = None
+        window_at = now if days[0] <= EXPIRY_NOTIFY_DAYS else None
+        window_key = -1
+        expiry_key = day0 + int(days[0])
+    else:
+        zero = np.flatnonzero(days == 0)
+        if zero.size:
+            days = days[:zero[0] + 1]
+        last = len(days) - 1
+        # Hari_Ke = rint(umur hari) -> indeks k berlaku mulai entry + (day0 + k - 0.5) hari
+        start_at = entry_at + timedelta(days=day0 - 0.5)
+        expiry_at = start_at + timedelta(days=last + int(days[-1]))
+        in_window = np.flatnonzero(days <= EXPIRY_NOTIFY_DAYS)
+        k_window = int(in_window[0]) if in_window.size else last + int(days[-1]) - EXPIRY_NOTIFY_DAYS
+        window_at = start_at + timedelta(days=k_window)
+        end_at = start_at + timedelta(days=len(days)) if days[-1] > 0 else None
+        window_key = day0 + k_window
+        expiry_key = day0 + last + int(days[-1])
+
+    fields = {
+        "predictedShelfLife": int(days[0]),
+        "shelfLifeTrajectory": {"startAt": start_at, "days": [int(d) for d in days]},
+        "predictedExpiryAt": expiry_at,
+        "expiryWindowAt": window_at,
+        "nextRecomputeAt": _next_recompute_at(now, int(days[0]), stats, end_at),
+    }
+    key = np.array([expiry_key, window_key, days[-1] == 0], dtype=np.int64).tobytes()
+    return fields, key
+
+def _days_remaining(item_data: Dict, now: datetime) -> Optional[int]:
+    """Sisa hari saat `now` dari trajektori tersimpan; item lama: predictedShelfLife apa adanya."""
+    trajectory = item_data.get("shelfLifeTrajectory") or {}
+    days = trajectory.get("days")
+    if not days:
+        return item_data.get("predictedShelfLife")
+    start_at = trajectory.get("startAt")
+    if start_at is None:
+        return int(days[0])
+    k = max(0, int((now - start_at) // timedelta(days=1)))
+    if k < len(days):
+        return int(days[k])
+    return max(0, int(days[-1]) - (k - len(days) + 1))
+
+# ===============================
+# Helper: Batched Scoring Engine
+# ===============================
+# Jumlah item maksimum per satu booster.predict (lintas user)
+SCORING_CHUNK_SIZE = int(os.getenv("SCORING_CHUNK_SIZE", "1000"))
+
+# Fingerprint fitur+prediksi: suhu/RH dikuantisasi agar jitter sensor tidak memicu write
+FINGERPRINT_TEMP_STEP = float(os.getenv("FINGERPRINT_TEMP_STEP", "0.5"))
+FINGERPRINT_HUMID_STEP = float(os.getenv("FINGERPRINT_HUMID_STEP", "2.0"))
+# 0 = nonaktif; >0 = tetap tulis ulang jika prediksi terakhir lebih tua dari N jam
+PREDICTION_MAX_STALENESS_HOURS = float(os.getenv("PREDICTION_MAX_STALENESS_HOURS", "0"))
+
+# Field item yang dibaca jalur skor (select): 4 input model + state prediksi yang dipakai
+# untuk no-op, sisa hari & reset notifikasi. Field klien lain (imageUrl, catatan, ...) tidak diunduh.
+_ITEM_SCORING_FIELDS = (
+    "entryDate", "itemName", "initialCondition", "storageMode",
+    "predictedShelfLife", "shelfLifeTrajectory", "predictionFingerprint", "predictionStatus",
+    "predictionUpdatedAt", "nextRecomputeAt", "expiryNotifiedAt", "predictionErrorCount",
+)
+
+class _ItemRecord:
+    """Item terproyeksi (atribut tetap via __slots__, bukan dict per dokumen).
+    get() meniru dict.get sehingga encoder & helper prediksi menerima record maupun dict."""
+    __slots__ = ("reference",) + _ITEM_SCORING_FIELDS
+
+    def __init__(self, reference, data: Dict):
+        self.reference = reference
+        for name in _ITEM_SCORING_FIELDS:
+            setattr(self, name, data.get(name))
+
+    @classmethod
+    def from_snapshot(cls, snap) -> "_ItemRecord":
+        return cls(snap.reference, snap.to_dict() or {})
+
+    @property
+    def id(self) -> str:
+        return self.reference.id
+
+    def get(self, name: str, default=None):
+        value = getattr(self, name, None)
+        return default if value is None else value
+
+_IDX_DAY = TRAINING_COLUMNS.index("Hari_Ke")
+_IDX_TEMP = TRAINING_COLUMNS.index("Suhu (°C)")
+_IDX_HUMID = TRAINING_COLUMNS.index("Kelembapan (%)")
+_IDX_TXH = TRAINING_COLUMNS.index("temp_x_humid")
+
+def _prediction_fingerprint(row: np.ndarray, trajectory_key: bytes) -> str:
+    """Hash ringkas (16 hex) dari vektor fitur terkuantisasi + kunci trajektori.
+
+    Hari_Ke tidak ikut: item yang hanya bertambah umur sehari menghasilkan trajektori
+    yang sama (kedaluwarsa & jendela notifikasi sama) sehingga tidak perlu ditulis ulang.
+    """
+    q = np.rint(np.asarray(row, dtype=np.float64)).astype(np.int64)
+    q[_IDX_DAY] = 0
+    q[_IDX_TEMP] = int(round(float(row[_IDX_TEMP]) / FINGERPRINT_TEMP_STEP))
+    q[_IDX_HUMID] = int(round(float(row[_IDX_HUMID]) / FINGERPRINT_HUMID_STEP))
+    q[_IDX_TXH] = 0  # turunan suhu*RH, sudah terwakili
+    h = hashlib.blake2b(q.tobytes(), digest_size=8)
+    h.update(trajectory_key)
+    return h.hexdigest()
+
+def _is_noop_prediction(item_data: Dict, fingerprint: str, now: datetime) -> bool:
+    """True jika dokumen sudah memuat fingerprint yang sama (dan belum melewati max-staleness)."""
+    if item_data.get("predictionFingerprint") != fingerprint:
+        return False
+    if str(item_data.get("predictionStatus", "")).startswith("error"):
+        return False
+    if PREDICTION_MAX_STALENESS_HOURS > 0:
+        updated_at = item_data.get("predictionUpdatedAt")
+        if not isinstance(updated_at, datetime):
+            return False
+        if now - updated_at > timedelta(hours=PREDICTION_MAX_STALENESS_HOURS):
+            return False
+    return True
+
+def _score_items(booster: Model, entries: List[Tuple[str, Dict]], now: Optional[datetime] = None,
+                 stats_by_uid: Optional[Dict[str, Dict[str, float]]] = None,
+                 ) -> List[Tuple[Optional[Dict], Optional[Exception], Optional[str]]]:
+    """
+    Skor trajektori banyak item (boleh lintas user) dengan SATU booster.predict:
+    tiap item menjadi TRAJECTORY_HORIZON_DAYS + 1 baris (Hari_Ke sekarang..horizon).
+    entries: list (uid, item_doc_data). Statistik sensor diambil sekali per uid, kecuali
+    stats_by_uid diberikan (skor offline: uid yang tidak ada memakai default; nilai Exception =
+    statistik gagal dibaca oleh fan-out async, item uid itu menjadi error).
+    Hasil: list (fields, error, fingerprint) sejajar dengan entries; fields = _trajectory_fields.
+    """
+    now = now or datetime.now(timezone.utc)
+    results: List[Tuple[Optional[Dict], Optional[Exception], Optional[str]]] = [(None, None, None)] * len(entries)
+    stats_errors: Dict[str, Exception] = {}
+    if stats_by_uid is not None:
+        default_stats = _sensor_statistics_from([], [], None, None)
+        stats_by_uid = {uid: stats_by_uid.get(uid, default_stats) for uid, _ in entries}
+        for uid in [uid for uid, stats in stats_by_uid.items() if isinstance(stats, Exception)]:
+            stats_errors[uid] = stats_by_uid.pop(uid)
+    else:
+        stats_by_uid = {}
+
+    temps: List[float] = []
+    humids: List[float] = []
+    for uid, _ in entries:
+        if uid not in stats_by_uid and uid not in stats_errors:
+            try:
+                stats_by_uid[uid] = _get_sensor_statistics(uid)
+            except Exception as e:
+                stats_errors[uid] = e
+        stats = stats_by_uid.get(uid, {})
+        temps.append(float(stats.get("avg_temp", 25.0)))
+        humids.append(float(stats.get("avg_humid", 80.0)))
+
+    with _stage("feature_build"):
+        X_all, errors = _FEATURE_ENCODER.encode([data or {} for _, data in entries], temps, humids, now)
+    row_index: List[int] = []
+    for i, (uid, _) in enumerate(entries):
+        err = stats_errors.get(uid) or errors[i]
+        if err is not None:
+            results[i] = (None, err, None)
+        else:
+            row_index.append(i)
+    X = X_all[row_index] if len(row_index) < len(entries) else X_all
+
+    if row_index:
+        width = TRAJECTORY_HORIZON_DAYS + 1
+        X_traj = np.repeat(X, width, axis=0)
+        X_traj[:, _IDX_DAY] += np.tile(np.arange(width, dtype=np.float32), len(X))
+        t0 = time.perf_counter()
+        with _stage("predict"):
+            y = _predict_rows(booster, X_traj)
+        primary_ms = (time.perf_counter() - t0) * 1000.0
+        _metric_count("items_scored", len(row_index))
+        days = _trajectory_days(y, len(X), width)
+        if MODEL_SHADOW_BLOB_PATHS and booster is _booster_cache:
+            _score_shadows(X_traj, days, primary_ms)
+        for r, i in enumerate(row_index):
+            uid, data = entries[i]
+            fields, key = _trajectory_fields(days[r], int(X[r, _IDX_DAY]), _entry_datetime(data or {}),
+                                             now, stats_by_uid[uid])
+            results[i] = (fields, None, _prediction_fingerprint(X[r], key))
+    return results
+
+# ===============================
+# Helper: Grid umur simpan (precomputed, memmap)
+# ===============================
+# Ruang input model kecil: 8 item + 4 kondisi one-hot (plus "tidak dikenal"), flag kulkas,
+# Hari_Ke integer, dan rata-rata suhu/RH. Booster dievaluasi sekali di grid terkuantisasi
+# (manage.py build-shelflife-grid), serving cukup lookup O(1) per baris; baris di luar
+# rentang grid tetap memakai booster. Pilih ukuran bucket lewat bench.py shelflife-grid.
+# "" = nonaktif; path relatif folder functions (ikut bundle deploy) atau gs://bucket/blob.npy
+SHELFLIFE_GRID_PATH = os.getenv("SHELFLIFE_GRID_PATH", "")
+# "1" = interpolasi bilinear suhu/RH; default node terdekat
+SHELFLIFE_GRID_INTERPOLATE = os.getenv("SHELFLIFE_GRID_INTERPOLATE", "0") == "1"
+SHELFLIFE_GRID_MAX_DAY = 365
+
+_IDX_KULKAS = TRAINING_COLUMNS.index("Kondisi_Penyimpanan_Kulkas")
+_GRID_ITEM_POS = [i for i, c in enumerate(TRAINING_COLUMNS) if c.startswith("Nama_Item_")]
+_GRID_COND_POS = [i for i, c in enumerate(TRAINING_COLUMNS) if c.startswith("Kondisi_Awal_")]
+# Kombinasi (item | tidak dikenal) x (kondisi | tidak dikenal) x kulkas
+_GRID_COMBOS = (len(_GRID_ITEM_POS) + 1) * (len(_GRID_COND_POS) + 1) * 2
+
+_grid_cache: Optional["_ShelfLifeGrid"] = None
+_grid_model_sha: Optional[str] = None   # sha model terakhir yang dicocokkan (grid None = belum/tidak cocok)
+_grid_checked_at: float = 0.0
+_grid_lock = threading.Lock()
+
+class _ShelfLifeGrid:
+    """
+    Prediksi mentah booster di node grid: values[combo, kelas_hari, i_suhu, i_rh] (float32,
+    biasanya np.memmap). Hari_Ke 0..365 dipetakan ke kelas ekuivalen lewat meta["day_class"].
+    """
+
+    def __init__(self, values, meta: Dict):
+        self.values = values
+        self.meta = meta
+        self.day_class = np.asarray(meta["day_class"], dtype=np.intp)
+        self.t_start, self.t_step, self.n_temp = meta["temp"]["start"], meta["temp"]["step"], meta["temp"]["count"]
+        self.h_start, self.h_step, self.n_humid = meta["humid"]["start"], meta["humid"]["step"], meta["humid"]["count"]
+
+    def lookup(self, X: np.ndarray, interpolate: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+        """Prediksi mentah per baris + mask baris yang tercakup grid (baris lain NaN)."""
+        X = np.asarray(X, dtype=np.float64)
+        item_hot = X[:, _GRID_ITEM_POS]
+        cond_hot = X[:, _GRID_COND_POS]
+        day = X[:, _IDX_DAY]
+        t = (X[:, _IDX_TEMP] - self.t_start) / self.t_step
+        h = (X[:, _IDX_HUMID] - self.h_start) / self.h_step
+        hit = (
+            (day >= 0) & (day <= SHELFLIFE_GRID_MAX_DAY) & (day == np.rint(day))
+            & (t >= 0) & (t <= self.n_temp - 1) & (h >= 0) & (h <= self.n_humid - 1)
+            & (item_hot.sum(axis=1) <= 1) & (cond_hot.sum(axis=1) <= 1)
+        )
+        y = np.full(len(X), np.nan)
+        rows = np.flatnonzero(hit)
+        if rows.size == 0:
+            return y, hit
+
+        item = np.where(item_hot[rows].any(axis=1), item_hot[rows].argmax(axis=1) + 1, 0)
+        cond = np.where(cond_hot[rows].any(axis=1), cond_hot[rows].argmax(axis=1) + 1, 0)
+        kulkas = (X[rows, _IDX_KULKAS] == 1).astype(np.intp)
+        combo = (item * (len(_GRID_COND_POS) + 1) + cond) * 2 + kulkas
+        d = self.day_class[day[rows].astype(np.intp)]
+        tr, hr = t[rows], h[rows]
+        v = self.values
+        if not interpolate:
+            y[rows] = v[combo, d, np.rint(tr).astype(np.intp), np.rint(hr).astype(np.intp)]
+            return y, hit
+
+        t0 = np.minimum(np.floor(tr).astype(np.intp), self.n_temp - 2)
+        h0 = np.minimum(np.floor(hr).astype(np.intp), self.n_humid - 2)
+        ft, fh = tr - t0, hr - h0
+        y[rows] = (
+            (1 - ft) * (1 - fh) * v[combo, d, t0, h0] + ft * (1 - fh) * v[combo, d, t0 + 1, h0]
+            + (1 - ft) * fh * v[combo, d, t0, h0 + 1] + ft * fh * v[combo, d, t0 + 1, h0 + 1]
+        )
+        return y, hit
+
+def _grid_axis(lo: float, hi: float, step: float) -> Dict[str, float]:
+    count = int((hi - lo) / step + 1e-9) + 1
+    if step <= 0 or count < 2:
+        raise ValueError(f"Sumbu grid tidak valid: {lo}..{hi} step {step}")
+    return {"start": float(lo), "step": float(step), "count": count}
+
+def _grid_day_classes(model_str: str) -> List[int]:
+    """
+    Kelas ekuivalen Hari_Ke 0..365: hari berurutan tanpa threshold Hari_Ke di antaranya
+    menghasilkan prediksi identik, jadi cukup satu irisan grid per kelas. Hari 0 selalu
+    kelas sendiri (missing_type Zero). Model di luar dukungan evaluator NumPy -> satu kelas per hari.
+    """
+    n_days = SHELFLIFE_GRID_MAX_DAY + 1
+    try:
+        ens = _CompiledEnsemble.from_model_str(model_str)
+    except _UnsupportedModelError:
+        return list(range(n_days))
+    internal = ens.left != np.arange(len(ens.left))  # leaf menunjuk dirinya sendiri
+    thr = ens.threshold[internal & (ens.feature == _IDX_DAY)]
+    classes = [0]
+    for d in range(1, n_days):
+        boundary = d == 1 or bool(np.any((thr >= d - 1) & (thr < d)))
+        classes.append(classes[-1] + 1 if boundary else classes[-1])
+    return classes
+
+def _shelflife_grid_meta(model_str: str, temp_range: Tuple[float, float], temp_step: float,
+                         humid_range: Tuple[float, float], humid_step: float) -> Dict:
+    day_class = _grid_day_classes(model_str)
+    day_rep = [day_class.index(c) for c in range(day_class[-1] + 1)]
+    return {
+        "version": 1,
+        "model_sha256": _model_sha256(model_str),
+        "columns": TRAINING_COLUMNS,
+        "temp": _grid_axis(*temp_range, temp_step),
+        "humid": _grid_axis(*humid_range, humid_step),
+        "day_class": day_class,
+        "day_rep": day_rep,
+    }
+
+def _grid_feature_rows(meta: Dict, combo, day, ti, hi) -> np.ndarray:
+    """Matriks fitur (n, 17) untuk node grid (combo, Hari_Ke, indeks suhu, indeks RH); argumen di-broadcast."""
+    combo, day, ti, hi = (a.ravel() for a in np.broadcast_arrays(combo, day, ti, hi))
+    X = np.zeros((combo.size, len(TRAINING_COLUMNS)), dtype=np.float32)
+    rows = np.arange(combo.size)
+    item, rest = np.divmod(combo, (len(_GRID_COND_POS) + 1) * 2)
+    cond, kulkas = np.divmod(rest, 2)
+    has_item, has_cond = item > 0, cond > 0
+    X[rows[has_item], np.asarray(_GRID_ITEM_POS)[item[has_item] - 1]] = 1
+    X[rows[has_cond], np.asarray(_GRID_COND_POS)[cond[has_cond] - 1]] = 1
+    X[:, _IDX_KULKAS] = kulkas
+    X[:, _IDX_DAY] = day
+    suhu = meta["temp"]["start"] + ti * meta["temp"]["step"]
+    rh = meta["humid"]["start"] + hi * meta["humid"]["step"]
+    X[:, _IDX_TEMP] = suhu
+    X[:, _IDX_HUMID] = rh
+    X[:, _IDX_TXH] = suhu * rh
+    return X
+
+def _build_shelflife_grid(booster: Model, meta: Dict, progress=None) -> np.ndarray:
+    """Evaluasi booster di semua node grid; hasil float32 (combo, kelas_hari, suhu, RH)."""
+    n_class = len(meta["day_rep"])
+    shape = (n_class, meta["temp"]["count"], meta["humid"]["count"])
+    day, ti, hi = np.meshgrid(np.asarray(meta["day_rep"]), np.arange(shape[1]), np.arange(shape[2]), indexing="ij")
+    values = np.empty((_GRID_COMBOS,) + shape, dtype=np.float32)
+    for combo in range(_GRID_COMBOS):
+        X = _grid_feature_rows(meta, combo, day, ti, hi)
+        values[combo] = booster.predict(X).reshape(shape)
+        if progress:
+            progress(combo + 1, _GRID_COMBOS)
+    return values
+
+def _grid_meta_path(path: str) -> str:
+    return os.path.splitext(path)[0] + ".json"
+
+def _save_shelflife_grid(path: str, values: np.ndarray, meta: Dict) -> None:
+    """Simpan grid sebagai .npy (bisa di-memmap) + metadata .json di sebelahnya."""
+    if not path.endswith(".npy"):
+        raise ValueError("Path grid harus berakhiran .npy")
+    np.save(path, np.ascontiguousarray(values, dtype=np.float32))
+    with open(_grid_meta_path(path), "w", encoding="utf-8") as f:
+        json.dump({**meta, "built_at": datetime.now(timezone.utc).isoformat()}, f)
+
+def _load_shelflife_grid(path: str) -> _ShelfLifeGrid:
+    """Memmap grid .npy lokal dan validasi layout terhadap metadata & TRAINING_COLUMNS."""
+    with open(_grid_meta_path(path), "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    if meta.get("columns") != TRAINING_COLUMNS:
+        raise ValueError("Kolom grid tidak sama dengan TRAINING_COLUMNS")
+    values = np.load(path, mmap_mode="r")
+    expected = (_GRID_COMBOS, len(meta["day_rep"]), meta["temp"]["count"], meta["humid"]["count"])
+    if values.shape != expected or len(meta["day_class"]) != SHELFLIFE_GRID_MAX_DAY + 1:
+        raise ValueError(f"Shape grid {values.shape} != {expected}")
+    return _ShelfLifeGrid(values, meta)
+
+def _download_shelflife_grid(uri: str) -> str:
+    """Unduh grid gs://bucket/blob.npy (+ .json) ke MODEL_LOCAL_CACHE_DIR per generation; kembalikan path lokal."""
+    bucket_name, _, blob_path = uri[len("gs://"):].partition("/")
+    bucket = storage.bucket(bucket_name)
+    blob = bucket.get_blob(blob_path)
+    meta_blob = bucket.get_blob(_grid_meta_path(blob_path))
+    if blob is None or meta_blob is None:
+        raise FileNotFoundError(f"Grid NOT FOUND at {uri}")
+    local_path = os.path.join(MODEL_LOCAL_CACHE_DIR, f"freshlens_grid.{blob.generation}.npy")
+    if not os.path.exists(local_path):
+        for b, dst in ((meta_blob, _grid_meta_path(local_path)), (blob, local_path)):
+            tmp = dst + ".tmp"
+            b.download_to_filename(tmp, if_generation_match=b.generation)
+            os.replace(tmp, dst)
+        keep = {os.path.basename(local_path), os.path.basename(_grid_meta_path(local_path))}
+        for name in os.listdir(MODEL_LOCAL_CACHE_DIR):
+            if name.startswith("freshlens_grid.") and name not in keep:
+                os.remove(os.path.join(MODEL_LOCAL_CACHE_DIR, name))
+    return local_path
+
+def _shelflife_grid_for(booster: Model) -> Optional[_ShelfLifeGrid]:
+    """Grid untuk booster ter-cache saat ini; None jika nonaktif, gagal dimuat, atau dibangun dari model lain."""
+    global _grid_cache, _grid_model_sha, _grid_checked_at
+    if not SHELFLIFE_GRID_PATH or booster is not _booster_cache:
+        return None
+    sha = _booster_sha256
+    if sha == _grid_model_sha and (
+        _grid_cache is not None or time.monotonic() - _grid_checked_at < MODEL_GENERATION_CHECK_SEC
+    ):
+        return _grid_cache
+
+    with _grid_lock:
+        if sha == _grid_model_sha and (
+            _grid_cache is not None or time.monotonic() - _grid_checked_at < MODEL_GENERATION_CHECK_SEC
+        ):
+            return _grid_cache
+        grid: Optional[_ShelfLifeGrid] = None
+        with _stage("grid_load"):
+            try:
+                path = SHELFLIFE_GRID_PATH
+                if path.startswith("gs://"):
+                    path = _download_shelflife_grid(path)
+                elif not os.path.isabs(path):
+                    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), path)
+                grid = _load_shelflife_grid(path)
+                if grid.meta.get("model_sha256") != sha:
+                    logging.warning(f"[Grid] {SHELFLIFE_GRID_PATH} dibangun dari model lain; pakai booster")
+                    grid = None
+                else:
+                    logging.info(f"[Grid] Loaded {SHELFLIFE_GRID_PATH} shape={grid.values.shape}")
+            except Exception as e:
+                logging.warning(f"[Grid] Gagal memuat {SHELFLIFE_GRID_PATH}; pakai booster: {e}")
+        _grid_cache, _grid_model_sha, _grid_checked_at = grid, sha, time.monotonic()
+        return grid
+
+def _predict_rows(booster: Model, X: np.ndarray) -> np.ndarray:
+    """booster.predict(X), lewat grid precomputed bila tersedia; baris di luar grid tetap ke booster."""
+    grid = _shelflife_grid_for(booster)
+    if grid is None:
+        return booster.predict(X)
+    y, hit = grid.lookup(X, SHELFLIFE_GRID_INTERPOLATE)
+    n_hit = int(hit.sum())
+    _metric_count("grid_hit", n_hit)
+    if n_hit < len(X):
+        _metric_count("grid_miss", len(X) - n_hit)
+        y[~hit] = booster.predict(X[~hit])
+    return y
+
+# ===============================
+# Helper: Bulk Write Pipeline (hasil prediksi)
+# ===============================
+PREDICTION_WRITE_OPS_PER_SEC = int(os.getenv("PREDICTION_WRITE_OPS_PER_SEC", "500"))
+PREDICTION_WRITE_MAX_ATTEMPTS = int(os.getenv("PREDICTION_WRITE_MAX_ATTEMPTS", "5"))
+# Kode gRPC yang layak di-retry: DEADLINE_EXCEEDED, RESOURCE_EXHAUSTED, ABORTED, INTERNAL, UNAVAILABLE
+_RETRYABLE_WRITE_CODES = {4, 8, 10, 13, 14}
+
+class _PredictionWriter:
+    """
+    Kirim update prediksi lewat Firestore BulkWriter (batch 20 op, paralel).
+    In-flight dibatasi rate limiter ops/detik, retry exponential backoff
+    untuk error transien, dan kegagalan per item dicatat di `failures`.
+    """
+
+    def __init__(self, db, tag: str, ops_per_second: Optional[int] = None):
+        self.tag = tag
+        self.queued = 0
+        self.written = 0
+        self.skipped = 0
+        self.failures: List[Tuple[str, int, str]] = []
+        self._lock = threading.Lock()
+        ops_per_second = ops_per_second or PREDICTION_WRITE_OPS_PER_SEC
+        self._bw = db.bulk_writer(options=BulkWriterOptions(
+            initial_ops_per_second=ops_per_second,
+            max_ops_per_second=ops_per_second,
+            retry=BulkRetry.exponential,
+        ))
+        self._bw.on_write_result(self._on_result)
+        self._bw.on_write_error(self._on_error)
+
+    def _on_result(self, reference, result, bulk_writer) -> None:
+        with self._lock:
+            self.written += 1
+
+    def _on_error(self, failure, bulk_writer) -> bool:
+        if failure.code in _RETRYABLE_WRITE_CODES and failure.attempts < PREDICTION_WRITE_MAX_ATTEMPTS:
+            return True
+        path = failure.operation.reference.path
+        with self._lock:
+            self.failures.append((path, failure.code, failure.message))
+        logging.warning(f"[{self.tag}][WRITE] {path} code={failure.code} attempts={failure.attempts} err={failure.message}")
+        return False
+
+    def update(self, reference, data: Dict) -> None:
+        with self._lock:
+            self.queued += 1
+        _metric_count("firestore_writes")
+        with _stage("write"):
+            self._bw.update(reference, data)
+
+    def flush(self) -> None:
+        """Tunggu (blocking) sampai semua op yang sudah diantrekan selesai."""
+        with _stage("write"):
+            self._bw.flush()
+
+    def wait_if_backlogged(self, limit: int) -> None:
+        """Backpressure: flush (blocking) bila op yang belum selesai melebihi `limit`."""
+        with self._lock:
+            backlog = self.queued - self.written - len(self.failures)
+        if backlog > limit:
+            self.flush()
+
+    def skip(self) -> None:
+        """Catat item yang tidak ditulis karena fingerprint-nya sama (no-op)."""
+        self.skipped += 1
+
+    def close(self) -> Dict[str, int]:
+        """Flush semua op yang tertunda (blocking) dan kembalikan ringkasan."""
+        with _stage("write"):
+            self._bw.close()
+        return {"written": self.written, "skipped": self.skipped, "failed": len(self.failures)}
+
+    def __enter__(self) -> "_PredictionWriter":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close()
+
+def _prediction_update(data: Dict, fields: Dict, fingerprint: str, status: str,
+                       now: datetime) -> Tuple[Optional[Dict], bool]:
+    """Update dokumen untuk hasil skor satu item -> (update | None, noop).
+
+    Item tanpa perubahan yang jadwal recompute-nya sudah jatuh tempo hanya dimajukan nextRecomputeAt-nya.
+    """
+    if _is_noop_prediction(data, fingerprint, now):
+        due_at = data.get("nextRecomputeAt")
+        if due_at is None or due_at <= now:
+            return {"nextRecomputeAt": fields["nextRecomputeAt"]}, True
+        return None, True
+    update = {
+        **fields,
+        "predictionStatus": status,
+        "predictionFingerprint": fingerprint,
+        "predictionUpdatedAt": firestore.SERVER_TIMESTAMP,
+    }
+    if data.get("predictionErrorCount"):
+        update["predictionErrorCount"] = firestore.DELETE_FIELD
+    # Item keluar dari jendela kedaluwarsa: aktifkan lagi notifikasinya. Item yang sudah
+    # dinotifikasi & masih di jendela tidak mendapat expiryWindowAt lagi (keluar dari query FCM).
+    window_at = fields["expiryWindowAt"]
+    if data.get("expiryNotifiedAt") is not None:
+        if window_at is None or window_at > now:
+            update["expiryNotifiedAt"] = firestore.DELETE_FIELD
+        else:
+            update["expiryWindowAt"] = firestore.DELETE_FIELD
+    return update, False
+
+def _repredict_snapshots(booster: Model, records: List[Tuple[str, _ItemRecord]],
+                         status: str, tag: str, writer: _PredictionWriter, write_errors: bool = True,
+                         deltas: Optional[List[int]] = None,
+                         stats_by_uid: Optional[Dict[str, Dict[str, float]]] = None) -> int:
+    """Skor batch item (uid, _ItemRecord) lalu antrekan hasilnya ke writer; kembalikan jumlah prediksi yang diantrekan.
+
+    Jika `deltas` diberikan, |sisa hari baru - sisa hari tersimpan saat ini| tiap item ikut dicatat.
+    `stats_by_uid`: statistik sensor yang sudah dibaca (fan-out async), diteruskan ke _score_items.
+    """
+    now = datetime.now(timezone.utc)
+    results = _score_items(booster, records, now, stats_by_uid)
+
+    total_queued = 0
+    for (uid, data), (fields, err, fingerprint) in zip(records, results):
+        if err is None:
+            pred_days = fields["predictedShelfLife"]
+            current = _days_remaining(data, now)
+            if deltas is not None and isinstance(current, (int, float)):
+                deltas.append(abs(pred_days - int(current)))
+            update, noop = _prediction_update(data, fields, fingerprint, status, now)
+            if noop:
+                writer.skip()
+            else:
+                total_queued += 1
+            if update is not None:
+                writer.update(data.reference, update)
+        elif write_errors:
+            # Mundurkan nextRecomputeAt (backoff) agar item yang terus gagal tidak menahan kepala due-queue
+            errors = int(data.get("predictionErrorCount", 0))
+            writer.update(data.reference, {
+                "predictionStatus": f"error: {err}",
+                "predictionUpdatedAt": firestore.SERVER_TIMESTAMP,
+                "predictionErrorCount": errors + 1,
+                "nextRecomputeAt": _error_retry_at(now, errors),
+            })
+            logging.warning(f"[{tag}][ITEM] uid={uid} item={data.id} err={err}")
+        else:
+            logging.error(f"[{tag}][ITEM] uid={uid} item={data.id} err={err}")
+    return total_queued
+
+# ===============================
+# Helper: Fan-out async re-prediksi (firestore_async)
+# ===============================
+# Opt-in (FIRESTORE_ASYNC_PIPELINE=1): item & statistik sensor banyak user dibaca bersamaan
+# lewat client Firestore async (maks ASYNC_FANOUT_CONCURRENCY user in-flight per fan-out).
+# Tiap halaman item masuk asyncio.Queue terbatas (ASYNC_FANOUT_QUEUE_PAGES) menuju skor per
+# SCORING_CHUNK_SIZE (di thread, loop tetap melayani fetch); fetcher menunggu bila antrean penuh.
+# Record yang sudah dibaca tapi belum diskor <= (2 x concurrency + queue) halaman + satu chunk,
+# sama terbatasnya dengan jalur sinkron. Hasil diantrekan ke _PredictionWriter sehingga
+# fetch, skor & write saling tumpang tindih.
+# Client async terikat ke satu event loop, jadi semua coroutine jalan di satu loop latar per
+# proses dan dipanggil dari kode sinkron lewat _run_async.
+FIRESTORE_ASYNC_PIPELINE = os.getenv("FIRESTORE_ASYNC_PIPELINE", "0") == "1"
+ASYNC_FANOUT_CONCURRENCY = max(1, int(os.getenv("ASYNC_FANOUT_CONCURRENCY", "16")))
+ASYNC_FANOUT_QUEUE_PAGES = max(1, int(os.getenv("ASYNC_FANOUT_QUEUE_PAGES", "4")))
+
+_async_loop: Optional[asyncio.AbstractEventLoop] = None
+_async_loop_lock = threading.Lock()
+
+def _async_db():
+    """Client Firestore async app default (di-cache firebase_admin, dipakai hanya di loop _run_async)."""
+    from firebase_admin import firestore_async
+    return firestore_async.client()
+
+def _run_async(coro):
+    """Jalankan coroutine di event loop latar lalu tunggu hasilnya; metrik invocation pemanggil ikut terbawa."""
+    global _async_loop
+    with _async_loop_lock:
+        if _async_loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="freshlens-async", daemon=True).start()
+            _async_loop = loop
+    metrics = _current_metrics.get()
+
+    async def run():
+        _current_metrics.set(metrics)
+        return await coro
+
+    return asyncio.run_coroutine_threadsafe(run(), _async_loop).result()
+
+async def _paged_async(query, page_size: int):
+    """Yield halaman (list snapshot); halaman berikutnya sudah di-fetch selagi halaman ini diproses."""
+    async def fetch(last):
+        page = query.limit(page_size)
+        if last is not None:
+            page = page.start_after(last)
+        with _stage("firestore_read"):
+            docs = [doc async for doc in page.stream()]
+        _metric_count("firestore_reads", max(1, len(docs)))
+        return docs
+
+    docs = await fetch(None)
+    while docs:
+        prefetch = asyncio.ensure_future(fetch(docs[-1])) if len(docs) >= page_size else None
+        try:
+            yield docs
+        except BaseException:
+            if prefetch is not None:
+                prefetch.cancel()
+            raise
+        if prefetch is None:
+            return
+        docs = await prefetch
+
+async def _get_sensor_statistics_async(adb, uid: str, hours: int = 24) -> Dict[str, float]:
+    """_get_sensor_statistics lewat client async (memo TTL yang sama)."""
+    cached = _sensor_stats_memo_get((uid, hours))
+    if cached is not None:
+        return cached
+    with _stage("sensor_stats"):
+        stats = await _fetch_sensor_statistics_async(adb, uid, hours)
+    _sensor_stats_memo_put((uid, hours), stats)
+    return dict(stats)
+
+async def _fetch_sensor_statistics_async(adb, uid: str, hours: int = 24) -> Dict[str, float]:
+    """Read yang sama dengan _fetch_sensor_statistics, tanpa menahan fetch user lain."""
+    now = datetime.now(timezone.utc)
+    start_time = now - timedelta(hours=hours)
+
+    agg = await _sensor_aggregate_ref(adb, uid).get(field_paths=_aggregate_window_field_paths(start_time, now))
+    _metric_count("firestore_reads")
+    spread: Optional[Tuple[float, float]] = None
+    if agg.exists:
+        agg_data = agg.to_dict() or {}
+        temps, humids = _aggregate_window_means(agg_data, start_time)
+        spread = _aggregate_window_spread(agg_data, start_time)
+    else:
+        start_epoch = start_time.timestamp()
+        readings = []
+        async for doc in _history_buckets_query(adb, uid, start_time).stream():
+            _metric_count("firestore_reads")
+            readings.extend(_bucket_readings(doc.to_dict() or {}, start_epoch))
+        temps, humids = _reading_values(readings)
+
+    latest_data = None
+    if not temps or not humids:
+        latest_doc = await (
+            adb.collection("users")
+            .document(uid)
+            .collection("sensor_data")
+            .document("latest")
+            .get(field_paths=["temperature", "humidity"])
+        )
+        _metric_count("firestore_reads")
+        if latest_doc.exists:
+            latest_data = latest_doc.to_dict() or {}
+    return _sensor_statistics_from(temps, humids, spread, latest_data)
+
+async def _stats_or_error(adb, uid: str):
+    """Statistik sensor, atau Exception-nya (diteruskan ke _score_items -> item uid itu error)."""
+    try:
+        return await _get_sensor_statistics_async(adb, uid)
+    except Exception as e:
+        return e
+
+def _async_record(db, snap) -> _ItemRecord:
+    # Write lewat BulkWriter sinkron -> referensi sinkron dengan path yang sama
+    return _ItemRecord(db.document(snap.reference.path), snap.to_dict() or {})
+
+async def _stream_user_pages_async(db, adb, uid: str, item_query, queue: asyncio.Queue) -> None:
+    """Halaman item satu user -> queue sebagai (uid, records, stats); put menunggu bila queue penuh.
+
+    Statistik dibaca setelah halaman pertama tidak kosong: user tanpa item tidak memicu read sensor
+    (sama seperti jalur sinkron)."""
+    stats = None
+    items_ref = adb.collection("users").document(uid).collection("items")
+    query = item_query(items_ref).select(_ITEM_SCORING_FIELDS)
+    # Selagi put menunggu antrean, paling banyak satu halaman prefetch user ini ikut tertahan
+    async for page in _paged_async(query, SWEEP_ITEM_PAGE_SIZE):
+        if stats is None:
+            stats = await _stats_or_error(adb, uid)
+        await queue.put((uid, [(uid, _async_record(db, snap)) for snap in page], stats))
+
+async def _score_chunk_async(booster: Model, chunk: List[Tuple[str, _ItemRecord]], stats_by_uid: Dict,
+                             status: str, tag: str, writer: _PredictionWriter, write_errors: bool,
+                             deltas: Optional[List[int]]) -> int:
+    """Skor + antrekan write di thread (loop tetap melayani fetch), lalu backpressure BulkWriter."""
+    queued = await asyncio.to_thread(
+        _repredict_snapshots, booster, chunk, status, tag, writer, write_errors, deltas, stats_by_uid
+    )
+    await asyncio.to_thread(writer.wait_if_backlogged, SWEEP_WRITE_BACKLOG)
+    return queued
+
+_FANOUT_DONE = object()
+
+async def _repredict_users_async(db, booster: Model, uids: List[str], item_query, status: str, tag: str,
+                                 writer: _PredictionWriter, write_errors: bool = True,
+                                 deltas: Optional[List[int]] = None) -> Tuple[int, int]:
+    """Fan-out fetch semua uid (maks ASYNC_FANOUT_CONCURRENCY user sekaligus), halaman item di-stream
+    lewat queue terbatas ke skor per chunk; kembalikan (item, prediksi diantrekan)."""
+    adb = _async_db()
+    queue: asyncio.Queue = asyncio.Queue(maxsize=ASYNC_FANOUT_QUEUE_PAGES)
+    next_uid = iter(uids)
+
+    async def fetcher() -> None:
+        for uid in next_uid:  # iterator bersama: tiap uid diambil tepat satu fetcher
+            await _stream_user_pages_async(db, adb, uid, item_query, queue)
+
+    async def produce() -> None:
+        try:
+            await asyncio.gather(*fetchers)
+        except Exception as e:
+            await queue.put(e)
+        else:
+            await queue.put(_FANOUT_DONE)
+
+    fetchers = [asyncio.ensure_future(fetcher()) for _ in range(min(ASYNC_FANOUT_CONCURRENCY, len(uids)))]
+    producer = asyncio.ensure_future(produce())
+    pending: List[Tuple[str, _ItemRecord]] = []
+    stats_by_uid: Dict[str, object] = {}
+    items = queued = 0
+    try:
+        while True:
+            entry = await queue.get()
+            if entry is _FANOUT_DONE:
+                break
+            if isinstance(entry, Exception):
+                raise entry
+            uid, records, stats = entry
+            stats_by_uid[uid] = stats
+            pending.extend(records)
+            items += len(records)
+            while len(pending) >= SCORING_CHUNK_SIZE:
+                chunk, pending = pending[:SCORING_CHUNK_SIZE], pending[SCORING_CHUNK_SIZE:]
+                queued += await _score_chunk_async(booster, chunk, stats_by_uid, status, tag, writer, write_errors, deltas)
+                # User yang record-nya sudah habis diskor tidak perlu statistiknya lagi
+                live = {u for u, _ in pending}
+                for u in [u for u in stats_by_uid if u not in live]:
+                    del stats_by_uid[u]
+        if pending:
+            queued += await _score_chunk_async(booster, pending, stats_by_uid, status, tag, writer, write_errors, deltas)
+    finally:
+        for task in fetchers + [producer]:
+            task.cancel()
+    return items, queued
+
+# ===============================
+# Helper: Cloud Vision (client, sumber gambar, cache hasil)
+# ===============================
+# Batas ukuran gambar inline (base64) & objek Storage yang boleh dianotasi
+VISION_MAX_IMAGE_BYTES = int(os.getenv("VISION_MAX_IMAGE_BYTES", str(6 * 1024 * 1024)))
+# Jumlah gambar maksimum per panggilan batch (batas sinkron batch_annotate_images = 16)
+VISION_MAX_BATCH = int(os.getenv("VISION_MAX_BATCH", "16"))
+VISION_MAX_RESULTS = 5
+# Cache label per hash konten: "memory" = LRU per proses, "firestore" = LRU + koleksi
+# VISION_CACHE_COLLECTION (lintas instance, eviction via expireAt + TTL policy), "off" = mati
+VISION_CACHE = os.getenv("VISION_CACHE", "memory")
+VISION_CACHE_MAX_ENTRIES = int(os.getenv("VISION_CACHE_MAX_ENTRIES", "2048"))
+VISION_CACHE_TTL_SEC = float(os.getenv("VISION_CACHE_TTL_SEC", str(30 * 86400)))
+VISION_CACHE_COLLECTION = "vision_cache"
+# Prefix objek Storage milik user; "{uid}" diganti UID pemanggil
+VISION_OWNER_PREFIXES = [p for p in os.getenv("VISION_OWNER_PREFIXES", "scans/{uid}/,item_images/{uid}_").split(",") if p]
+# Unggahan sekali pakai kamera (scans/{uid}/...) dihapus setelah dianotasi, berhasil maupun gagal
+VISION_SCAN_PREFIX = "scans/{uid}/"
+VISION_DELETE_SCANS = os.getenv("VISION_DELETE_SCANS", "1") == "1"
+
+_vision_client = None
+_vision_client_lock = threading.Lock()
+# key -> (expires_at_monotonic, labels); urutan = LRU (terbaru di akhir)
+_vision_cache: "OrderedDict[str, Tuple[float, List[str]]]" = OrderedDict()
+_vision_cache_lock = threading.Lock()
+
+def _get_vision_client(vision):
+    """ImageAnnotatorClient per proses (channel gRPC & auth dipakai ulang antar invocation)."""
+    global _vision_client
+    if _vision_client is None:
+        with _vision_client_lock:
+            if _vision_client is None:
+                _vision_client = vision.ImageAnnotatorClient()
+    return _vision_client
+
+def _vision_cache_key(md5_hex: str) -> str:
+    return f"{md5_hex}.label.{VISION_MAX_RESULTS}"
+
+def _inline_image_source(img_b64) -> Tuple[bytes, str]:
+    """Decode gambar base64 (boleh data URI) -> (bytes, md5 hex)."""
+    if not img_b64 or not isinstance(img_b64, str):
+        raise https_fn.HttpsError(
+            code=https_fn.FunctionsErrorCode.INVALID_ARGUMENT,
+            message="Field 'image' (base64 string) wajib dikirim."
+        )
+    # Bersihkan prefix data URI jika ada
+    if img_b64.startswith("data:"):
+        comma = img_b64.find(",")
+        img_b64 = img_b64[comma + 1:] if comma != -1 else img_b64
+    try:
+        raw_bytes = base64.b64decode(img_b64)
+    except ValueError:
+        raise https_fn.HttpsError(
+            code=https_fn.FunctionsErrorCode.INVALID_ARGUMENT,
+            message="Field 'image' bukan base64 yang valid."
+        )
+    if len(raw_bytes) > VISION_MAX_IMAGE_BYTES:
+        raise https_fn.HttpsError(
+            code=https_fn.FunctionsErrorCode.INVALID_ARGUMENT,
+            message=f"Gambar terlalu besar ({len(raw_bytes)} B). Kompres/resize di client dulu."
+        )
+    return raw_bytes, hashlib.md5(raw_bytes, usedforsecurity=False).hexdigest()
+
+def _storage_image_source(uid: str, path) -> Tuple[str, Optional[str]]:
+    """Validasi path Storage / gs:// milik uid -> (gs:// URI, md5 hex dari metadata objek)."""
+    if not path or not isinstance(path, str):
+        raise https_fn.HttpsError(
+            code=https_fn.FunctionsErrorCode.INVALID_ARGUMENT,
+            message="Field 'path' (gs:// URI atau path Storage) wajib dikirim."
+        )
+    bucket_name, blob_path = DEFAULT_BUCKET, path.lstrip("/")
+    if path.startswith("gs://"):
+        bucket_name, _, blob_path = path[len("gs://"):].partition("/")
+    owned = any(blob_path.startswith(p.replace("{uid}", uid)) for p in VISION_OWNER_PREFIXES)
+    if bucket_name != DEFAULT_BUCKET or not owned or ".." in blob_path.split("/"):
+        raise https_fn.HttpsError(
+            code=https_fn.FunctionsErrorCode.PERMISSION_DENIED,
+            message="Gambar bukan milik user ini."
+        )
+    blob = storage.bucket(bucket_name).get_blob(blob_path)
+    if blob is None:
+        raise https_fn.HttpsError(
+            code=https_fn.FunctionsErrorCode.NOT_FOUND,
+            message=f"Gambar tidak ditemukan: {blob_path}"
+        )
+    if (blob.size or 0) > VISION_MAX_IMAGE_BYTES:
+        raise https_fn.HttpsError(
+            code=https_fn.FunctionsErrorCode.INVALID_ARGUMENT,
+            message=f"Gambar terlalu besar ({blob.size} B). Kompres/resize di client dulu."
+        )
+    # md5Hash Storage = hash konten (base64); objek composite tidak punya -> tanpa cache
+    md5_hex = base64.b64decode(blob.md5_hash).hex() if blob.md5_hash else None
+    return f"gs://{bucket_name}/{blob_path}", md5_hex
+
+def _scan_blob_paths(uid: str, sources: List[Dict]) -> List[str]:
+    """Path objek di bucket default di bawah scans/{uid}/ yang dirujuk sources (tanpa I/O)."""
+    prefix = VISION_SCAN_PREFIX.replace("{uid}", uid)
+    paths = []
+    for src in sources:
+        path = src.get("path") if isinstance(src, dict) else None
+        if not isinstance(path, str):
+            continue
+        bucket_name, blob_path = DEFAULT_BUCKET, path.lstrip("/")
+        if path.startswith("gs://"):
+            bucket_name, _, blob_path = path[len("gs://"):].partition("/")
+        if bucket_name == DEFAULT_BUCKET and blob_path.startswith(prefix) and ".." not in blob_path.split("/"):
+            paths.append(blob_path)
+    return list(dict.fromkeys(paths))
+
+def _delete_scan_uploads(paths: List[str]) -> None:
+    """Hapus unggahan scan (best effort: objek yang sudah hilang diabaikan)."""
+    if not paths:
+        return
+    try:
+        with _stage("storage_delete"):
+            storage.bucket(DEFAULT_BUCKET).delete_blobs(paths, on_error=lambda blob: None)
+    except Exception as e:
+        logging.warning(f"[AnnotateImage] Gagal hapus scan {paths}: {e}")
+
+def _vision_cache_get(db, keys: List[str]) -> Dict[str, List[str]]:
+    """Label ter-cache untuk keys (LRU proses dulu, lalu Firestore bila VISION_CACHE=firestore)."""
+    if VISION_CACHE == "off" or not keys:
+        return {}
+    found: Dict[str, List[str]] = {}
+    now = time.monotonic()
+    with _vision_cache_lock:
+        for key in keys:
+            cached = _vision_cache.get(key)
+            if cached is not None and cached[0] > now:
+                _vision_cache.move_to_end(key)
+                found[key] = cached[1]
+    missing = [k for k in keys if k not in found]
+    if VISION_CACHE == "firestore" and missing:
+        coll = db.collection(VISION_CACHE_COLLECTION)
+        wall_now = datetime.now(timezone.utc)
+        _metric_count("firestore_reads", len(missing))
+        for snap in db.get_all([coll.document(k) for k in missing]):
+            data = snap.to_dict() if snap.exists else None
+            # TTL policy Firestore menghapus dengan jeda; dokumen kedaluwarsa dianggap miss
+            if data and data.get("expireAt") and data["expireAt"] > wall_now:
+                found[snap.id] = list(data.get("labels") or [])
+        _vision_cache_put(None, {k: found[k] for k in missing if k in found})
+    return found
+
+def _vision_cache_put(db, results: Dict[str, List[str]]) -> None:
+    """Simpan hasil ke LRU proses (evict entri tertua) dan, bila db diberikan, ke Firestore."""
+    if VISION_CACHE == "off" or not results:
+        return
+    expires_at = time.monotonic() + VISION_CACHE_TTL_SEC
+    with _vision_cache_lock:
+        for key, labels in results.items():
+            _vision_cache[key] = (expires_at, labels)
+            _vision_cache.move_to_end(key)
+        while len(_vision_cache) > VISION_CACHE_MAX_ENTRIES:
+            _vision_cache.popitem(last=False)
+    if VISION_CACHE == "firestore" and db is not None:
+        coll = db.collection(VISION_CACHE_COLLECTION)
+        expire_at = datetime.now(timezone.utc) + timedelta(seconds=VISION_CACHE_TTL_SEC)
+        batch = db.batch()
+        for key, labels in results.items():
+            batch.set(coll.document(key), {
+                "labels": labels,
+                "createdAt": firestore.SERVER_TIMESTAMP,
+                "expireAt": expire_at,
+            })
+        _metric_count("firestore_writes", len(results))
+        batch.commit()
+
+def _annotate_sources(vision, uid: str, sources: List[Dict]) -> List[Dict[str, object]]:
+    """Anotasi label untuk daftar sumber ({"image": b64} / {"path": ...}): cache dulu, sisanya 1 batch request."""
+    prepared = []  # (vision.Image, cache key | None)
+    for src in sources:
+        if not isinstance(src, dict):
+            raise https_fn.HttpsError(
+                code=https_fn.FunctionsErrorCode.INVALID_ARGUMENT,
+                message="Setiap gambar harus berupa objek {'image': ...} atau {'path': ...}."
+            )
+        if src.get("path") is not None:
+            uri, md5_hex = _storage_image_source(uid, src["path"])
+            image = vision.Image(source=vision.ImageSource(image_uri=uri))
+        else:
+            raw_bytes, md5_hex = _inline_image_source(src.get("image"))
+            image = vision.Image(content=raw_bytes)
+        prepared.append((image, _vision_cache_key(md5_hex) if md5_hex else None))
+
+    db = firestore.client() if VISION_CACHE == "firestore" else None
+    keys = list(dict.fromkeys(k for _, k in prepared if k))
+    with _stage("vision_cache"):
+        cached = _vision_cache_get(db, keys)
+    _metric_count("vision_cache_hit", sum(1 for _, k in prepared if k in cached))
+
+    # Gambar identik dalam satu batch hanya dikirim sekali
+    pending: Dict[object, int] = {}
+    requests = []
+    for i, (image, key) in enumerate(prepared):
+        if key in cached:
+            continue
+        dedupe = key if key is not None else ("nokey", i)
+        if dedupe not in pending:
+            pending[dedupe] = len(requests)
+            requests.append(vision.AnnotateImageRequest(
+                image=image,
+                features=[vision.Feature(type_=vision.Feature.Type.LABEL_DETECTION, max_results=VISION_MAX_RESULTS)],
+            ))
+
+    responses = []
+    if requests:
+        _metric_count("vision_requests")
+        _metric_count("vision_images", len(requests))
+        with _stage("vision"):
+            responses = list(_get_vision_client(vision).batch_annotate_images(requests=requests).responses)
+
+    fresh: Dict[str, List[str]] = {}
+    results: List[Dict[str, object]] = []
+    for i, (_, key) in enumerate(prepared):
+        if key in cached:
+            labels = cached[key]
+        else:
+            response = responses[pending[key if key is not None else ("nokey", i)]]
+            if response.error.message:
+                results.append({"error": f"Vision error: {response.error.message}"})
+                continue
+            labels = [a.description for a in (response.label_annotations or [])]
+            if key is not None:
+                fresh[key] = labels
+        results.append({"label": labels[0] if labels else "Tidak terdeteksi", "labels": labels, "cached": key in cached})
+    _vision_cache_put(db, fresh)
+    return results
 
 # ===============================
 # Callable: Cloud Vision (opsional)
 # ===============================
 @https_fn.on_call(memory=options.MemoryOption.MB_512)
+@_instrumented
 def annotate_image(req: https_fn.CallableRequest):
+    """Label gambar via Cloud Vision.
+
+    Input: {"path": "scans/<uid>/x.jpg" | "gs://..."} (disarankan, bytes tidak lewat payload),
+    {"image": "<base64>"}, atau batch {"images": [{"path": ...} | {"image": ...}, ...]}.
+    Output: {"label", "labels", "cached"}; batch -> {"results": [...]} (per item bisa {"error"}).
+    Objek di bawah scans/<uid>/ dihapus setelah dianotasi (VISION_DELETE_SCANS).
+    """
     if req.auth is None:
         raise https_fn.HttpsError(
             code=https_fn.FunctionsErrorCode.UNAUTHENTICATED,
             message="Anda harus login."
         )
+    vision = _vision_module()
     if vision is None:
         raise https_fn.HttpsError(
             code=https_fn.FunctionsErrorCode.FAILED_PRECONDITION,
@@ -248,40 +2408,24 @@ def annotate_image(req: https_fn.CallableRequest):
         )
 
     body = req.data or {}
-    img_b64 = body.get("image")
-    if not img_b64 or not isinstance(img_b64, str):
+    batch = body.get("images")
+    if batch is not None and (not isinstance(batch, list) or not 0 < len(batch) <= VISION_MAX_BATCH):
         raise https_fn.HttpsError(
             code=https_fn.FunctionsErrorCode.INVALID_ARGUMENT,
-            message="Field 'image' (base64 string) wajib dikirim."
+            message=f"Field 'images' harus list berisi 1..{VISION_MAX_BATCH} gambar."
         )
 
+    sources = batch if batch is not None else [body]
     try:
-        # Bersihkan prefix data URI jika ada
-        if img_b64.startswith("data:"):
-            comma = img_b64.find(",")
-            img_b64 = img_b64[comma + 1:] if comma != -1 else img_b64
-
-        raw_bytes = base64.b64decode(img_b64)
-
-        if len(raw_bytes) > 6 * 1024 * 1024:
-            raise https_fn.HttpsError(
-                code=https_fn.FunctionsErrorCode.INVALID_ARGUMENT,
-                message=f"Gambar terlalu besar ({len(raw_bytes)} B). Kompres/resize di client dulu."
-            )
-
-        client = vision.ImageAnnotatorClient()
-        image = vision.Image(content=raw_bytes)
-        response = client.label_detection(image=image, max_results=5)
-
-        if response.error.message:
+        results = _annotate_sources(vision, req.auth.uid, sources)
+        if batch is not None:
+            return {"results": results}
+        if "error" in results[0]:
             raise https_fn.HttpsError(
                 code=https_fn.FunctionsErrorCode.FAILED_PRECONDITION,
-                message=f"Vision error: {response.error.message}"
+                message=results[0]["error"]
             )
-
-        labels = response.label_annotations or []
-        top = labels[0].description if labels else "Tidak terdeteksi"
-        return {"label": top}
+        return results[0]
 
     except https_fn.HttpsError:
         raise
@@ -291,34 +2435,49 @@ def annotate_image(req: https_fn.CallableRequest):
             code=https_fn.FunctionsErrorCode.INTERNAL,
             message=f"Gagal menganotasi gambar: {e}"
         )
+    finally:
+        if VISION_DELETE_SCANS:
+            _delete_scan_uploads(_scan_blob_paths(req.auth.uid, sources))
 
 # ===============================
 # Trigger: Prediksi awal saat item dibuat
 # ===============================
 @firestore_fn.on_document_created(document="users/{uid}/items/{itemId}", memory=options.MemoryOption.MB_512)
+@_instrumented
 def predict_initial_shelflife(event: firestore_fn.Event[firestore.DocumentSnapshot]):
     uid, ref = event.params["uid"], event.data.reference
     try:
         booster = _load_booster_if_needed()
-        df = _build_features_for_item(uid, event.data.to_dict())
-        pred_days = _predict_days(booster, df)
-        ref.update({
-            "predictedShelfLife": pred_days,
-            "predictionStatus": "ok",
-            "predictionUpdatedAt": firestore.SERVER_TIMESTAMP
-        })
-        logging.info(f"[PredictInitial] OK uid={uid} item={event.params['itemId']} days={pred_days}")
+        fields, err, fingerprint = _score_items(booster, [(uid, event.data.to_dict() or {})])[0]
+        if err is not None:
+            raise err
+        _metric_count("firestore_writes")
+        with _stage("write"):
+            ref.update({
+                **fields,
+                "predictionStatus": "ok",
+                "predictionFingerprint": fingerprint,
+                "predictionUpdatedAt": firestore.SERVER_TIMESTAMP
+            })
+        logging.info(
+            f"[PredictInitial] OK uid={uid} item={event.params['itemId']} days={fields['predictedShelfLife']} "
+            f"expiry={fields['predictedExpiryAt']}"
+        )
     except Exception as e:
         logging.exception(f"[PredictInitial] ERROR for uid={uid}")
         ref.update({
             "predictionStatus": f"error: {e}",
-            "predictionUpdatedAt": firestore.SERVER_TIMESTAMP
+            "predictionUpdatedAt": firestore.SERVER_TIMESTAMP,
+            # Masuk due-queue agar update_all_shelflives mencoba lagi (mis. gagal load model sesaat)
+            "predictionErrorCount": 1,
+            "nextRecomputeAt": _error_retry_at(datetime.now(timezone.utc), 0),
         })
 
 # ===============================
 # Trigger: Log setiap update sensor ke 'history'
 # ===============================
 @firestore_fn.on_document_written(document="users/{uid}/sensor_data/latest")
+@_instrumented
 def log_sensor_data_to_history(event: firestore_fn.Event[firestore.DocumentSnapshot]):
     uid = event.params["uid"]
     after = event.data
@@ -326,41 +2485,155 @@ def log_sensor_data_to_history(event: firestore_fn.Event[firestore.DocumentSnaps
         return
 
     data = after.to_dict() or {}
+    if data.get("historyLogged"):
+        # Ditulis ingestSensorBatch: bacaan batch sudah masuk bucket jam & agregat
+        return
     temperature = float(data.get("temperature", 25.0))
     humidity = float(data.get("humidity", 80.0))
 
     db = firestore.client()
-    history_entries = (
-        db.collection("users")
-        .document(uid)
-        .collection("sensor_data")
-        .document("history")
-        .collection("entries")
-    )
-    history_entries.add({
-        "temperature": temperature,
-        "humidity": humidity,
-        "source": "iot-latest",
-        "createdAt": firestore.SERVER_TIMESTAMP,
-    })
-
-    # Trim history agar tidak tumbuh tak terbatas
+    now = datetime.now(timezone.utc)
+    # Retensi diurus compact_sensor_history; tidak ada trim per write
+    _append_sensor_reading(db, uid, temperature, humidity, now)
     try:
-        old = history_entries.order_by("createdAt", direction=firestore.Query.DESCENDING).offset(1000).limit(100).stream()
-        batch = db.batch()
-        cnt = 0
-        for doc in old:
-            batch.delete(doc.reference)
-            cnt += 1
-        if cnt:
-            batch.commit()
+        _update_sensor_aggregate(db, uid, temperature, humidity, now)
     except Exception as e:
-        logging.warning(f"[SensorHistory] trim failed: {e}")
+        logging.warning(f"[SensorHistory] aggregate update failed: {e}")
+
+# ===============================
+# Scheduler: Kompaksi history sensor harian
+# ===============================
+@scheduler_fn.on_schedule(schedule="every day 03:00", timezone="Asia/Jakarta", memory=options.MemoryOption.MB_512)
+@_instrumented
+def compact_sensor_history(event: scheduler_fn.ScheduledEvent):
+    db = firestore.client()
+    try:
+        now = datetime.now(timezone.utc)
+        totals = {"hours": 0, "days": 0, "expiredDays": 0}
+        for u in db.collection("users").select([]).stream():
+            try:
+                for key, value in _compact_sensor_history(db, u.id, now).items():
+                    totals[key] += value
+            except Exception as e:
+                logging.warning(f"[CompactHistory][USER] uid={u.id} err={e}")
+        logging.info(f"[CompactHistory] Done. {totals}")
+    except Exception as e:
+        logging.exception("[CompactHistory][FATAL]")
+
+# ===============================
+# Helper: Debounce re-prediksi sensor
+# ===============================
+# Re-prediksi per user hanya jika rata-rata 24 jam (input model) bergeser melewati ambang,
+# dan paling banyak sekali per REPREDICT_COALESCE_MIN menit. Update di dalam jendela
+# ditandai `pendingDueAt` pada repredict_state/{uid} dan dijalankan oleh
+# flush_deferred_repredictions (trailing run).
+REPREDICT_TEMP_THRESHOLD = float(os.getenv("REPREDICT_TEMP_THRESHOLD", "0.5"))    # °C
+REPREDICT_HUMID_THRESHOLD = float(os.getenv("REPREDICT_HUMID_THRESHOLD", "2.0"))  # %RH
+REPREDICT_COALESCE_MIN = float(os.getenv("REPREDICT_COALESCE_MIN", "10"))
+
+REPREDICT_RUN, REPREDICT_BELOW_THRESHOLD, REPREDICT_DEFERRED = "run", "below_threshold", "deferred"
+
+def _repredict_state_ref(db, uid: str):
+    return db.collection("repredict_state").document(uid)
+
+def _claim_repredict(db, uid: str, stats: Dict[str, float], now: datetime) -> Tuple[str, Dict[str, float]]:
+    """Putuskan (transaksional) apakah recompute jalan sekarang, ditunda, atau tidak perlu.
+
+    Kembalikan (keputusan, drift) dengan drift = selisih rata-rata terhadap recompute terakhir.
+    """
+    ref = _repredict_state_ref(db, uid)
+    window = timedelta(minutes=REPREDICT_COALESCE_MIN)
+
+    @firestore.transactional
+    def decide(transaction):
+        snap = ref.get(transaction=transaction)
+        state = (snap.to_dict() or {}) if snap.exists else {}
+        drift = {}
+        if state.get("lastAvgTemp") is not None and state.get("lastAvgHumid") is not None:
+            drift = {
+                "temp": stats["avg_temp"] - state["lastAvgTemp"],
+                "humid": stats["avg_humid"] - state["lastAvgHumid"],
+            }
+            if abs(drift["temp"]) < REPREDICT_TEMP_THRESHOLD and abs(drift["humid"]) < REPREDICT_HUMID_THRESHOLD:
+                # Rata-rata kembali ke dekat titik terakhir: batalkan trailing run yang tertunda
+                if state.get("pendingDueAt") is not None:
+                    transaction.update(ref, {"pendingDueAt": firestore.DELETE_FIELD})
+                return REPREDICT_BELOW_THRESHOLD, drift
+
+        last_run = state.get("lastRunAt")
+        if last_run is not None and now - last_run < window:
+            if state.get("pendingDueAt") is None:
+                transaction.set(ref, {"pendingDueAt": last_run + window}, merge=True)
+            return REPREDICT_DEFERRED, drift
+
+        transaction.set(ref, {
+            "lastRunAt": now,
+            "lastAvgTemp": stats["avg_temp"],
+            "lastAvgHumid": stats["avg_humid"],
+            "pendingDueAt": firestore.DELETE_FIELD,
+        }, merge=True)
+        return REPREDICT_RUN, drift
+
+    _metric_count("firestore_reads")
+    _metric_count("firestore_writes")
+    return decide(db.transaction())
+
+def _repredict_user_if_needed(db, uid: str, tag: str) -> str:
+    """Gate ambang + jendela coalescing, lalu re-skor semua item user bila perlu."""
+    now = datetime.now(timezone.utc)
+    # Bacaan baru ditulis instance fungsi lain (log history / ingestSensorBatch), jadi memo proses
+    # ini tidak pernah di-invalidate oleh write-nya: tiap invocation mulai dari statistik segar.
+    _invalidate_sensor_statistics(uid)
+    stats = _get_sensor_statistics(uid)
+    decision, drift = _claim_repredict(db, uid, stats, now)
+    drift_txt = (f"drift temp={drift['temp']:+.2f} humid={drift['humid']:+.2f}" if drift else "drift n/a")
+    if decision != REPREDICT_RUN:
+        logging.info(f"[{tag}] uid={uid} {decision}; {drift_txt}")
+        return decision
+
+    booster = _load_booster_if_needed()
+    total_updated = 0
+    deltas: List[int] = []
+    with _PredictionWriter(db, tag) as writer:
+        if FIRESTORE_ASYNC_PIPELINE:
+            # Satu user: halaman item di-prefetch & di-skor per chunk selagi halaman berikutnya dibaca
+            n_items, total_updated = _run_async(_repredict_users_async(
+                db, booster, [uid], lambda items_ref: items_ref, "ok", tag, writer, deltas=deltas
+            ))
+        else:
+            items_ref = db.collection("users").document(uid).collection("items")
+            with _stage("firestore_read"):
+                records = [(uid, _ItemRecord.from_snapshot(item)) for item in items_ref.select(_ITEM_SCORING_FIELDS).stream()]
+            _metric_count("firestore_reads", max(1, len(records)))
+            n_items = len(records)
+            for start in range(0, len(records), SCORING_CHUNK_SIZE):
+                total_updated += _repredict_snapshots(
+                    booster, records[start:start + SCORING_CHUNK_SIZE], "ok", tag, writer, deltas=deltas
+                )
+
+    # Efek nyata ke prediksi (untuk tuning ambang): berapa item berubah & seberapa jauh (hari)
+    changed = sum(1 for d in deltas if d)
+    effect = {
+        "items": n_items,
+        "changed": changed,
+        "meanAbsDeltaDays": round(sum(deltas) / len(deltas), 3) if deltas else 0.0,
+        "maxAbsDeltaDays": max(deltas) if deltas else 0,
+        "driftTemp": round(drift["temp"], 3) if drift else None,
+        "driftHumid": round(drift["humid"], 3) if drift else None,
+    }
+    _repredict_state_ref(db, uid).set({"lastEffect": effect}, merge=True)
+    logging.info(
+        f"[{tag}] uid={uid} updated items: {total_updated}, skipped (unchanged): {writer.skipped}, "
+        f"write failures: {len(writer.failures)}; {drift_txt}; "
+        f"changed {changed}/{len(deltas)} mean|Δdays|={effect['meanAbsDeltaDays']} max|Δdays|={effect['maxAbsDeltaDays']}"
+    )
+    return decision
 
 # ===============================
 # Trigger: Re-predict saat sensor berubah
 # ===============================
 @firestore_fn.on_document_updated(document="users/{uid}/sensor_data/latest", memory=options.MemoryOption.MB_512)
+@_instrumented
 def on_sensor_data_update_and_repredict(event: firestore_fn.Event[firestore.DocumentSnapshot]):
     uid = event.params["uid"]
     try:
@@ -375,78 +2648,359 @@ def on_sensor_data_update_and_repredict(event: firestore_fn.Event[firestore.Docu
             logging.info("[RePredictOnSensor] No sensor change; skip recompute.")
             return
 
-        booster = _load_booster_if_needed()
-        db = firestore.client()
-        items_ref = db.collection("users").document(uid).collection("items")
-
-        total_updated = 0
-        for item in items_ref.stream():
-            try:
-                df = _build_features_for_item(uid, item.to_dict())
-                pred_days = _predict_days(booster, df)
-                item.reference.update({
-                    "predictedShelfLife": pred_days,
-                    "predictionStatus": "ok",
-                    "predictionUpdatedAt": firestore.SERVER_TIMESTAMP,
-                })
-                total_updated += 1
-            except Exception as ie:
-                item.reference.update({
-                    "predictionStatus": f"error: {ie}",
-                    "predictionUpdatedAt": firestore.SERVER_TIMESTAMP,
-                })
-                logging.warning(f"[RePredictOnSensor][ITEM] uid={uid} item={item.id} err={ie}")
-
-        logging.info(f"[RePredictOnSensor] uid={uid} updated items: {total_updated}")
+        _repredict_user_if_needed(firestore.client(), uid, "RePredictOnSensor")
     except Exception as e:
         logging.exception("[RePredictOnSensor][FATAL]")
 
 # ===============================
-# Scheduler: Recalc setiap 3 jam
+# Scheduler: Trailing run re-prediksi yang tertunda
 # ===============================
-@scheduler_fn.on_schedule(schedule="every 3 hours", memory=options.MemoryOption.MB_512)
-def update_all_shelflives(event: scheduler_fn.ScheduledEvent):
+@scheduler_fn.on_schedule(schedule="every 5 minutes", memory=options.MemoryOption.MB_512)
+@_instrumented
+def flush_deferred_repredictions(event: scheduler_fn.ScheduledEvent):
     db = firestore.client()
     try:
-        booster = _load_booster_if_needed()
-        cutoff = datetime.now(timezone.utc) - timedelta(hours=3)
+        now = datetime.now(timezone.utc)
+        due = db.collection("repredict_state").where("pendingDueAt", "<=", now).select([]).stream()
+        counts: Dict[str, int] = {}
+        for state in due:
+            try:
+                decision = _repredict_user_if_needed(db, state.id, "RePredictDeferred")
+                counts[decision] = counts.get(decision, 0) + 1
+            except Exception:
+                logging.exception(f"[RePredictDeferred][USER] uid={state.id}")
+        logging.info(f"[RePredictDeferred] Done. {counts}")
+    except Exception as e:
+        logging.exception("[RePredictDeferred][FATAL]")
 
-        users = db.collection("users").stream()
-        total_updated = 0
+# ===============================
+# Helper: Sweep paralel per shard uid
+# ===============================
+# Koleksi users dibagi menjadi SWEEP_SHARDS rentang uid deterministik (karakter pertama uid)
+# dan diproses paralel oleh thread pool terbatas. Budget write ops/detik dibagi rata antar
+# worker, dan tiap shard menunggu BulkWriter bila antrean write > SWEEP_WRITE_BACKLOG.
+#
+# User & item dibaca per halaman (cursor), dan cursor uid terakhir tiap shard disimpan di
+# dokumennya sendiri, sweep_state/{tag}/shards/{i} (tanpa dokumen panas bersama); dokumen
+# sweep_state/{tag} hanya memuat runId, jumlah shard & completedAt. Run yang melewati
+# SWEEP_DEADLINE_SEC berhenti rapi; run berikutnya melanjutkan dari checkpoint sampai semua
+# shard selesai, baru kemudian mulai run baru (runId baru -> dokumen shard lama diabaikan).
+SWEEP_SHARDS = max(1, min(int(os.getenv("SWEEP_SHARDS", "8")), 62))
+SWEEP_MAX_WORKERS = max(1, int(os.getenv("SWEEP_MAX_WORKERS", "4")))
+SWEEP_WRITE_BACKLOG = int(os.getenv("SWEEP_WRITE_BACKLOG", "2000"))
+SWEEP_PROGRESS_EVERY = int(os.getenv("SWEEP_PROGRESS_EVERY", "5000"))  # item per log progres
+SWEEP_USER_PAGE_SIZE = int(os.getenv("SWEEP_USER_PAGE_SIZE", "300"))
+SWEEP_ITEM_PAGE_SIZE = int(os.getenv("SWEEP_ITEM_PAGE_SIZE", "500"))
+# Timeout fungsi scheduler sweep & batas kerja di dalamnya (sisakan waktu untuk flush)
+SWEEP_TIMEOUT_SEC = 540
+SWEEP_DEADLINE_SEC = float(os.getenv("SWEEP_DEADLINE_SEC", "480"))
+
+# Alfabet uid Firebase Auth dalam urutan byte (= urutan document ID di Firestore)
+_UID_ALPHABET = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+
+def _uid_shard_bounds(shards: int) -> List[Tuple[Optional[str], Optional[str]]]:
+    """Rentang [lo, hi) per shard; shard pertama & terakhir terbuka agar semua uid tercakup."""
+    cuts = [_UID_ALPHABET[i * len(_UID_ALPHABET) // shards] for i in range(1, shards)]
+    return list(zip([None] + cuts, cuts + [None]))
+
+def _shard_users_query(db, lo: Optional[str], hi: Optional[str], after: Optional[str] = None):
+    users = db.collection("users")
+    query = users.order_by("__name__")
+    if lo is not None:
+        query = query.where("__name__", ">=", users.document(lo))
+    if hi is not None:
+        query = query.where("__name__", "<", users.document(hi))
+    if after is not None:
+        query = query.where("__name__", ">", users.document(after))
+    return query.select([])  # sweep hanya butuh uid
+
+def _paged_stream(query, page_size: int):
+    """Stream query per halaman (start_after snapshot terakhir); memori dibatasi page_size."""
+    last = None
+    while True:
+        page = query.limit(page_size)
+        if last is not None:
+            page = page.start_after(last)
+        with _stage("firestore_read"):
+            docs = list(page.stream())
+        _metric_count("firestore_reads", max(1, len(docs)))
+        yield from docs
+        if len(docs) < page_size:
+            return
+        last = docs[-1]
+
+def _sweep_checkpoint_ref(db, tag: str):
+    return db.collection("sweep_state").document(tag)
+
+def _sweep_shard_ref(db, tag: str, shard: int):
+    return _sweep_checkpoint_ref(db, tag).collection("shards").document(str(shard))
+
+def _read_shard_states(db, tag: str, run_id: str, shards: int) -> Dict[int, Dict]:
+    """State per shard milik run `run_id` (satu get_all); dokumen dari run lain diabaikan."""
+    snaps = db.get_all([_sweep_shard_ref(db, tag, i) for i in range(shards)])
+    _metric_count("firestore_reads", shards)
+    states: Dict[int, Dict] = {}
+    for snap in snaps:
+        data = (snap.to_dict() or {}) if snap.exists else {}
+        if data.get("runId") == run_id:
+            states[int(snap.id)] = data
+    return states
+
+def _load_sweep_checkpoint(db, tag: str, shards: int) -> Tuple[str, Dict[int, Dict]]:
+    """(runId, state per shard) dari run yang belum selesai; jika tidak ada, mulai run baru."""
+    ref = _sweep_checkpoint_ref(db, tag)
+    snap = ref.get()
+    data = (snap.to_dict() or {}) if snap.exists else {}
+    if data.get("runId") and data.get("completedAt") is None and data.get("shardCount") == shards:
+        logging.info(f"[{tag}] Resume run dari checkpoint (mulai {data.get('startedAt')})")
+        return data["runId"], _read_shard_states(db, tag, data["runId"], shards)
+    run_id = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%f")
+    # merge: field lain (mis. modelSha256 run terakhir) tetap ada; map `shards` format lama dibuang
+    ref.set({"runId": run_id, "shardCount": shards, "startedAt": firestore.SERVER_TIMESTAMP,
+             "completedAt": None, "shards": firestore.DELETE_FIELD}, merge=True)
+    return run_id, {}
+
+def _sweep_shard(db, booster: Model, shard: int, bounds: Tuple[Optional[str], Optional[str]],
+                 item_query, status: str, tag: str, write_errors: bool, ops_per_second: int,
+                 run_id: str, state: Dict, deadline: float) -> Dict[str, int]:
+    """Re-prediksi user dalam satu rentang uid mulai dari cursor checkpoint; chunk skor lintas user."""
+    lo, hi = bounds
+    if state.get("done"):
+        return {"done": 1}
+
+    started = time.monotonic()
+    progress = {"users": 0, "items": 0, "updated": 0}
+    pending: List[Tuple[str, _ItemRecord]] = []
+    cursor: Optional[str] = state.get("cursor")
+    done = False
+    ckpt_ref = _sweep_shard_ref(db, tag, shard)
+    ckpt_users, ckpt_items = int(state.get("users", 0)), int(state.get("items", 0))
+
+    with _PredictionWriter(db, f"{tag}:{shard}", ops_per_second=ops_per_second) as writer:
+        def flush() -> None:
+            progress["updated"] += _repredict_snapshots(booster, pending, status, tag, writer, write_errors=write_errors)
+            pending.clear()
+            writer.wait_if_backlogged(SWEEP_WRITE_BACKLOG)
+
+        while time.monotonic() < deadline:
+            with _stage("firestore_read"):
+                page = list(_shard_users_query(db, lo, hi, cursor).limit(SWEEP_USER_PAGE_SIZE).stream())
+            _metric_count("firestore_reads", max(1, len(page)))
+            page_users = page_items = 0
+            if FIRESTORE_ASYNC_PIPELINE:
+                # Seluruh halaman user di-fan-out; deadline dicek per halaman (halaman selalu tuntas)
+                page_items, queued = _run_async(_repredict_users_async(
+                    db, booster, [u.id for u in page], item_query, status, tag, writer, write_errors
+                ))
+                progress["updated"] += queued
+                if page:
+                    cursor = page[-1].id
+                page_users = len(page)
+                done = len(page) < SWEEP_USER_PAGE_SIZE
+                if (progress["items"] + page_items) // SWEEP_PROGRESS_EVERY > progress["items"] // SWEEP_PROGRESS_EVERY:
+                    logging.info(f"[{tag}][shard {shard}] progress {progress} uid={cursor}")
+            else:
+                for u in page:
+                    items_ref = db.collection("users").document(u.id).collection("items")
+                    for item in _paged_stream(item_query(items_ref).select(_ITEM_SCORING_FIELDS), SWEEP_ITEM_PAGE_SIZE):
+                        pending.append((u.id, _ItemRecord.from_snapshot(item)))
+                        page_items += 1
+                        if len(pending) >= SCORING_CHUNK_SIZE:
+                            flush()
+                        if (progress["items"] + page_items) % SWEEP_PROGRESS_EVERY == 0:
+                            logging.info(f"[{tag}][shard {shard}] progress {progress} uid={u.id}")
+                    if time.monotonic() >= deadline:
+                        # User ini belum tentu tuntas dibaca -> cursor tetap di user sebelumnya
+                        break
+                    cursor = u.id
+                    page_users += 1
+                else:
+                    done = len(page) < SWEEP_USER_PAGE_SIZE
+
+            # Checkpoint hanya setelah write halaman ini ter-flush
+            if pending:
+                flush()
+            writer.flush()
+            progress["users"] += page_users
+            progress["items"] += page_items
+            _metric_count("firestore_writes")
+            # Dokumen milik shard ini saja: set penuh, tanpa merge/transaksi
+            ckpt_ref.set({
+                "runId": run_id,
+                "cursor": cursor,
+                "done": done,
+                "users": ckpt_users + progress["users"],
+                "items": ckpt_items + progress["items"],
+                "updatedAt": firestore.SERVER_TIMESTAMP,
+            })
+            if done or time.monotonic() >= deadline:
+                break
 
-        for u in users:
-            uid = u.id
-            items_ref = db.collection("users").document(uid).collection("items")
+    progress.update(skipped=writer.skipped, failed=len(writer.failures), done=int(done))
+    logging.info(
+        f"[{tag}][shard {shard}] {'done' if done else 'stopped at deadline'} range=[{lo or ''}, {hi or ''}) "
+        f"cursor={cursor} {progress} in {time.monotonic() - started:.1f}s"
+    )
+    return progress
+
+def _run_sharded_sweep(db, booster: Model, item_query, status: str, tag: str,
+                       write_errors: bool = True, on_complete: Optional[Dict] = None) -> Dict[str, int]:
+    """Jalankan _sweep_shard untuk semua shard di thread pool (resume dari checkpoint); kembalikan total.
+
+    `on_complete`: field tambahan yang ditulis ke checkpoint bersama completedAt. Run dianggap
+    selesai bila semua dokumen shard run ini berstatus done.
+    """
+    deadline = time.monotonic() + SWEEP_DEADLINE_SEC
+    bounds = _uid_shard_bounds(SWEEP_SHARDS)
+    run_id, states = _load_sweep_checkpoint(db, tag, len(bounds))
+    workers = min(SWEEP_MAX_WORKERS, len(bounds))
+    ops_per_second = max(1, PREDICTION_WRITE_OPS_PER_SEC // workers)
+    totals = {"users": 0, "items": 0, "updated": 0, "skipped": 0, "failed": 0, "done": 0, "failedShards": 0}
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix=tag) as pool:
+        futures = {
+            # copy_context: stage/counter metrik dari thread worker ikut tercatat di invocation ini
+            pool.submit(
+                contextvars.copy_context().run,
+                _sweep_shard, db, booster, i, b, item_query, status, tag, write_errors, ops_per_second,
+                run_id, states.get(i) or {}, deadline,
+            ): i
+            for i, b in enumerate(bounds)
+        }
+        for fut in as_completed(futures):
             try:
-                candidates = items_ref.where("predictionUpdatedAt", "<", cutoff).stream()
+                for key, value in fut.result().items():
+                    totals[key] += value
             except Exception:
-                candidates = items_ref.stream()
-
-            for item in candidates:
-                try:
-                    df = _build_features_for_item(uid, item.to_dict())
-                    pred_days = _predict_days(booster, df)
-                    item.reference.update({
-                        "predictedShelfLife": pred_days,
-                        "predictionStatus": "ok",
-                        "predictionUpdatedAt": firestore.SERVER_TIMESTAMP,
-                    })
-                    total_updated += 1
-                except Exception as ie:
-                    item.reference.update({
-                        "predictionStatus": f"error: {ie}",
-                        "predictionUpdatedAt": firestore.SERVER_TIMESTAMP,
-                    })
-                    logging.warning(f"[UpdateAll][ITEM] uid={uid} item={item.id} err={ie}")
-
-        logging.info(f"[UpdateAll] Done. Updated items: {total_updated}")
+                logging.exception(f"[{tag}][shard {futures[fut]}] failed")
+                totals["failedShards"] += 1
+
+    shard_states = _read_shard_states(db, tag, run_id, len(bounds))
+    if sum(1 for st in shard_states.values() if st.get("done")) == len(bounds):
+        _sweep_checkpoint_ref(db, tag).set({**(on_complete or {}), "completedAt": firestore.SERVER_TIMESTAMP}, merge=True)
+    return totals
+
+# ===============================
+# Helper: Due-queue recompute (nextRecomputeAt)
+# ===============================
+# Tiap prediksi menulis nextRecomputeAt (lihat _next_recompute_at), jadi scheduler cukup
+# satu query collection group terurut atas item yang jatuh tempo: biaya sebanding dengan
+# pekerjaan, bukan jumlah user. Butuh index single-field collection group untuk
+# items.nextRecomputeAt (dan items.expiryWindowAt untuk check_expiring_items).
+# Item yang sudah diproses pindah ke masa depan, sehingga run berikutnya otomatis
+# melanjutkan sisa antrean tanpa checkpoint.
+def _due_items_query(db, now: datetime):
+    return (
+        db.collection_group("items")
+        .where("nextRecomputeAt", "<=", now)
+        .order_by("nextRecomputeAt")
+        .select(_ITEM_SCORING_FIELDS)  # memuat nextRecomputeAt -> cursor start_after tetap valid
+    )
+
+def _drain_due_items(db, booster: Model, tag: str, deadline: float) -> Dict[str, int]:
+    """Re-prediksi item dengan nextRecomputeAt <= sekarang, paling lama tertunda lebih dulu."""
+    now = datetime.now(timezone.utc)
+    totals = {"items": 0, "updated": 0, "done": 1}
+    if FIRESTORE_ASYNC_PIPELINE:
+        with _PredictionWriter(db, tag) as writer:
+            _run_async(_drain_due_items_async(db, booster, now, tag, deadline, writer, totals))
+        totals.update(skipped=writer.skipped, failed=len(writer.failures))
+        return totals
+
+    query = _due_items_query(db, now)
+    pending: List[Tuple[str, _ItemRecord]] = []
+
+    with _PredictionWriter(db, tag) as writer:
+        def flush() -> None:
+            totals["updated"] += _repredict_snapshots(booster, pending, "ok", tag, writer)
+            pending.clear()
+            writer.wait_if_backlogged(SWEEP_WRITE_BACKLOG)
+
+        for item in _paged_stream(query, SWEEP_ITEM_PAGE_SIZE):
+            owner_ref = item.reference.parent.parent
+            if owner_ref is None:
+                continue
+            pending.append((owner_ref.id, _ItemRecord.from_snapshot(item)))
+            totals["items"] += 1
+            if len(pending) >= SCORING_CHUNK_SIZE:
+                flush()
+            if totals["items"] % SWEEP_PROGRESS_EVERY == 0:
+                logging.info(f"[{tag}] progress {totals}")
+            if time.monotonic() >= deadline:
+                totals["done"] = 0
+                break
+        if pending:
+            flush()
+
+    totals.update(skipped=writer.skipped, failed=len(writer.failures))
+    return totals
+
+async def _drain_due_items_async(db, booster: Model, now: datetime, tag: str, deadline: float,
+                                 writer: _PredictionWriter, totals: Dict[str, int]) -> None:
+    """Fan-out _drain_due_items: halaman berikutnya di-prefetch, statistik sensor semua user
+    di satu halaman dibaca bersamaan, skor per chunk di thread. Deadline dicek per halaman."""
+    adb = _async_db()
+    semaphore = asyncio.Semaphore(ASYNC_FANOUT_CONCURRENCY)
+    pending: List[Tuple[str, _ItemRecord]] = []
+    stats_by_uid: Dict[str, object] = {}
+
+    async def stats_for(uid: str):
+        async with semaphore:
+            return uid, await _stats_or_error(adb, uid)
+
+    pages = _paged_async(_due_items_query(adb, now), SWEEP_ITEM_PAGE_SIZE)
+    try:
+        async for page in pages:
+            records = [
+                (snap.reference.parent.parent.id, _async_record(db, snap))
+                for snap in page if snap.reference.parent.parent is not None
+            ]
+            # Memo TTL tetap berlaku: user yang sudah dibaca di halaman sebelumnya tidak memicu RPC
+            for uid, stats in await asyncio.gather(*(stats_for(uid) for uid in {uid for uid, _ in records})):
+                stats_by_uid[uid] = stats
+            pending.extend(records)
+            progress_before = totals["items"]
+            totals["items"] += len(records)
+            while len(pending) >= SCORING_CHUNK_SIZE:
+                chunk, pending = pending[:SCORING_CHUNK_SIZE], pending[SCORING_CHUNK_SIZE:]
+                totals["updated"] += await _score_chunk_async(booster, chunk, stats_by_uid, "ok", tag, writer, True, None)
+            if totals["items"] // SWEEP_PROGRESS_EVERY > progress_before // SWEEP_PROGRESS_EVERY:
+                logging.info(f"[{tag}] progress {totals}")
+            if time.monotonic() >= deadline:
+                totals["done"] = 0
+                break
+        if pending:
+            totals["updated"] += await _score_chunk_async(booster, pending, stats_by_uid, "ok", tag, writer, True, None)
+    finally:
+        await pages.aclose()
+
+# ===============================
+# Scheduler: Recompute item yang jatuh tempo (tiap jam)
+# ===============================
+@scheduler_fn.on_schedule(schedule="every 1 hours", timeout_sec=SWEEP_TIMEOUT_SEC, memory=options.MemoryOption.MB_512)
+@_instrumented
+def update_all_shelflives(event: scheduler_fn.ScheduledEvent):
+    db = firestore.client()
+    try:
+        booster = _load_booster_if_needed()
+        totals = _drain_due_items(db, booster, "UpdateAll", time.monotonic() + SWEEP_DEADLINE_SEC)
+        logging.info(
+            f"[UpdateAll] {'Done' if totals['done'] else 'Stopped at deadline'}. Due items: {totals['items']}, "
+            f"updated: {totals['updated']}, unchanged (rescheduled): {totals['skipped']}, "
+            f"write failures: {totals['failed']}"
+        )
     except Exception as e:
         logging.exception("[UpdateAll][FATAL]")
 
 # ===============================
 # Scheduler: Recalc harian pukul 00:00 WIB
 # ===============================
-@scheduler_fn.on_schedule(schedule="0 0 * * *", timezone="Asia/Jakarta", memory=options.MemoryOption.MB_512)
+# Jaring pengaman untuk model baru & item lama tanpa trajektori. Bertambahnya Hari_Ke sudah
+# tercakup trajektori, jadi sweep dilewati bila run terakhir selesai dengan model yang sama;
+# saat jalan pun hanya item yang trajektorinya berubah yang ditulis.
+@scheduler_fn.on_schedule(schedule="0 0 * * *", timezone="Asia/Jakarta", timeout_sec=SWEEP_TIMEOUT_SEC,
+                          memory=options.MemoryOption.MB_512)
+@_instrumented
 def daily_shelflife_recalculation(event: scheduler_fn.ScheduledEvent):
     
     wib_tz = timezone(timedelta(hours=7))
@@ -456,80 +3010,173 @@ def daily_shelflife_recalculation(event: scheduler_fn.ScheduledEvent):
     db = firestore.client()
     try:
         booster = _load_booster_if_needed()
-        users = db.collection("users").stream()
-        total_updated = 0
-        for user in users:
-            uid = user.id
-            items_ref = db.collection("users").document(uid).collection("items")
-            for item in items_ref.stream():
-                try:
-                    df = _build_features_for_item(uid, item.to_dict())
-                    pred_days = _predict_days(booster, df)
-                    item.reference.update({
-                        "predictedShelfLife": pred_days,
-                        "predictionStatus": "repredicted_daily",
-                        "predictionUpdatedAt": firestore.SERVER_TIMESTAMP,
-                    })
-                    total_updated += 1
-                except Exception as ie:
-                    logging.error(f"[DailyRecalc][ITEM] uid={uid} item={item.id} err={ie}")
-        logging.info(f"[DailyRecalc] Selesai. Total item diperbarui: {total_updated}")
+        last = _sweep_checkpoint_ref(db, "DailyRecalc").get()
+        last_data = (last.to_dict() or {}) if last.exists else {}
+        if (_booster_sha256 is not None and last_data.get("completedAt") is not None
+                and last_data.get("modelSha256") == _booster_sha256):
+            logging.info("[DailyRecalc] Model tidak berubah sejak sweep terakhir; dilewati.")
+            return
+        totals = _run_sharded_sweep(
+            db, booster, lambda items_ref: items_ref, "repredicted_daily", "DailyRecalc", write_errors=False,
+            on_complete={"modelSha256": _booster_sha256},
+        )
+        logging.info(
+            f"[DailyRecalc] Selesai. Total item diperbarui: {totals['updated']}, "
+            f"dilewati (tidak berubah): {totals['skipped']}, gagal tulis: {totals['failed']}, "
+            f"user: {totals['users']}, shard selesai: {totals['done']}/{SWEEP_SHARDS}, shard gagal: {totals['failedShards']}"
+        )
     except Exception as e:
         logging.critical(f"[DailyRecalc][FATAL] {e}")
 
 # ===============================
 # Scheduler: Notifikasi harian item kadaluarsa (FCM)
 # ===============================
+# Satu digest per user; item yang sudah dinotifikasi ditandai `expiryNotifiedAt` dan
+# `expiryWindowAt`-nya dihapus, jadi query harian hanya membaca item yang belum dinotifikasi
+# (re-prediksi menulis jendela lagi & menghapus marker bila item keluar dari jendela).
+EXPIRY_NOTIFY_DAYS = int(os.getenv("EXPIRY_NOTIFY_DAYS", "2"))
+FCM_SEND_BATCH_SIZE = 500  # batas messaging.send_each per panggilan
+FCM_TOKEN_PREFETCH_CHUNK = int(os.getenv("FCM_TOKEN_PREFETCH_CHUNK", "300"))
+EXPIRY_DIGEST_MAX_NAMES = 3
+
+def _expiry_digest_message(token: str, item_names: List[str]) -> messaging.Message:
+    """Notifikasi ringkas untuk semua item user yang akan kedaluwarsa."""
+    if len(item_names) == 1:
+        body = f"Jangan lupa, {item_names[0]} Anda akan segera habis masa simpannya. Yuk, segera diolah!"
+    else:
+        names = list(dict.fromkeys(item_names))  # nama unik, urutan paling mendesak dulu
+        shown = ", ".join(names[:EXPIRY_DIGEST_MAX_NAMES])
+        rest = len(names) - EXPIRY_DIGEST_MAX_NAMES
+        if rest > 0:
+            shown += f" dan {rest} lainnya"
+        body = f"Jangan lupa, {len(item_names)} item Anda akan segera habis masa simpannya: {shown}. Yuk, segera diolah!"
+    return messaging.Message(
+        notification=messaging.Notification(title='Segera Habis!', body=body),
+        data={"type": "expiry_digest", "count": str(len(item_names))},
+        token=token,
+    )
+
+def _mark_items_notified(db, item_refs: List[firestore.DocumentReference]) -> int:
+    """
+    Tandai item di digest terkirim dan keluarkan dari query expiryWindowAt (batch per _BATCH_MAX_OPS).
+    Batch yang gagal (mis. item dihapus sejak query) diulang per dokumen; kembalikan jumlah gagal.
+    """
+    marker = {'expiryNotifiedAt': firestore.SERVER_TIMESTAMP, 'expiryWindowAt': firestore.DELETE_FIELD}
+    failed = 0
+    for start in range(0, len(item_refs), _BATCH_MAX_OPS):
+        refs = item_refs[start:start + _BATCH_MAX_OPS]
+        _metric_count("firestore_writes", len(refs))
+        batch = db.batch()
+        for ref in refs:
+            batch.update(ref, marker)
+        try:
+            batch.commit()
+            continue
+        except Exception as e:
+            logging.warning(f"[FCM] Batch marker gagal ({e}); ulangi per item")
+        for ref in refs:
+            try:
+                ref.update(marker)
+            except Exception as e:
+                failed += 1
+                logging.warning(f"[FCM] Gagal menandai {ref.path}: {e}")
+    return failed
+
+def _legacy_items_pending(db) -> bool:
+    """Item lama tanpa trajektori (tanpa expiryWindowAt) hanya ada sampai DailyRecalc pertama selesai."""
+    snap = _sweep_checkpoint_ref(db, "DailyRecalc").get()
+    _metric_count("firestore_reads")
+    return not snap.exists or (snap.to_dict() or {}).get("modelSha256") is None
+
+def _prefetch_fcm_tokens(db, uids: List[str]) -> Dict[str, Optional[str]]:
+    """fcmToken per uid lewat get_all per chunk (hanya field fcmToken yang dibaca)."""
+    tokens: Dict[str, Optional[str]] = {}
+    for start in range(0, len(uids), FCM_TOKEN_PREFETCH_CHUNK):
+        refs = [db.collection('users').document(uid) for uid in uids[start:start + FCM_TOKEN_PREFETCH_CHUNK]]
+        for snap in db.get_all(refs, field_paths=['fcmToken']):
+            tokens[snap.id] = (snap.to_dict() or {}).get('fcmToken') if snap.exists else None
+            _metric_count("firestore_reads")
+    return tokens
+
 @scheduler_fn.on_schedule(schedule="every day 09:00", timezone="Asia/Jakarta", memory=options.MemoryOption.MB_512)
+@_instrumented
 def check_expiring_items(event: scheduler_fn.ScheduledEvent) -> None:
     """
-    Memeriksa semua item di inventaris semua pengguna dan mengirim notifikasi
-    jika ada item yang akan kedaluwarsa dalam <= 2 hari.
+    Memeriksa semua item di inventaris semua pengguna dan mengirim satu notifikasi
+    digest per pengguna untuk item yang akan kedaluwarsa dalam <= EXPIRY_NOTIFY_DAYS hari.
     """
     logging.info("[FCM] Menjalankan pengecekan item kedaluwarsa...")
     db = firestore.client()
 
     try:
-        # Ambil semua item dari semua pengguna yang akan habis dalam 2 hari
-        expiring_items_query = db.collection_group('items').where('predictedShelfLife', '<=', 2)
-        expiring_items = expiring_items_query.stream()
-
-        # Cache token per user agar tidak query user doc berulang-ulang
-        token_cache: Dict[str, Optional[str]] = {}
+        now = datetime.now(timezone.utc)
+        # Item dengan trajektori: awal jendela <= EXPIRY_NOTIFY_DAYS hari sudah dihitung saat prediksi.
+        # Item lama tanpa trajektori: predictedShelfLife statis (duplikat dibuang per path); query ini
+        # juga cocok dengan item yang sudah dinotifikasi, jadi hanya dipakai sampai semua item dikonversi.
+        items = db.collection_group('items').select(
+            ['itemName', 'expiryNotifiedAt', 'predictedShelfLife', 'shelfLifeTrajectory']
+        )
+        expiring_items = items.where('expiryWindowAt', '<=', now).stream()
+        if _legacy_items_pending(db):
+            expiring_items = itertools.chain(
+                expiring_items, items.where('predictedShelfLife', '<=', EXPIRY_NOTIFY_DAYS).stream()
+            )
 
+        # owner uid -> [(sisa hari, itemName, item_ref)]
+        pending: Dict[str, List[Tuple[int, str, firestore.DocumentReference]]] = {}
+        seen = set()
+        already_notified = 0
         for item in expiring_items:
+            _metric_count("firestore_reads")
+            if item.reference.path in seen:
+                continue
+            seen.add(item.reference.path)
             item_data = item.to_dict() or {}
-            item_name = item_data.get('itemName', 'Item')
+            if item_data.get('expiryNotifiedAt') is not None:
+                already_notified += 1
+                continue
 
             # Dapatkan ID pemilik dari path dokumen (users/{uid}/items/{itemId})
             owner_ref = item.reference.parent.parent  # type: ignore[assignment]
             if owner_ref is None:
                 logging.warning("[FCM] Gagal temukan owner_ref untuk item %s", item.id)
                 continue
-            owner_id = owner_ref.id
-
-            if owner_id not in token_cache:
-                user_doc = db.collection('users').document(owner_id).get()
-                token_cache[owner_id] = (user_doc.to_dict() or {}).get('fcmToken') if user_doc.exists else None
-
-            token = token_cache.get(owner_id)
-            if not token:
-                logging.info(f"[FCM] Lewati {owner_id}: tidak ada fcmToken")
-                continue
-
-            # Buat dan kirim pesan notifikasi
-            msg = messaging.Message(
-                notification=messaging.Notification(
-                    title='Segera Habis!',
-                    body=f"Jangan lupa, {item_name} Anda akan segera habis masa simpannya. Yuk, segera diolah!",
-                ),
-                token=token,
+            pending.setdefault(owner_ref.id, []).append(
+                (_days_remaining(item_data, now) or 0, item_data.get('itemName', 'Item'), item.reference)
             )
+
+        tokens = _prefetch_fcm_tokens(db, list(pending))
+        digests = [(uid, tokens[uid]) for uid in pending if tokens.get(uid)]
+        sent = failed = marker_failed = 0
+
+        for start in range(0, len(digests), FCM_SEND_BATCH_SIZE):
+            chunk = digests[start:start + FCM_SEND_BATCH_SIZE]
+            notified_refs: List[firestore.DocumentReference] = []
+            messages = [
+                _expiry_digest_message(token, [name for _, name, _ in sorted(pending[uid], key=lambda e: e[0])])
+                for uid, token in chunk
+            ]
             try:
-                resp = messaging.send(msg)
-                logging.info(f"[FCM] Notifikasi terkirim ke {owner_id}: {resp}")
+                batch_resp = messaging.send_each(messages)
             except Exception as e:
-                logging.error(f"[FCM] Gagal mengirim notifikasi ke {owner_id}: {e}")
+                logging.error(f"[FCM] send_each gagal untuk {len(chunk)} pesan: {e}")
+                failed += len(chunk)
+                continue
+
+            for (uid, _), resp in zip(chunk, batch_resp.responses):
+                if not resp.success:
+                    failed += 1
+                    logging.warning(f"[FCM] Gagal mengirim notifikasi ke {uid}: {resp.exception}")
+                    continue
+                sent += 1
+                notified_refs.extend(item_ref for _, _, item_ref in pending[uid])
+            marker_failed += _mark_items_notified(db, notified_refs)
+
+        logging.info(
+            f"[FCM] Selesai. digest terkirim: {sent}, gagal: {failed}, "
+            f"tanpa fcmToken: {len(pending) - len(digests)}, item sudah dinotifikasi: {already_notified}, "
+            f"marker gagal: {marker_failed}"
+        )
 
     except Exception as e:
         logging.error(f"[FCM] Error saat query/pengiriman notifikasi: {e}")
@@ -538,10 +3185,93 @@ def check_expiring_items(event: scheduler_fn.ScheduledEvent) -> None:
 
 # ... (kode import dan fungsi notifikasi yang sudah ada) ...
 
+# ===============================
+# Helper: Cache pemilik perangkat IoT (deviceId -> ownerUid)
+# ===============================
+DEVICE_OWNER_TTL_SEC = float(os.getenv("DEVICE_OWNER_TTL_SEC", "300"))
+# Entri negatif (tidak terdaftar / belum di-claim) lebih pendek agar claim baru cepat terlihat
+DEVICE_OWNER_NEGATIVE_TTL_SEC = float(os.getenv("DEVICE_OWNER_NEGATIVE_TTL_SEC", "60"))
+# Cek version stamp iot_meta/ownership paling sering tiap N detik per instance
+DEVICE_OWNER_VERSION_CHECK_SEC = float(os.getenv("DEVICE_OWNER_VERSION_CHECK_SEC", "15"))
+
+DEVICE_UNKNOWN, DEVICE_UNCLAIMED, DEVICE_OWNED = "unknown", "unclaimed", "owned"
+
+# device_id -> (expires_at, state, owner_uid)
+_device_owner_cache: Dict[str, Tuple[float, str, Optional[str]]] = {}
+_device_owner_lock = threading.Lock()
+_device_owner_version: Optional[int] = None
+_device_owner_version_checked_at: float = 0.0
+_device_owner_stats: Dict[str, int] = {"hits": 0, "negative_hits": 0, "misses": 0, "invalidations": 0}
+
+def _ownership_meta_ref(db):
+    return db.collection("iot_meta").document("ownership")
+
+def _bump_ownership_version(transaction, db) -> None:
+    """Naikkan version stamp kepemilikan (dalam transaksi register/unregister)."""
+    transaction.set(_ownership_meta_ref(db), {
+        "version": firestore.Increment(1),
+        "updatedAt": firestore.SERVER_TIMESTAMP,
+    }, merge=True)
+
+def _invalidate_device_owner(device_id: Optional[str] = None) -> None:
+    """Buang satu entri (atau semua bila device_id None) dari cache pemilik perangkat."""
+    with _device_owner_lock:
+        if device_id is None:
+            _device_owner_cache.clear()
+        else:
+            _device_owner_cache.pop(device_id, None)
+        _device_owner_stats["invalidations"] += 1
+
+def _check_ownership_version(db) -> None:
+    """Kosongkan cache bila version stamp berubah (register/unregister di instance lain)."""
+    global _device_owner_version, _device_owner_version_checked_at
+    now = time.monotonic()
+    if now - _device_owner_version_checked_at < DEVICE_OWNER_VERSION_CHECK_SEC:
+        return
+    _device_owner_version_checked_at = now
+    try:
+        snap = _ownership_meta_ref(db).get()
+        version = (snap.to_dict() or {}).get("version", 0) if snap.exists else 0
+    except Exception as e:
+        logging.warning(f"[DeviceOwnerCache] version check failed: {e}")
+        return
+    if _device_owner_version is not None and version != _device_owner_version:
+        _invalidate_device_owner()
+    _device_owner_version = version
+
+def _resolve_device_owner(db, device_id: str) -> Tuple[str, Optional[str]]:
+    """Kembalikan (state, ownerUid) dengan state DEVICE_OWNED / DEVICE_UNCLAIMED / DEVICE_UNKNOWN."""
+    _check_ownership_version(db)
+    now = time.monotonic()
+    with _device_owner_lock:
+        cached = _device_owner_cache.get(device_id)
+        if cached is not None and cached[0] > now:
+            _device_owner_stats["hits" if cached[1] == DEVICE_OWNED else "negative_hits"] += 1
+            return cached[1], cached[2]
+        _device_owner_stats["misses"] += 1
+
+    device_doc = db.collection('iot_devices').document(device_id).get()
+    _metric_count("firestore_reads")
+    if not device_doc.exists:
+        state, owner_uid = DEVICE_UNKNOWN, None
+    else:
+        owner_uid = (device_doc.to_dict() or {}).get('ownerUid')
+        state = DEVICE_OWNED if owner_uid else DEVICE_UNCLAIMED
+
+    ttl = DEVICE_OWNER_TTL_SEC if state == DEVICE_OWNED else DEVICE_OWNER_NEGATIVE_TTL_SEC
+    with _device_owner_lock:
+        _device_owner_cache[device_id] = (now + ttl, state, owner_uid)
+    return state, owner_uid
+
+def _device_owner_cache_stats() -> Dict[str, int]:
+    with _device_owner_lock:
+        return dict(_device_owner_stats, size=len(_device_owner_cache))
+
 # ===============================
 # Cloud Function: Registrasi Perangkat IoT
 # ===============================
 @https_fn.on_call(region="asia-southeast2", memory=options.MemoryOption.MB_512)
+@_instrumented
 def registerDevice(req: https_fn.CallableRequest) -> Dict[str, any]:
     """
     Menghubungkan perangkat IoT ke akun pengguna yang sedang login.
@@ -581,9 +3311,11 @@ def registerDevice(req: https_fn.CallableRequest) -> Dict[str, any]:
             transaction.update(user_ref, {
                 'linkedDeviceId': device_id
             })
+            _bump_ownership_version(transaction, db)
         
         transaction = db.transaction()
         update_in_transaction(transaction, device_ref, user_ref)
+        _invalidate_device_owner(device_id)
         
         logging.info(f"Perangkat '{device_id}' berhasil terhubung dengan user '{uid}'")
         return {"status": "success", "message": "Perangkat berhasil terhubung!"}
@@ -597,6 +3329,7 @@ def registerDevice(req: https_fn.CallableRequest) -> Dict[str, any]:
 # Cloud Function: Menerima Data Sensor IoT
 # ===============================
 @https_fn.on_request(region="asia-southeast2")
+@_instrumented
 def ingestSensorData(req: https_fn.Request) -> https_fn.Response:
     """
     Endpoint HTTP untuk menerima data dari perangkat ESP32.
@@ -617,19 +3350,21 @@ def ingestSensorData(req: https_fn.Request) -> https_fn.Response:
 
         logging.info(f"Menerima data dari perangkat '{device_id}': Temp={temperature}, Humid={humidity}")
 
-        device_ref = db.collection('iot_devices').document(device_id)
-        device_doc = device_ref.get()
+        # Resolusi pemilik lewat cache TTL (tanpa read Firestore saat hit)
+        state, owner_uid = _resolve_device_owner(db, device_id)
+        stats = _device_owner_cache_stats()
+        if (stats["hits"] + stats["negative_hits"] + stats["misses"]) % 1000 == 0:
+            logging.info(f"[DeviceOwnerCache] {stats}")
 
-        if not device_doc.exists:
+        if state == DEVICE_UNKNOWN:
             return https_fn.Response("Perangkat tidak terdaftar.", status=404)
-        
-        owner_uid = device_doc.to_dict().get('ownerUid')
 
-        if not owner_uid:
+        if state == DEVICE_UNCLAIMED:
             return https_fn.Response("Perangkat belum terhubung dengan pengguna.", status=403)
             
         # Simpan data sensor ke path pengguna yang benar
         sensor_latest_ref = db.collection('users').document(owner_uid).collection('sensor_data').document('latest')
+        _metric_count("firestore_writes")
         sensor_latest_ref.set({
             'temperature': float(temperature),
             'humidity': float(humidity),
@@ -643,6 +3378,7 @@ def ingestSensorData(req: https_fn.Request) -> https_fn.Response:
         return https_fn.Response("Terjadi kesalahan internal.", status=500)
 
 @https_fn.on_call(region="asia-southeast2",)
+@_instrumented
 def unregisterDevice(req: https_fn.CallableRequest) -> Dict[str, any]:
     """
     Memutuskan hubungan perangkat IoT dari akun pengguna yang sedang login.
@@ -681,9 +3417,12 @@ def unregisterDevice(req: https_fn.CallableRequest) -> Dict[str, any]:
             transaction.update(user_ref, {
                 'linkedDeviceId': firestore.DELETE_FIELD
             })
+            # 3. Beri tahu cache pemilik perangkat di semua instance
+            _bump_ownership_version(transaction, db)
         
         transaction = db.transaction()
         update_in_transaction(transaction, device_ref, user_ref)
+        _invalidate_device_owner(device_id)
         
         logging.info(f"Perangkat '{device_id}' berhasil diputuskan dari user '{uid}'")
         return {"status": "success", "message": "Perangkat berhasil diputuskan!"}
@@ -692,3 +3431,206 @@ def unregisterDevice(req: https_fn.CallableRequest) -> Dict[str, any]:
         logging.error(f"Gagal memutuskan perangkat untuk user '{uid}': {e}")
         raise https_fn.HttpsError(code="internal", message=f"Terjadi kesalahan: {e}")
 
+
+# ===============================
+# Helper: Ingest batch sensor (buffer ESP32)
+# ===============================
+# Perangkat yang menyangga bacaan (offline / hemat daya) mengirim banyak bacaan sekaligus,
+# masing-masing dengan timestamp perangkat. Satu transaksi menulis semua bucket jam yang
+# tersentuh, agregat per jam, dan 'latest' sekali (bacaan terbaru) dengan historyLogged=True
+# sehingga log_sensor_data_to_history tidak menambahkannya lagi. Per batch: 1 request +
+# 2 invocation trigger, bukan 1 request + 2 invocation per bacaan.
+#
+# Body JSON:  {"deviceId": "...", "readings": [{"ts": epoch_detik, "temperature": t, "humidity": h}, ...]}
+#             (readings juga boleh [[ts, t, h], ...])
+# Body biner (Content-Type: application/octet-stream, little-endian, 6 byte per bacaan):
+#   "FL" | versi u8 (=1) | panjang deviceId u8 | deviceId utf-8 | baseTs u32 epoch detik | count u16
+#   lalu count x (offset u16 detik dari baseTs | suhu i16 per 0.01 °C | RH u16 per 0.01 %)
+# Kirim ulang batch yang sama aman: bacaan dengan ts yang sudah ada di bucket dilewati.
+SENSOR_BATCH_MAX_READINGS = int(os.getenv("SENSOR_BATCH_MAX_READINGS", "1000"))
+SENSOR_BATCH_MAX_CLOCK_SKEW_SEC = float(os.getenv("SENSOR_BATCH_MAX_CLOCK_SKEW_SEC", "300"))
+
+_PACKED_MAGIC = b"FL"
+_PACKED_VERSION = 1
+_PACKED_HEADER = struct.Struct("<2sBB")
+_PACKED_BASE = struct.Struct("<IH")
+_PACKED_READING = struct.Struct("<HhH")
+
+def _parse_json_batch(payload) -> Tuple[str, List[Tuple[float, float, float]]]:
+    """(deviceId, [(ts, suhu, RH)]) dari body JSON; ValueError/TypeError bila formatnya salah."""
+    if not isinstance(payload, dict):
+        raise ValueError("body harus objek JSON")
+    device_id, readings = payload.get("deviceId"), payload.get("readings")
+    if not device_id or not isinstance(readings, list):
+        raise ValueError("deviceId dan readings (array) wajib diisi")
+    parsed = []
+    for r in readings:
+        if isinstance(r, dict):
+            ts, t, h = r.get("ts"), r.get("temperature"), r.get("humidity")
+        elif isinstance(r, list) and len(r) == 3:
+            ts, t, h = r
+        else:
+            raise ValueError("bacaan harus {ts, temperature, humidity} atau [ts, temperature, humidity]")
+        if ts is None or t is None or h is None:
+            raise ValueError("ts, temperature, dan humidity wajib diisi")
+        parsed.append((float(ts), float(t), float(h)))
+    return str(device_id), parsed
+
+def _parse_packed_batch(body: bytes) -> Tuple[str, List[Tuple[float, float, float]]]:
+    """(deviceId, [(ts, suhu, RH)]) dari body biner packed (lihat format di atas)."""
+    if len(body) < _PACKED_HEADER.size:
+        raise ValueError("body biner terlalu pendek")
+    magic, version, id_len = _PACKED_HEADER.unpack_from(body, 0)
+    if magic != _PACKED_MAGIC or version != _PACKED_VERSION:
+        raise ValueError("header biner tidak dikenali")
+    offset = _PACKED_HEADER.size + id_len
+    if id_len == 0 or len(body) < offset + _PACKED_BASE.size:
+        raise ValueError("body biner terlalu pendek")
+    device_id = body[_PACKED_HEADER.size:offset].decode("utf-8")
+    base_ts, count = _PACKED_BASE.unpack_from(body, offset)
+    offset += _PACKED_BASE.size
+    if len(body) != offset + count * _PACKED_READING.size:
+        raise ValueError("panjang body tidak sesuai jumlah bacaan")
+    return device_id, [
+        (float(base_ts + dt), t / 100.0, h / 100.0)
+        for dt, t, h in _PACKED_READING.iter_unpack(body[offset:])
+    ]
+
+def _normalize_batch_readings(readings: List[Tuple[float, float, float]],
+                              now: datetime) -> Tuple[List[Tuple[float, float, float]], int]:
+    """Urutkan per ts & dedupe ts ganda dalam batch (yang terakhir menang); tolak bacaan non-finite,
+    di masa depan (> clock skew), atau lebih tua dari retensi bucket mentah. -> (bacaan, ditolak)"""
+    oldest = _hour_start(now - timedelta(hours=SENSOR_HISTORY_RAW_RETENTION_HOURS)).timestamp()
+    newest = now.timestamp() + SENSOR_BATCH_MAX_CLOCK_SKEW_SEC
+    by_ts: Dict[float, Tuple[float, float]] = {}
+    rejected = 0
+    for ts, t, h in readings:
+        if not (math.isfinite(ts) and math.isfinite(t) and math.isfinite(h)) or not oldest <= ts <= newest:
+            rejected += 1
+            continue
+        by_ts[round(ts, 3)] = (t, h)
+    return [(ts, t, h) for ts, (t, h) in sorted(by_ts.items())], rejected
+
+def _write_sensor_batch(db, uid: str, readings: List[Tuple[float, float, float]], now: datetime) -> Dict[str, object]:
+    """Satu transaksi: merge bacaan (terurut) ke bucket jamnya, agregat per jam untuk bacaan baru,
+    lalu 'latest' sekali bila bacaan terbaru batch lebih baru dari isi 'latest' sekarang."""
+    by_hour: Dict[str, List[Tuple[float, float, float]]] = {}
+    for reading in readings:
+        by_hour.setdefault(_hour_bucket_key(datetime.fromtimestamp(reading[0], timezone.utc)), []).append(reading)
+    buckets_ref = _sensor_hour_buckets_ref(db, uid)
+    bucket_refs = {key: buckets_ref.document(key) for key in by_hour}
+    latest_ref = db.collection("users").document(uid).collection("sensor_data").document("latest")
+    agg_ref = _sensor_aggregate_ref(db, uid)
+    agg_first_key = _aggregate_first_key(now)
+    writes = 0
+
+    @firestore.transactional
+    def commit(transaction) -> Dict[str, object]:
+        nonlocal writes
+        snaps = {
+            snap.reference.path: snap
+            for snap in db.get_all(
+                list(bucket_refs.values()) + [latest_ref, agg_ref],
+                field_paths=["ts", "temperature", "humidity", "readingAt", "lastUpdate", "buckets"],
+                transaction=transaction,
+            )
+        }
+        accepted = duplicates = hours = 0
+        agg_buckets: Dict[str, object] = {}
+        for key, rows in by_hour.items():
+            ref = bucket_refs[key]
+            snap = snaps.get(ref.path)
+            data = (snap.to_dict() or {}) if snap is not None and snap.exists else {}
+            existing = list(zip(data.get("ts") or [], data.get("temperature") or [], data.get("humidity") or []))
+            seen = {ts for ts, _, _ in existing}
+            new = [r for r in rows if r[0] not in seen]
+            duplicates += len(rows) - len(new)
+            if not new:
+                continue
+            merged = sorted(existing + new, key=lambda r: r[0])
+            transaction.set(ref, {
+                "hourStart": _hour_start(datetime.fromtimestamp(new[0][0], timezone.utc)),
+                "ts": [r[0] for r in merged],
+                "temperature": [r[1] for r in merged],
+                "humidity": [r[2] for r in merged],
+                "source": "iot-batch",
+                "updatedAt": firestore.SERVER_TIMESTAMP,
+            })
+            accepted += len(new)
+            hours += 1
+            if key >= agg_first_key:
+                agg_buckets[key] = _aggregate_bucket_fields([r[1] for r in new], [r[2] for r in new])
+
+        agg = snaps.get(agg_ref.path)
+        expired = _aggregate_expired_buckets((agg.to_dict() or {}) if agg is not None and agg.exists else {}, now)
+        if agg_buckets or expired:
+            agg_buckets.update(expired)
+            transaction.set(agg_ref, {
+                "buckets": agg_buckets,
+                "updatedAt": firestore.SERVER_TIMESTAMP,
+            }, merge=True)
+
+        newest_ts, newest_t, newest_h = readings[-1]
+        newest_at = datetime.fromtimestamp(newest_ts, timezone.utc)
+        latest = snaps.get(latest_ref.path)
+        latest_data = (latest.to_dict() or {}) if latest is not None and latest.exists else {}
+        latest_at = latest_data.get("readingAt") or latest_data.get("lastUpdate")
+        latest_updated = accepted > 0 and not (isinstance(latest_at, datetime) and latest_at >= newest_at)
+        if latest_updated:
+            transaction.set(latest_ref, {
+                "temperature": newest_t,
+                "humidity": newest_h,
+                "readingAt": newest_at,
+                "lastUpdate": firestore.SERVER_TIMESTAMP,
+                "historyLogged": True,
+            })
+        writes = hours + bool(agg_buckets) + latest_updated
+        return {"accepted": accepted, "duplicates": duplicates, "hours": hours, "latestUpdated": latest_updated}
+
+    result = commit(db.transaction())
+    _metric_count("firestore_reads", len(bucket_refs) + 2)
+    _metric_count("firestore_writes", writes)
+    return result
+
+# ===============================
+# Cloud Function: Menerima Batch Data Sensor IoT
+# ===============================
+@https_fn.on_request(region="asia-southeast2")
+@_instrumented
+def ingestSensorBatch(req: https_fn.Request) -> https_fn.Response:
+    """
+    Endpoint HTTP batch untuk ESP32 yang menyangga bacaan: JSON array atau biner packed.
+    """
+    if req.method != "POST":
+        return https_fn.Response("Metode tidak diizinkan", status=405)
+
+    try:
+        if req.mimetype == "application/octet-stream":
+            device_id, readings = _parse_packed_batch(req.get_data())
+        else:
+            device_id, readings = _parse_json_batch(req.get_json(force=True, silent=True))
+    except (ValueError, TypeError) as e:
+        return https_fn.Response(f"Batch tidak valid: {e}", status=400)
+    if len(readings) > SENSOR_BATCH_MAX_READINGS:
+        return https_fn.Response(f"Batch melebihi {SENSOR_BATCH_MAX_READINGS} bacaan.", status=413)
+
+    try:
+        db = firestore.client()
+        state, owner_uid = _resolve_device_owner(db, device_id)
+        if state == DEVICE_UNKNOWN:
+            return https_fn.Response("Perangkat tidak terdaftar.", status=404)
+        if state == DEVICE_UNCLAIMED:
+            return https_fn.Response("Perangkat belum terhubung dengan pengguna.", status=403)
+
+        now = datetime.now(timezone.utc)
+        valid, rejected = _normalize_batch_readings(readings, now)
+        result: Dict[str, object] = {"accepted": 0, "duplicates": 0, "hours": 0, "latestUpdated": False}
+        if valid:
+            result = _write_sensor_batch(db, owner_uid, valid, now)
+        result["rejected"] = rejected
+        logging.info(f"[SensorBatch] device={device_id} uid={owner_uid} received={len(readings)} {result}")
+        return https_fn.Response(json.dumps(result), status=200, mimetype="application/json")
+
+    except Exception as e:
+        logging.error(f"[SensorBatch] Error saat memproses batch sensor: {e}")
+        return https_fn.Response("Terjadi kesalahan internal.", status=500)
@@ -0,0 +1,465 @@
+# functions/manage.py
+#
+# Perintah admin lokal untuk operasi data FreshLens.
+# Jalankan dari folder functions dengan kredensial admin (GOOGLE_APPLICATION_CREDENTIALS):
+#   python manage.py rebuild-sensor-aggregates [--uid UID ...]
+#   python manage.py check-sensor-aggregates [--uid UID ...]
+#   python manage.py migrate-sensor-history [--uid UID ...] [--delete-entries]
+#   python manage.py compact-sensor-history [--uid UID ...]
+#   python manage.py build-shelflife-grid [--model freshlens_lgbm.txt] [--out freshlens_grid.npy] [--upload gs://...]
+#   python manage.py export-scoring-data [--uid UID ...] [--items-out items.jsonl] [--sensors-out sensor_history.jsonl]
+#   python manage.py score-export --items items.jsonl --sensors sensor_history.jsonl [--model freshlens_lgbm.txt]
+#                                 [--out scores.parquet] [--workers N] [--write-back]
+
+import os
+import sys
+import csv
+import gzip
+import json
+import time
+import logging
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from firebase_admin import firestore, storage
+
+import main
+
+
+def _iter_uids(uids: List[str]) -> Iterable[str]:
+    """UID eksplisit dari argumen, atau semua user bila kosong."""
+    if uids:
+        yield from uids
+        return
+    for u in firestore.client().collection("users").select([]).stream():
+        yield u.id
+
+
+def cmd_rebuild_sensor_aggregates(args: argparse.Namespace) -> int:
+    total = 0
+    for uid in _iter_uids(args.uid):
+        n = main._rebuild_sensor_aggregate(uid)
+        total += n
+        logging.info(f"[Manage] aggregate rebuilt uid={uid} entries={n}")
+    logging.info(f"[Manage] Done. Total entries: {total}")
+    return 0
+
+
+def cmd_check_sensor_aggregates(args: argparse.Namespace) -> int:
+    mismatches = 0
+    for uid in _iter_uids(args.uid):
+        report = main._check_sensor_aggregate(uid, hours=args.hours, tolerance=args.tolerance)
+        print(json.dumps(report, default=str))
+        if not report["consistent"]:
+            mismatches += 1
+    logging.info(f"[Manage] Done. Inconsistent users: {mismatches}")
+    return 1 if mismatches else 0
+
+
+def cmd_migrate_sensor_history(args: argparse.Namespace) -> int:
+    total = 0
+    for uid in _iter_uids(args.uid):
+        n = main._migrate_sensor_history(uid, delete_entries=args.delete_entries)
+        total += n
+        logging.info(f"[Manage] history migrated uid={uid} entries={n}")
+    logging.info(f"[Manage] Done. Total entries: {total} (deleted: {args.delete_entries})")
+    return 0
+
+
+def cmd_compact_sensor_history(args: argparse.Namespace) -> int:
+    db = firestore.client()
+    now = datetime.now(timezone.utc)
+    for uid in _iter_uids(args.uid):
+        report = main._compact_sensor_history(db, uid, now)
+        print(json.dumps({"uid": uid, **report}))
+    return 0
+
+
+def _range(value: str):
+    lo, hi = (float(v) for v in value.split(","))
+    return lo, hi
+
+
+def _read_model_text(path: Optional[str]) -> str:
+    """Teks model dari file lokal, atau unduh MODEL_BLOB_PATH dari Storage bila path kosong."""
+    if path:
+        with open(path, "r", encoding="utf-8") as f:
+            return f.read()
+    blob = storage.bucket(main.DEFAULT_BUCKET).get_blob(main.MODEL_BLOB_PATH)
+    return blob.download_as_bytes(if_generation_match=blob.generation).decode("utf-8")
+
+
+def cmd_build_shelflife_grid(args: argparse.Namespace) -> int:
+    model_str = _read_model_text(args.model)
+    booster = main._parse_model(model_str)
+    meta = main._shelflife_grid_meta(model_str, args.temp_range, args.temp_step, args.humid_range, args.humid_step)
+    shape = (main._GRID_COMBOS, len(meta["day_rep"]), meta["temp"]["count"], meta["humid"]["count"])
+    logging.info(f"[Manage] grid shape={shape} day_classes={shape[1]} size={4 * shape[0] * shape[1] * shape[2] * shape[3] / 1e6:.1f}MB")
+
+    def progress(done: int, total: int) -> None:
+        if done % 10 == 0 or done == total:
+            logging.info(f"[Manage] grid combos {done}/{total}")
+
+    values = main._build_shelflife_grid(booster, meta, progress)
+    main._save_shelflife_grid(args.out, values, meta)
+    logging.info(f"[Manage] grid saved {args.out} (+ {main._grid_meta_path(args.out)})")
+
+    if args.upload:
+        bucket_name, _, blob_path = args.upload[len("gs://"):].partition("/")
+        bucket = storage.bucket(bucket_name)
+        # Metadata dulu: instance yang melihat .npy baru pasti menemukan .json yang cocok
+        bucket.blob(main._grid_meta_path(blob_path)).upload_from_filename(main._grid_meta_path(args.out))
+        bucket.blob(blob_path).upload_from_filename(args.out)
+        logging.info(f"[Manage] grid uploaded {args.upload}")
+    return 0
+
+# ---- Ekspor & skor offline (backfill / rollout model)
+# Format ekspor (JSONL, boleh .gz; atau Parquet dengan kolom yang sama bila pyarrow terpasang):
+#   items:   {"uid", "itemId", <field dokumen item>}; timestamp sebagai ISO-8601 atau epoch detik
+#   sensors: {"uid", "ts", "temperature", "humidity"}; nilai skalar (satu bacaan) atau array
+#            sejajar (dokumen bucket jam apa adanya). Baris {"uid", "latest": true, ...} = sensor_data/latest.
+_EXPORT_TIMESTAMP_FIELDS = ("entryDate", "predictionUpdatedAt", "nextRecomputeAt", "expiryNotifiedAt",
+                            "predictedExpiryAt", "expiryWindowAt")
+
+
+def _export_value(value):
+    if isinstance(value, datetime):
+        return value.astimezone(timezone.utc).isoformat()
+    if isinstance(value, dict):
+        return {k: _export_value(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_export_value(v) for v in value]
+    return value
+
+
+def _import_timestamp(value) -> Optional[datetime]:
+    if value is None or isinstance(value, datetime):
+        return value if value is None or value.tzinfo else value.replace(tzinfo=timezone.utc)
+    if isinstance(value, (int, float)):
+        return datetime.fromtimestamp(value, timezone.utc)
+    dt = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    return dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
+
+
+def _import_item(row: Dict) -> Tuple[str, str, Dict]:
+    """Baris ekspor -> (uid, itemId, data item dengan timestamp sebagai datetime UTC)."""
+    data = dict(row)
+    uid, item_id = data.pop("uid"), data.pop("itemId")
+    for field in _EXPORT_TIMESTAMP_FIELDS:
+        if data.get(field) is not None:
+            data[field] = _import_timestamp(data[field])
+    trajectory = data.get("shelfLifeTrajectory")
+    if isinstance(trajectory, dict) and trajectory.get("startAt") is not None:
+        data["shelfLifeTrajectory"] = {**trajectory, "startAt": _import_timestamp(trajectory["startAt"])}
+    return uid, item_id, data
+
+
+def _read_rows(path: str, batch_size: int = 10000) -> Iterator[Dict]:
+    """Stream baris dari JSONL(.gz) atau Parquet (per row group/batch, memori terbatas)."""
+    if path.endswith(".parquet"):
+        import pyarrow.parquet as pq
+
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=batch_size):
+            yield from batch.to_pylist()
+        return
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def _write_jsonl(path: str, rows: Iterable[Dict]) -> int:
+    opener = gzip.open if path.endswith(".gz") else open
+    n = 0
+    with opener(path, "wt", encoding="utf-8") as f:
+        for row in rows:
+            f.write(json.dumps(_export_value(row)) + "\n")
+            n += 1
+    return n
+
+
+def cmd_export_scoring_data(args: argparse.Namespace) -> int:
+    db = firestore.client()
+    since = datetime.now(timezone.utc) - timedelta(hours=args.hours)
+    uids = list(_iter_uids(args.uid))
+
+    def item_rows():
+        for uid in uids:
+            items_ref = db.collection("users").document(uid).collection("items")
+            for item in items_ref.select(main._ITEM_SCORING_FIELDS).stream():
+                yield {"uid": uid, "itemId": item.id, **(item.to_dict() or {})}
+
+    def sensor_rows():
+        for uid in uids:
+            latest = db.collection("users").document(uid).collection("sensor_data").document("latest").get()
+            if latest.exists:
+                data = latest.to_dict() or {}
+                yield {"uid": uid, "latest": True, "temperature": data.get("temperature"), "humidity": data.get("humidity")}
+            query = main._sensor_hour_buckets_ref(db, uid).where("hourStart", ">=", main._hour_start(since))
+            for bucket in query.stream():
+                data = bucket.to_dict() or {}
+                yield {"uid": uid, "ts": data.get("ts") or [], "temperature": data.get("temperature") or [],
+                       "humidity": data.get("humidity") or []}
+
+    n_items = _write_jsonl(args.items_out, item_rows())
+    n_sensor = _write_jsonl(args.sensors_out, sensor_rows())
+    logging.info(f"[Manage] exported users={len(uids)} items={n_items} -> {args.items_out}, "
+                 f"sensor rows={n_sensor} -> {args.sensors_out}")
+    return 0
+
+
+def _offline_sensor_statistics(path: str, as_of: datetime, hours: int = 24) -> Dict[str, Dict[str, float]]:
+    """
+    Statistik sensor per uid dari ekspor, dengan logika jalur agregat _fetch_sensor_statistics:
+    bucket jam >= jam(as_of - hours) -> rata-rata & std rata-rata per jam, fallback latest, default.
+    """
+    start_time = as_of - timedelta(hours=hours)
+    start_epoch = main._hour_start(start_time).timestamp()
+    end_epoch = as_of.timestamp()
+    buckets: Dict[str, Dict[str, Dict[str, float]]] = {}
+    latest: Dict[str, Dict] = {}
+    for row in _read_rows(path):
+        uid = row["uid"]
+        if row.get("latest"):
+            latest[uid] = row
+            continue
+        ts, temps, humids = row.get("ts"), row.get("temperature"), row.get("humidity")
+        if not isinstance(ts, list):
+            ts, temps, humids = [ts], [temps], [humids]
+        readings = [
+            (t, tv, hv) for t, tv, hv in zip((_import_timestamp(t).timestamp() for t in ts), temps, humids)
+            if start_epoch <= t <= end_epoch
+        ]
+        main._add_to_aggregate_buckets(buckets.setdefault(uid, {}), readings)
+
+    stats: Dict[str, Dict[str, float]] = {}
+    for uid in set(buckets) | set(latest):
+        agg_data = {"buckets": buckets.get(uid, {})}
+        temps, humids = main._aggregate_window_means(agg_data, start_time)
+        spread = main._aggregate_window_spread(agg_data, start_time)
+        fallback = latest.get(uid) if not temps or not humids else None
+        stats[uid] = main._sensor_statistics_from(temps, humids, spread, fallback)
+    return stats
+
+
+_SCORE_COLUMNS = [
+    ("uid", "string"), ("itemId", "string"), ("predictedShelfLife", "int32"), ("previousShelfLife", "int32"),
+    ("predictedExpiryAt", "timestamp"), ("expiryWindowAt", "timestamp"), ("nextRecomputeAt", "timestamp"),
+    ("trajectoryStartAt", "timestamp"), ("trajectoryDays", "list"), ("avgTemp", "float64"),
+    ("avgHumid", "float64"), ("fingerprint", "string"), ("noop", "bool"), ("error", "string"),
+]
+_score_booster = None
+
+
+def _init_score_worker(model_str: str, grid_path: Optional[str]) -> None:
+    global _score_booster
+    _score_booster = main._parse_model(model_str)
+    if grid_path:
+        # Jalur serving yang sama: grid dipakai hanya bila sha model cocok, miss -> booster
+        main._booster_cache, main._booster_sha256 = _score_booster, main._model_sha256(model_str)
+        main.SHELFLIFE_GRID_PATH = grid_path if grid_path.startswith("gs://") else os.path.abspath(grid_path)
+
+
+def _score_chunk(rows: List[Tuple[str, str, Dict]], stats_by_uid: Dict[str, Dict[str, float]],
+                 as_of: datetime) -> Tuple[Dict[str, List], List[Optional[Dict]]]:
+    """Skor satu chunk di worker -> (kolom hasil, fields per item untuk write-back)."""
+    entries = [(uid, data) for uid, _, data in rows]
+    results = main._score_items(_score_booster, entries, as_of, stats_by_uid)
+    cols: Dict[str, List] = {name: [] for name, _ in _SCORE_COLUMNS}
+    for (uid, item_id, data), (fields, err, fingerprint) in zip(rows, results):
+        stats = stats_by_uid.get(uid) or main._sensor_statistics_from([], [], None, None)
+        previous = main._days_remaining(data, as_of)
+        fields = fields or {}
+        trajectory = fields.get("shelfLifeTrajectory") or {}
+        for name, value in (
+            ("uid", uid), ("itemId", item_id), ("predictedShelfLife", fields.get("predictedShelfLife")),
+            ("previousShelfLife", int(previous) if isinstance(previous, (int, float)) else None),
+            ("predictedExpiryAt", fields.get("predictedExpiryAt")), ("expiryWindowAt", fields.get("expiryWindowAt")),
+            ("nextRecomputeAt", fields.get("nextRecomputeAt")), ("trajectoryStartAt", trajectory.get("startAt")),
+            ("trajectoryDays", trajectory.get("days")), ("avgTemp", stats["avg_temp"]), ("avgHumid", stats["avg_humid"]),
+            ("fingerprint", fingerprint), ("noop", err is None and main._is_noop_prediction(data, fingerprint, as_of)),
+            ("error", str(err) if err is not None else None),
+        ):
+            cols[name].append(value)
+    return cols, [fields or None for fields, _, _ in results]
+
+
+class _ScoreOutput:
+    """Tulis kolom hasil per chunk: Parquet (row group per chunk) bila pyarrow ada, selain itu CSV."""
+
+    def __init__(self, path: str, fmt: str):
+        if fmt == "auto":
+            try:
+                import pyarrow  # noqa: F401
+                fmt = "parquet"
+            except ImportError:
+                fmt = "csv"
+        if fmt == "parquet":
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            types = {"string": pa.string(), "int32": pa.int32(), "float64": pa.float64(), "bool": pa.bool_(),
+                     "timestamp": pa.timestamp("us", tz="UTC"), "list": pa.list_(pa.int16())}
+            self._pa = pa
+            self._schema = pa.schema([(name, types[t]) for name, t in _SCORE_COLUMNS])
+            self._writer = pq.ParquetWriter(path, self._schema)
+        else:
+            if path.endswith(".parquet"):
+                path = path[: -len(".parquet")] + ".csv"
+                logging.warning(f"[Manage] pyarrow tidak terpasang; hasil ditulis sebagai CSV: {path}")
+            self._file = open(path, "w", newline="", encoding="utf-8")
+            self._writer = csv.writer(self._file)
+            self._writer.writerow([name for name, _ in _SCORE_COLUMNS])
+        self.format, self.path = fmt, path
+
+    def write(self, cols: Dict[str, List]) -> None:
+        if self.format == "parquet":
+            self._writer.write_table(self._pa.Table.from_pydict(cols, schema=self._schema))
+            return
+        for row in zip(*(cols[name] for name, _ in _SCORE_COLUMNS)):
+            self._writer.writerow([
+                v.isoformat() if isinstance(v, datetime) else ",".join(map(str, v)) if isinstance(v, list) else v
+                for v in row
+            ])
+
+    def close(self) -> None:
+        (self._writer if self.format == "parquet" else self._file).close()
+
+
+def _chunked(rows: Iterable, size: int) -> Iterator[List]:
+    chunk: List = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def cmd_score_export(args: argparse.Namespace) -> int:
+    t0 = time.perf_counter()
+    as_of = _import_timestamp(args.as_of) if args.as_of else datetime.now(timezone.utc)
+    model_str = _read_model_text(args.model)
+    stats = _offline_sensor_statistics(args.sensors, as_of)
+    logging.info(f"[Manage] sensor stats users={len(stats)} ({time.perf_counter() - t0:.1f}s)")
+
+    workers = args.workers or os.cpu_count() or 1
+    out = _ScoreOutput(args.out, args.format)
+    db = firestore.client() if args.write_back else None
+    writer = main._PredictionWriter(db, "ScoreExport") if args.write_back else None
+    summary = {"rows": 0, "errors": 0, "noop": 0, "changed": 0, "deltaMax": 0}
+    pending: deque = deque()
+
+    def drain_one() -> None:
+        future, rows = pending.popleft()
+        cols, fields_list = future.result()
+        out.write(cols)
+        summary["rows"] += len(rows)
+        for r, (new, old, err, noop) in enumerate(zip(cols["predictedShelfLife"], cols["previousShelfLife"],
+                                                      cols["error"], cols["noop"])):
+            if err is not None:
+                summary["errors"] += 1
+                continue
+            summary["noop"] += int(noop)
+            if old is not None and new != old:
+                summary["changed"] += 1
+                summary["deltaMax"] = max(summary["deltaMax"], abs(new - old))
+            if writer is not None:
+                uid, item_id, data = rows[r]
+                update, noop = main._prediction_update(data, fields_list[r], cols["fingerprint"][r], args.status, as_of)
+                if noop:
+                    writer.skip()
+                if update is not None:
+                    writer.update(db.collection("users").document(uid).collection("items").document(item_id), update)
+        if writer is not None:
+            writer.wait_if_backlogged(main.PREDICTION_WRITE_OPS_PER_SEC * 4)
+
+    # In-flight dibatasi 2 chunk per worker -> memori tetap terbatas untuk ekspor sebesar apa pun
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_score_worker,
+                             initargs=(model_str, args.grid)) as pool:
+        for chunk in _chunked((_import_item(row) for row in _read_rows(args.items)), args.chunk_size):
+            uids = {uid for uid, _, _ in chunk}
+            future = pool.submit(_score_chunk, chunk, {u: stats[u] for u in uids if u in stats}, as_of)
+            # Data item hanya disimpan untuk write-back
+            pending.append((future, chunk if writer is not None else [None] * len(chunk)))
+            if len(pending) >= 2 * workers:
+                drain_one()
+        while pending:
+            drain_one()
+    out.close()
+
+    if writer is not None:
+        summary["writeBack"] = writer.close()
+    elapsed = time.perf_counter() - t0
+    summary.update({"workers": workers, "seconds": round(elapsed, 2),
+                    "rowsPerSec": round(summary["rows"] / max(elapsed, 1e-9), 1), "out": out.path})
+    print(json.dumps(summary))
+    return 1 if summary["errors"] else 0
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Perintah admin FreshLens")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("rebuild-sensor-aggregates", help="Backfill dokumen agregat sensor dari history mentah")
+    p.add_argument("--uid", action="append", default=[], help="Batasi ke UID tertentu (boleh berulang)")
+    p.set_defaults(func=cmd_rebuild_sensor_aggregates)
+
+    p = sub.add_parser("check-sensor-aggregates", help="Bandingkan agregat dengan np.mean atas history mentah")
+    p.add_argument("--uid", action="append", default=[], help="Batasi ke UID tertentu (boleh berulang)")
+    p.add_argument("--hours", type=int, default=24)
+    p.add_argument("--tolerance", type=float, default=1e-6, help="Toleransi relatif selisih rata-rata")
+    p.set_defaults(func=cmd_check_sensor_aggregates)
+
+    p = sub.add_parser("migrate-sensor-history", help="Konversi history/entries lama ke bucket per jam")
+    p.add_argument("--uid", action="append", default=[], help="Batasi ke UID tertentu (boleh berulang)")
+    p.add_argument("--delete-entries", action="store_true", help="Hapus dokumen entries lama setelah konversi")
+    p.set_defaults(func=cmd_migrate_sensor_history)
+
+    p = sub.add_parser("compact-sensor-history", help="Jalankan kompaksi bucket jam -> ringkasan harian sekarang")
+    p.add_argument("--uid", action="append", default=[], help="Batasi ke UID tertentu (boleh berulang)")
+    p.set_defaults(func=cmd_compact_sensor_history)
+
+    p = sub.add_parser("build-shelflife-grid", help="Evaluasi booster di grid item x kondisi x penyimpanan x hari x suhu x RH")
+    p.add_argument("--model", default=None, help="File model LightGBM (teks); default unduh dari Storage")
+    p.add_argument("--out", default="freshlens_grid.npy", help="Path .npy keluaran (metadata ke .json sebelahnya)")
+    p.add_argument("--temp-range", type=_range, default=(0.0, 40.0), help="Rentang suhu min,max (°C)")
+    p.add_argument("--temp-step", type=float, default=main.FINGERPRINT_TEMP_STEP)
+    p.add_argument("--humid-range", type=_range, default=(30.0, 100.0), help="Rentang RH min,max (%%)")
+    p.add_argument("--humid-step", type=float, default=main.FINGERPRINT_HUMID_STEP)
+    p.add_argument("--upload", default=None, help="Unggah ke gs://bucket/path.npy (set SHELFLIFE_GRID_PATH ke URI ini)")
+    p.set_defaults(func=cmd_build_shelflife_grid)
+
+    p = sub.add_parser("export-scoring-data", help="Ekspor item + history sensor ke JSONL untuk score-export")
+    p.add_argument("--uid", action="append", default=[], help="Batasi ke UID tertentu (boleh berulang)")
+    p.add_argument("--items-out", default="items.jsonl")
+    p.add_argument("--sensors-out", default="sensor_history.jsonl")
+    p.add_argument("--hours", type=int, default=25, help="Window history sensor yang diekspor (jam)")
+    p.set_defaults(func=cmd_export_scoring_data)
+
+    p = sub.add_parser("score-export", help="Skor ekspor item secara offline (multi-core), opsional tulis balik")
+    p.add_argument("--items", required=True, help="Ekspor item (.jsonl, .jsonl.gz, .parquet)")
+    p.add_argument("--sensors", required=True, help="Ekspor history sensor (.jsonl, .jsonl.gz, .parquet)")
+    p.add_argument("--model", default=None, help="File model LightGBM (teks); default unduh dari Storage")
+    p.add_argument("--out", default="scores.parquet", help="Hasil kolumnar (.parquet; fallback .csv tanpa pyarrow)")
+    p.add_argument("--format", choices=["auto", "parquet", "csv"], default="auto")
+    p.add_argument("--grid", default=None, help="Grid umur simpan (.npy lokal / gs://) dari build-shelflife-grid")
+    p.add_argument("--as-of", default=None, help="Waktu skor ISO-8601 (default sekarang)")
+    p.add_argument("--workers", type=int, default=0, help="Jumlah proses (default semua core)")
+    p.add_argument("--chunk-size", type=int, default=5000)
+    p.add_argument("--write-back", action="store_true", help="Tulis hasil ke Firestore via BulkWriter (lewati no-op)")
+    p.add_argument("--status", default="ok", help="predictionStatus untuk item yang ditulis balik")
+    p.set_defaults(func=cmd_score_export)
+
+    return parser
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    args = build_parser().parse_args()
+    sys.exit(args.func(args))
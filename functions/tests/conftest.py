@@ -0,0 +1,9 @@
+# functions/tests/conftest.py
+#
+# Jalankan dari folder functions:
+#   pip install -r requirements-dev.txt
+#   python -m pytest -q
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,52 @@
+# Paritas _FeatureEncoder (batch) vs _feature_row (referensi per item), termasuk baris error.
+import random
+from datetime import datetime, timezone
+
+import numpy as np
+
+import bench
+import main
+
+
+def _reference(docs, temps, humids, now):
+    rows, errors = [], []
+    for doc, t, h in zip(docs, temps, humids):
+        try:
+            row = main._feature_row(doc, {"avg_temp": t, "avg_humid": h}, now)
+        except Exception:
+            rows.append([0] * len(main.TRAINING_COLUMNS))
+            errors.append(True)
+            continue
+        rows.append([row[c] for c in main.TRAINING_COLUMNS])
+        errors.append(False)
+    return np.array(rows, dtype=np.float32), errors
+
+
+def test_encoder_matches_feature_row():
+    now = datetime.now(timezone.utc)
+    docs = bench._random_item_docs(5_000, now)
+    rnd = random.Random(1)
+    temps = [rnd.uniform(0, 40) for _ in docs]
+    humids = [rnd.uniform(20, 100) for _ in docs]
+
+    expected, ref_errors = _reference(docs, temps, humids, now)
+    got, errors = main._FEATURE_ENCODER.encode(docs, temps, humids, now)
+
+    assert [e is not None for e in errors] == ref_errors
+    assert any(ref_errors), "data uji harus memuat item error (itemName bukan string)"
+    ok = ~np.array(ref_errors)
+    np.testing.assert_array_equal(got[ok], expected[ok])
+
+
+def test_encoder_reuses_output_buffer():
+    now = datetime.now(timezone.utc)
+    docs = bench._random_item_docs(500, now, seed=3)
+    temps, humids = [25.0] * len(docs), [80.0] * len(docs)
+    buf = np.full((len(docs), len(main.TRAINING_COLUMNS)), np.nan, dtype=np.float32)
+
+    out, errors = main._FEATURE_ENCODER.encode(docs, temps, humids, now, out=buf)
+    expected, _ = main._FEATURE_ENCODER.encode(docs, temps, humids, now)
+
+    assert np.shares_memory(out, buf)
+    ok = np.array([e is None for e in errors])
+    np.testing.assert_array_equal(out[ok], expected[ok])
@@ -0,0 +1,15 @@
+# Budget cold start per entry point (waktu import + first use, RSS, modul berat tidak ikut ter-import).
+# STARTUP_BUDGET_SCALE (default 1.0) melonggarkan budget waktu/RSS di runner CI yang lambat.
+import os
+
+import pytest
+
+import bench
+
+BUDGET_SCALE = float(os.getenv("STARTUP_BUDGET_SCALE", "1.0"))
+
+
+@pytest.mark.parametrize("entry_point", sorted(bench.ENTRY_POINT_DEPS))
+def test_entry_point_within_startup_budget(entry_point):
+    best, problems = bench._startup_check(bench.ENTRY_POINT_DEPS[entry_point], repeat=2, budget_scale=BUDGET_SCALE)
+    assert not problems, f"{entry_point}: {'; '.join(problems)} ({best})"
@@ -0,0 +1,82 @@
+# Paritas _CompiledEnsemble (evaluator NumPy) vs lgb.Booster.predict pada booster sintetis kecil.
+import os
+
+import numpy as np
+import pytest
+
+lgb = pytest.importorskip("lightgbm")
+
+import bench
+import main
+
+TOLERANCE = 1e-9
+
+
+@pytest.fixture(scope="module")
+def grid() -> np.ndarray:
+    return bench._feature_grid(20_000)
+
+
+def _with_missing(X: np.ndarray) -> np.ndarray:
+    """Salinan X dengan NaN di kolom biner & suhu (jalur missing value)."""
+    X_nan = X.copy()
+    X_nan[:: 7, 1] = np.nan
+    X_nan[3:: 11, main._IDX_TEMP] = np.nan
+    return X_nan
+
+
+def _train(X: np.ndarray, y: np.ndarray, **params):
+    base = {"verbose": -1, "seed": 7, "deterministic": True, "min_data_in_leaf": 5}
+    return lgb.train({**base, **params}, lgb.Dataset(X, label=y), num_boost_round=40)
+
+
+def _shelf_life_label(X: np.ndarray) -> np.ndarray:
+    rng = np.random.default_rng(7)
+    day, temp, humid = X[:, main._IDX_DAY], X[:, main._IDX_TEMP], X[:, main._IDX_HUMID]
+    return np.clip(30.0 - 0.4 * day - 0.5 * temp + 0.05 * humid + rng.normal(0, 1.5, len(X)), 0, None)
+
+
+def _assert_parity(booster, X: np.ndarray) -> None:
+    compiled = main._CompiledEnsemble.from_model_str(booster.model_to_string())
+    for data in (X, _with_missing(X)):
+        expected = booster.predict(data)
+        got = compiled.predict(data)
+        np.testing.assert_allclose(got, expected, rtol=0, atol=TOLERANCE)
+        assert np.array_equal(np.rint(np.clip(got, 0, 365)), np.rint(np.clip(expected, 0, 365)))
+
+
+# Satu varian per jalur evaluator: bitvector (tanpa missing), traversal (NaN saat training,
+# > 64 leaf), missing_type Zero, dan objective dengan link exp.
+@pytest.mark.parametrize("name, params, nan_in_training, expects_bitvector", [
+    ("l2-bitvector", {"objective": "regression", "num_leaves": 31}, False, True),
+    ("l2-nan-deep", {"objective": "regression", "num_leaves": 127}, True, False),
+    ("l2-zero-missing", {"objective": "regression", "num_leaves": 15, "zero_as_missing": True}, False, False),
+    ("poisson", {"objective": "poisson", "num_leaves": 31}, False, True),
+])
+def test_compiled_ensemble_matches_booster(grid, name, params, nan_in_training, expects_bitvector):
+    X = grid.copy()
+    if nan_in_training:
+        X[np.random.default_rng(7).random(len(X)) < 0.1, main._IDX_TEMP] = np.nan
+    y = _shelf_life_label(grid)
+    if params["objective"] == "poisson":
+        y = np.rint(y)
+    booster = _train(X, y, **params)
+
+    compiled = main._CompiledEnsemble.from_model_str(booster.model_to_string())
+    assert (compiled._tables is not None) == expects_bitvector
+    _assert_parity(booster, grid)
+
+
+def test_multiclass_is_unsupported(grid):
+    label = (grid[:, main._IDX_DAY] > 10).astype(int) + (grid[:, main._IDX_TEMP] > 20).astype(int)
+    booster = lgb.train({"objective": "multiclass", "num_class": 3, "verbose": -1},
+                        lgb.Dataset(grid, label=label), num_boost_round=3)
+    with pytest.raises(main._UnsupportedModelError):
+        main._CompiledEnsemble.from_model_str(booster.model_to_string())
+
+
+@pytest.mark.skipif(not os.getenv("FRESHLENS_MODEL_FILE"), reason="FRESHLENS_MODEL_FILE tidak diset")
+def test_compiled_ensemble_matches_production_model(grid):
+    with open(os.environ["FRESHLENS_MODEL_FILE"], "r", encoding="utf-8") as f:
+        booster = lgb.Booster(model_str=f.read())
+    _assert_parity(booster, grid)
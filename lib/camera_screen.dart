@@ -1,10 +1,11 @@
 // lib/camera_screen.dart
 
-import 'dart:convert';
 import 'dart:io';
 import 'package:camera/camera.dart';
 import 'package:flutter/material.dart';
 import 'package:cloud_functions/cloud_functions.dart';
+import 'package:firebase_auth/firebase_auth.dart';
+import 'package:firebase_storage/firebase_storage.dart';
 import 'package:freshlens_ai_app/confirm_item_screen.dart'; // Halaman berikutnya
 
 class CameraScreen extends StatefulWidget {
@@ -55,19 +56,28 @@ class _CameraScreenState extends State<CameraScreen> {
     setState(() => _isBusy = true);
     final navigator = Navigator.of(context);
     final scaffoldMessenger = ScaffoldMessenger.of(context);
+    Reference? scanRef;
 
     try {
       // 1. Ambil gambar
       final picture = await _controller!.takePicture();
       final imagePath = picture.path;
 
-      // 2. Encode gambar ke Base64
-      final bytes = await File(imagePath).readAsBytes();
-      final base64Image = base64Encode(bytes);
+      // 2. Unggah ke Storage (bytes tidak lewat payload callable)
+      final uid = FirebaseAuth.instance.currentUser!.uid;
+      final ref = FirebaseStorage.instance
+          .ref()
+          .child('scans')
+          .child(uid)
+          .child('${DateTime.now().millisecondsSinceEpoch}.jpg');
+      scanRef = ref;
+      await ref.putFile(File(imagePath));
 
       // 3. Panggil Cloud Function untuk deteksi objek
+      //    (annotate_image menghapus objek scans/ setelah dianotasi)
       final callable = _functions.httpsCallable('annotate_image');
-      final response = await callable.call(<String, dynamic>{'image': base64Image});
+      final response = await callable.call(<String, dynamic>{'path': ref.fullPath});
+      scanRef = null;
 
       // Ambil label dari response, default ke 'Tidak Dikenali'
       final detectedLabel = (response.data is Map && response.data['label'] != null)
@@ -84,6 +94,8 @@ class _CameraScreenState extends State<CameraScreen> {
         ),
       );
     } catch (e) {
+      // Panggilan gagal sebelum/tanpa sampai ke function: hapus unggahan sendiri (best effort)
+      scanRef?.delete().catchError((_) {});
       scaffoldMessenger.showSnackBar(
         SnackBar(content: Text('Gagal memproses gambar: ${e.toString()}')),
       );
@@ -61,7 +61,7 @@ class _HomeContentState extends State<HomeContent> {
             id: doc.id,
             entryDate: (data['entryDate'] as Timestamp? ?? Timestamp.now()).toDate(),
             quantity: data['quantity'] ?? 0,
-            predictedShelfLife: data['predictedShelfLife'] ?? 7,
+            predictedShelfLife: daysRemainingFromData(data),
             initialCondition: data['initialCondition'] ?? 'Tidak diketahui',
           );
         }).toList(),
@@ -59,7 +59,7 @@ class _InventoryScreenState extends State<InventoryScreen> {
             entryDate:
                 (data['entryDate'] as Timestamp? ?? Timestamp.now()).toDate(),
             quantity: data['quantity'] ?? 0,
-            predictedShelfLife: data['predictedShelfLife'] ?? 7,
+            predictedShelfLife: daysRemainingFromData(data),
             initialCondition: data['initialCondition'] ?? 'Tidak diketahui',
           );
         }).toList(),
@@ -1,5 +1,7 @@
 // lib/models/inventory_item_model.dart
 
+import 'package:cloud_firestore/cloud_firestore.dart';
+
 class Batch {
   final String id;
   final DateTime entryDate;
@@ -30,4 +32,23 @@ class InventoryItemGroup {
   int get totalQuantity {
     return batches.fold(0, (sum, item) => sum + item.quantity);
   }
-}
\ No newline at end of file
+}
+
+/// Sisa hari saat [now] dari trajektori prediksi (`shelfLifeTrajectory`) yang ditulis backend,
+/// sehingga angka tetap berjalan tanpa update harian. Dokumen lama: `predictedShelfLife` apa adanya.
+int daysRemainingFromData(Map<String, dynamic> data, {DateTime? now}) {
+  final fallback = (data['predictedShelfLife'] as num?)?.toInt() ?? 7;
+  final trajectory = data['shelfLifeTrajectory'];
+  if (trajectory is! Map) return fallback;
+  final days = (trajectory['days'] as List?)?.map((d) => (d as num).toInt()).toList();
+  if (days == null || days.isEmpty) return fallback;
+  final startAt = trajectory['startAt'];
+  if (startAt is! Timestamp) return days.first;
+
+  final elapsed = (now ?? DateTime.now()).difference(startAt.toDate());
+  final k = elapsed.isNegative ? 0 : elapsed.inMicroseconds ~/ Duration.microsecondsPerDay;
+  if (k < days.length) return days[k];
+  // Setelah akhir trajektori: turun 1 hari per hari
+  final extrapolated = days.last - (k - days.length + 1);
+  return extrapolated < 0 ? 0 : extrapolated;
+}